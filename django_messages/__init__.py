@@ -1,20 +1,34 @@
 VERSION = (0, 5, 0, 'pre')
 __version__ = '.'.join(map(str, VERSION))
 
-from django.db.models import signals
+from django.db.models.signals import post_save
 from django_messages.models import Message
+from django_messages.signals import messages_sent
+from django_messages.instrumentation import instrument
 from django.conf import settings
 
 notification = False
 if 'notification' in settings.INSTALLED_APPS:
     from notification import models as notification
 
+def notify(message):
+    if message.parent_msg:
+        notification.send([message.sender], "messages_replied", {'message': message,})
+        notification.send([message.recipient], "messages_reply_received", {'message': message,})
+    else:
+        notification.send([message.sender], "messages_sent", {'message': message,})
+        notification.send([message.recipient], "messages_received", {'message': message,})
+notify = instrument('notification.notify')(notify)
+
 def message_post_save_callback(sender, instance, created, **kwargs):
     if notification and created:
-        if instance.parent_msg:
-            notification.send([instance.sender], "messages_replied", {'message': instance,})
-            notification.send([instance.recipient], "messages_reply_received", {'message': instance,})
-        else:
-            notification.send([instance.sender], "messages_sent", {'message': instance,})
-            notification.send([instance.recipient], "messages_received", {'message': instance,})
-signals.post_save.connect(message_post_save_callback, sender=Message)
+        notify(instance)
+post_save.connect(message_post_save_callback, sender=Message)
+
+def messages_sent_callback(sender, messages, **kwargs):
+    if notification:
+        # notices are rendered with the message of each recipient, they
+        # can't be sent together
+        for message in messages:
+            notify(message)
+messages_sent.connect(messages_sent_callback, sender=Message)
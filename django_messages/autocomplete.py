@@ -0,0 +1,95 @@
+"""
+Completion of usernames for the recipient field.
+
+Usernames are looked up in a sorted index held in the memory of each
+process and rebuilt from the database every
+``DJANGO_MESSAGES_USERNAME_INDEX_TIMEOUT`` seconds, so that completing a
+prefix is a binary search rather than a ``LIKE`` query on the user table.
+The recent correspondents of a user, kept in the Django cache, are
+suggested first.
+"""
+import bisect
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+
+from django_messages.models import ConversationParticipant
+
+USERNAME_INDEX_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_USERNAME_INDEX_TIMEOUT', 60 * 5)
+CORRESPONDENTS_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_CORRESPONDENTS_TIMEOUT', 60 * 5)
+# number of latest conversations the correspondents are read from
+CORRESPONDENTS_COUNT = 50
+
+# (keys, usernames, expires), replaced as a whole so that a thread reading it
+# while another one rebuilds it never gets the keys of one and the usernames
+# of the other
+_index = {'current': ([], [], 0)}
+
+
+def reset_username_index():
+    """drops the index of this process, it is rebuilt on next use"""
+    _index['current'] = ([], [], 0)
+
+def get_username_index():
+    """
+    returns the lowercased usernames of the active users and the usernames
+    themselves, sorted on the former
+    """
+    now = time.time()
+    keys, usernames, expires = _index['current']
+    if expires <= now:
+        usernames = sorted(
+            User.objects.filter(is_active=True).values_list('username', flat=True),
+            key=lambda username: username.lower()
+        )
+        keys = [username.lower() for username in usernames]
+        _index['current'] = (keys, usernames, now + USERNAME_INDEX_TIMEOUT)
+    return keys, usernames
+
+def correspondents_key(user_id):
+    return 'django_messages:correspondents:%s' % user_id
+
+def get_correspondents(user):
+    """
+    returns the usernames of the users the given user recently received
+    messages from or sent messages to, latest first
+    """
+    key = correspondents_key(user.pk)
+    correspondents = cache.get(key)
+    if correspondents is None:
+        rows = ConversationParticipant.objects.filter(
+            user=user,
+        ).order_by('-last_activity').values_list(
+            'inbox_message__sender__username',
+            'outbox_message__recipient__username',
+        )[:CORRESPONDENTS_COUNT]
+        correspondents = []
+        for usernames in rows:
+            for username in usernames:
+                if username and username != user.username and username not in correspondents:
+                    correspondents.append(username)
+        cache.set(key, correspondents, CORRESPONDENTS_TIMEOUT)
+    return correspondents
+
+def complete(user, prefix, limit=10):
+    """
+    returns at most ``limit`` usernames starting with ``prefix``, regardless
+    of case, the recent correspondents of ``user`` first
+    """
+    prefix = prefix.lower()
+    matches = [
+        username for username in get_correspondents(user)
+        if username.lower().startswith(prefix)
+    ][:limit]
+    if not prefix:
+        return matches
+    keys, usernames = get_username_index()
+    i = bisect.bisect_left(keys, prefix)
+    while len(matches) < limit and i < len(keys) and keys[i].startswith(prefix):
+        username = usernames[i]
+        if username != user.username and username not in matches:
+            matches.append(username)
+        i += 1
+    return matches
@@ -0,0 +1,278 @@
+"""
+Benchmarks of the listings, counters and views of django-messages over a
+synthetic population.
+
+``Population`` fills the database with users and conversations: thread
+lengths follow a Pareto distribution and a few bots start a large share of
+the conversations. ``Benchmark`` then times the manager methods and views
+for a sample of the users and reports, for each of them, the median and
+95th percentile durations, the number of queries and of rows returned::
+
+    population = Population(users=1000, conversations=20000)
+    population.generate()
+    try:
+        results = Benchmark(population, repeat=50).run()
+    finally:
+        population.delete()
+
+The ``benchmark_messages`` command does the same and prints the results as
+JSON, so that runs can be compared.
+"""
+import datetime
+import math
+import random
+import time
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.client import Client
+
+from django_messages import counters
+from django_messages.instrumentation import enable_debug_cursors, restore_debug_cursors, \
+    query_counts, queries_since
+from django_messages.models import Message, ConversationParticipant, inbox_count_for, \
+    make_snippet
+
+PASSWORD = 'benchmark'
+
+
+def percentile(values, percent):
+    """returns the nearest-rank percentile of a list of numbers"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Population(object):
+    """
+    Synthetic users and conversations, inserted with ``bulk_create``.
+    Usernames start with ``prefix`` so that the population can be deleted
+    afterwards.
+    """
+    def __init__(self, users=100, conversations=1000, max_thread_length=50,
+            thread_length_alpha=1.5, bots=2, bot_share=0.3, deleted_share=0.1,
+            prefix='benchmark_', seed=0, batch_size=500):
+        self.users = users
+        self.conversations = conversations
+        self.max_thread_length = max_thread_length
+        self.thread_length_alpha = thread_length_alpha
+        self.bots = bots
+        self.bot_share = bot_share
+        self.deleted_share = deleted_share
+        self.prefix = prefix
+        self.seed = seed
+        self.batch_size = batch_size
+        self.messages = 0
+
+    def params(self):
+        return {
+            'users': self.users,
+            'bots': self.bots,
+            'conversations': self.conversations,
+            'messages': self.messages,
+            'max_thread_length': self.max_thread_length,
+            'thread_length_alpha': self.thread_length_alpha,
+            'bot_share': self.bot_share,
+            'deleted_share': self.deleted_share,
+            'seed': self.seed,
+        }
+
+    def get_users(self):
+        return User.objects.filter(username__startswith=self.prefix)
+
+    def generate(self):
+        rand = random.Random(self.seed)
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username='%s%d' % (self.prefix, i), password=password)
+            for i in range(self.users + self.bots)
+        ])
+        user_ids = list(self.get_users().order_by('pk').values_list('pk', flat=True))
+        self.bot_ids, self.user_ids = user_ids[:self.bots], user_ids[self.bots:]
+
+        start = datetime.datetime.now() - datetime.timedelta(days=365)
+        done = 0
+        while done < self.conversations:
+            count = min(self.batch_size, self.conversations - done)
+            threads = []
+            for i in range(count):
+                if self.bot_ids and rand.random() < self.bot_share:
+                    sender_id = rand.choice(self.bot_ids)
+                else:
+                    sender_id = rand.choice(self.user_ids)
+                recipient_id = rand.choice(self.user_ids)
+                length = min(self.max_thread_length,
+                    int(rand.paretovariate(self.thread_length_alpha)))
+                sent_at = start + datetime.timedelta(minutes=rand.randint(0, 60 * 24 * 365))
+                threads.append((sender_id, recipient_id, length, sent_at))
+            self.create_threads(rand, threads)
+            done += count
+        return self
+
+    def create_threads(self, rand, threads):
+        """inserts a batch of conversations, roots first then replies"""
+        roots = [
+            self.make_message(rand, sender_id, recipient_id, None, sent_at)
+            for sender_id, recipient_id, length, sent_at in threads
+        ]
+        db = Message.objects.write_db
+        with transaction.commit_on_success(using=db):
+            # the ids are known without reading the roots back, which could
+            # pick up messages inserted meanwhile by another process
+            Message.objects._insert_with_ids(roots, db)
+            root_ids = [root.pk for root in roots]
+            Message.objects.filter(pk__in=root_ids).update(conversation=F('id'))
+
+        replies = []
+        for root_id, (sender_id, recipient_id, length, sent_at) in zip(root_ids, threads):
+            for i in range(1, length):
+                if i % 2:
+                    sender_id, recipient_id = recipient_id, sender_id
+                sent_at += datetime.timedelta(minutes=rand.randint(1, 60 * 24))
+                replies.append(self.make_message(rand, sender_id, recipient_id, root_id, sent_at))
+        Message.objects.bulk_create(replies)
+        ConversationParticipant.objects.refresh(root_ids)
+        self.messages += len(root_ids) + len(replies)
+
+    def make_message(self, rand, sender_id, recipient_id, conversation_id, sent_at):
+        body = 'Body ' * rand.randint(1, 100)
+        message = Message(
+            sender_id=sender_id,
+            recipient_id=recipient_id,
+            conversation_id=conversation_id,
+            subject='Subject %d' % rand.randint(0, 10 ** 6),
+            body=body,
+            snippet=make_snippet(body),
+            sent_at=sent_at,
+        )
+        if rand.random() < 0.8:
+            message.read_at = sent_at
+        if rand.random() < self.deleted_share:
+            message.recipient_deleted_at = sent_at
+        return message
+
+    def delete(self):
+        """deletes the users of the population with their messages"""
+        user_ids = list(self.get_users().values_list('pk', flat=True))
+        for i in range(0, len(user_ids), self.batch_size):
+            batch = user_ids[i:i + self.batch_size]
+            ConversationParticipant.objects.filter(user__in=batch).delete()
+            Message.objects.filter(sender__in=batch).delete()
+        self.get_users().delete()
+
+
+class Benchmark(object):
+    """
+    Times each case ``repeat`` times, each time for the next user of a
+    sample of the population, and counts its queries in an extra untimed
+    call.
+    """
+    cases = (
+        'inbox_for', 'outbox_for', 'trash_for', 'get_conversation',
+        'inbox_count_for', 'view', 'delete',
+    )
+
+    def __init__(self, population, repeat=20, per_page=20, sample=10, seed=0):
+        self.population = population
+        self.repeat = repeat
+        self.per_page = per_page
+        rand = random.Random(seed)
+        user_ids = population.user_ids + population.bot_ids
+        self.users = list(User.objects.filter(
+            pk__in=rand.sample(user_ids, min(sample, len(user_ids)))
+        ))
+        self.clients = {}
+
+    def get_client(self, user):
+        if user.pk not in self.clients:
+            client = Client()
+            client.login(username=user.username, password=PASSWORD)
+            self.clients[user.pk] = client
+        return self.clients[user.pk]
+
+    def get_conversation_id(self, user):
+        participant = ConversationParticipant.objects.filter(user=user)[:1]
+        return participant and participant[0].conversation_id or None
+
+    def case_inbox_for(self, user):
+        return len(Message.objects.inbox_for(user, per_page=self.per_page))
+
+    def case_outbox_for(self, user):
+        return len(Message.objects.outbox_for(user, per_page=self.per_page))
+
+    def case_trash_for(self, user):
+        return len(Message.objects.trash_for(user, per_page=self.per_page))
+
+    def case_get_conversation(self, user):
+        conversation_id = self.get_conversation_id(user)
+        if conversation_id is None:
+            return 0
+        return len(Message.objects.get_conversation(conversation_id))
+
+    def case_inbox_count_for(self, user):
+        # the count is timed as computed on a cache miss
+        counters.invalidate_inbox_counts([user.pk])
+        inbox_count_for(user)
+        return 1
+
+    def case_view(self, user):
+        conversation_id = self.get_conversation_id(user)
+        if conversation_id is None:
+            return 0
+        self.get_client(user).get(reverse('messages_detail', args=(conversation_id,)))
+        return 1
+
+    def case_delete(self, user):
+        conversation_id = self.get_conversation_id(user)
+        if conversation_id is None:
+            return 0
+        client = self.get_client(user)
+        client.post(reverse('messages_delete'), {'ids': conversation_id})
+        # put the conversation back for the next runs
+        client.post(reverse('messages_undelete'), {'ids': conversation_id})
+        return 1
+
+    def measure(self, case):
+        function = getattr(self, 'case_%s' % case)
+        durations = []
+        rows = []
+        for i in range(self.repeat):
+            user = self.users[i % len(self.users)]
+            started = time.time()
+            rows.append(function(user))
+            durations.append((time.time() - started) * 1000)
+
+        # the queries sent to the replicas count too
+        use_debug_cursors = enable_debug_cursors()
+        try:
+            counts = query_counts()
+            function(self.users[0])
+            queries = len(queries_since(counts))
+        finally:
+            restore_debug_cursors(use_debug_cursors)
+        return {
+            'p50_ms': percentile(durations, 50),
+            'p95_ms': percentile(durations, 95),
+            'mean_ms': sum(durations) / len(durations),
+            'queries': queries,
+            'rows': percentile(rows, 50),
+        }
+
+    def run(self, cases=None):
+        """returns the results of the given cases, all by default"""
+        results = {}
+        for case in cases or self.cases:
+            results[case] = self.measure(case)
+        return {
+            'population': self.population.params(),
+            'repeat': self.repeat,
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'results': results,
+        }
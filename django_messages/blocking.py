@@ -0,0 +1,74 @@
+"""
+Blocklist lookups for django-relationships.
+
+A recipient blocks a sender through a relationship of the "blocking"
+status going from the recipient to the sender. The status is looked up
+once per process, and the ids of the users each recipient blocks are kept
+in the Django cache, dropped whenever one of their relationships changes,
+so that checking the recipients of a message takes at most one query.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+
+if "relationships" in settings.INSTALLED_APPS:
+    from relationships.models import Relationship, RelationshipStatus
+    relationships = True
+else:
+    relationships = False
+
+BLOCKLIST_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_BLOCKLIST_TIMEOUT', 60 * 60 * 24)
+
+_status = {}
+
+
+def get_blocking_status():
+    """returns the "blocking" ``RelationshipStatus``, read once per process"""
+    if 'blocking' not in _status:
+        _status['blocking'] = RelationshipStatus.objects.get(from_slug="blocking")
+    return _status['blocking']
+
+def blocklist_key(user_id):
+    return 'django_messages:blocklist:%s' % user_id
+
+def get_blocklists(user_ids):
+    """
+    returns a dict of the sets of the ids of the users blocked by each of
+    the given users, reading the ones missing from the cache in one query
+    """
+    keys = dict((blocklist_key(user_id), user_id) for user_id in user_ids)
+    cached = cache.get_many(keys.keys())
+    blocklists = dict((keys[key], blocked) for key, blocked in cached.items())
+    missing = [user_id for user_id in user_ids if user_id not in blocklists]
+    if missing:
+        loaded = dict((user_id, set()) for user_id in missing)
+        for from_user_id, to_user_id in Relationship.objects.filter(
+            from_user__in=missing,
+            status=get_blocking_status(),
+            site__pk=settings.SITE_ID,
+        ).values_list('from_user', 'to_user'):
+            loaded[from_user_id].add(to_user_id)
+        cache.set_many(
+            dict((blocklist_key(user_id), blocked) for user_id, blocked in loaded.items()),
+            BLOCKLIST_TIMEOUT
+        )
+        blocklists.update(loaded)
+    return blocklists
+
+def blockers_of(sender, recipients):
+    """returns the recipients who block the sender, in the given order"""
+    blocklists = get_blocklists([recipient.pk for recipient in recipients])
+    return [recipient for recipient in recipients
+        if sender.pk in blocklists[recipient.pk]]
+
+def invalidate_blocklist(sender, instance, **kwargs):
+    cache.delete(blocklist_key(instance.from_user_id))
+
+def reset_blocking_status(sender, **kwargs):
+    _status.clear()
+
+if relationships:
+    signals.post_save.connect(invalidate_blocklist, sender=Relationship)
+    signals.post_delete.connect(invalidate_blocklist, sender=Relationship)
+    signals.post_save.connect(reset_blocking_status, sender=RelationshipStatus)
+    signals.post_delete.connect(reset_blocking_status, sender=RelationshipStatus)
@@ -0,0 +1,82 @@
+"""
+Per-user counters stored in the Django cache.
+
+The database stays the source of truth: a counter missing from the cache is
+recomputed by its reader, and writers that can't tell by how much a counter
+changed simply drop it.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_messages.signals import mailbox_changed
+
+INBOX_COUNT_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_INBOX_COUNT_TIMEOUT', 60 * 60 * 24)
+MAILBOX_VERSION_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_MAILBOX_VERSION_TIMEOUT', 60 * 60 * 24)
+
+
+def inbox_count_key(user_id):
+    return 'django_messages:inbox_count:%s' % user_id
+
+def get_inbox_count(user_id):
+    """returns the cached unread count of the user or None"""
+    return cache.get(inbox_count_key(user_id))
+
+def get_inbox_counts(user_ids):
+    """returns a dict of the cached unread counts of the given users"""
+    keys = dict((inbox_count_key(user_id), user_id) for user_id in user_ids)
+    cached = cache.get_many(keys.keys())
+    return dict((keys[key], count) for key, count in cached.items())
+
+def set_inbox_count(user_id, count):
+    cache.set(inbox_count_key(user_id), count, INBOX_COUNT_TIMEOUT)
+
+def set_inbox_counts(counts):
+    """stores a dict of unread counts by user id"""
+    cache.set_many(dict(
+        (inbox_count_key(user_id), count) for user_id, count in counts.items()
+    ), INBOX_COUNT_TIMEOUT)
+
+def incr_inbox_count(user_id, delta=1):
+    """
+    Adds ``delta`` to the cached unread count of the user, if there is one.
+    """
+    try:
+        if delta < 0:
+            cache.decr(inbox_count_key(user_id), -delta)
+        else:
+            cache.incr(inbox_count_key(user_id), delta)
+    except ValueError:
+        # not cached, the next reader will count
+        pass
+
+def invalidate_inbox_counts(user_ids):
+    cache.delete_many([inbox_count_key(user_id) for user_id in user_ids])
+
+def mailbox_version_key(user_id):
+    return 'django_messages:mailbox_version:%s' % user_id
+
+def get_mailbox_version(user_id):
+    """
+    returns the version of the mailbox of the user, the time of its latest
+    change as a float timestamp. A version missing from the cache starts
+    anew at the current time.
+    """
+    key = mailbox_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = time.time()
+        # another process may have started it in the meantime
+        if not cache.add(key, version, MAILBOX_VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+def bump_mailbox_versions(user_ids):
+    """marks the mailboxes of the given users as changed"""
+    user_ids = list(user_ids)
+    version = time.time()
+    cache.set_many(dict(
+        (mailbox_version_key(user_id), version) for user_id in user_ids
+    ), MAILBOX_VERSION_TIMEOUT)
+    mailbox_changed.send(sender=None, user_ids=user_ids, version=version)
@@ -0,0 +1,148 @@
+"""
+Keyset pagination of the conversations of a user.
+
+Pages are ordered by last activity then conversation id, newest first, and
+a cursor remembers the key of the row a page ends (or starts) on. Fetching
+any page is then a range scan starting at that key instead of an
+``OFFSET`` over every previous page. Lists of messages, such as the
+messages of a conversation, are paged the same way on their id alone.
+"""
+import base64
+import binascii
+import datetime
+
+from django.db.models import Q
+
+NEXT = 'n'
+PREVIOUS = 'p'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(direction, last_activity, conversation_id):
+    value = '%s|%s|%d' % (
+        direction,
+        last_activity.strftime(DATETIME_FORMAT),
+        conversation_id,
+    )
+    return base64.urlsafe_b64encode(value)
+
+def decode_cursor(cursor):
+    """
+    Returns a ``(direction, last_activity, conversation_id)`` tuple, or
+    None if ``cursor`` is not a valid cursor.
+    """
+    try:
+        direction, last_activity, conversation_id = \
+            base64.urlsafe_b64decode(str(cursor)).split('|')
+        last_activity = datetime.datetime.strptime(last_activity, DATETIME_FORMAT)
+        conversation_id = int(conversation_id)
+    except (TypeError, ValueError, UnicodeEncodeError, binascii.Error):
+        return None
+    if direction not in (NEXT, PREVIOUS):
+        return None
+    return direction, last_activity, conversation_id
+
+
+class CursorPage(object):
+    """
+    A page of conversations. ``object_list`` holds one message per
+    conversation, ``next_cursor`` and ``previous_cursor`` are None on the
+    last and first page.
+    """
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+def paginate(queryset, cursor, per_page, get_object=None):
+    """
+    Returns the ``CursorPage`` of ``queryset`` designated by ``cursor``,
+    the first one if ``cursor`` is None or invalid. ``queryset`` is a
+    queryset of rows with ``last_activity`` and ``conversation`` fields,
+    ``get_object`` maps each row to the object put in the page.
+    """
+    table = queryset.model._meta.db_table
+    key = cursor and decode_cursor(cursor)
+    if key:
+        direction, last_activity, conversation_id = key
+    else:
+        direction = NEXT
+    if direction == NEXT:
+        order = '-'
+        lookup = 'lt'
+    else:
+        order = ''
+        lookup = 'gt'
+    if key:
+        queryset = queryset.filter(
+            Q(**{'last_activity__%s' % lookup: last_activity}) |
+            Q(**{
+                'last_activity': last_activity,
+                'conversation__%s' % lookup: conversation_id,
+            })
+        )
+    # ordering on the column avoids a join on the conversation
+    queryset = queryset.order_by().extra(order_by=[
+        '%s%s.last_activity' % (order, table),
+        '%s%s.conversation_id' % (order, table),
+    ])
+    rows = list(queryset[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == PREVIOUS:
+        rows.reverse()
+    if not rows:
+        return CursorPage([])
+
+    first, last = rows[0], rows[-1]
+    if direction == NEXT:
+        has_next, has_previous = more, bool(key)
+    else:
+        has_next, has_previous = True, more
+    next_cursor = previous_cursor = None
+    if has_next:
+        next_cursor = encode_cursor(NEXT, last.last_activity, last.conversation_id)
+    if has_previous:
+        previous_cursor = encode_cursor(PREVIOUS, first.last_activity, first.conversation_id)
+    if get_object is not None:
+        rows = [get_object(row) for row in rows]
+    return CursorPage(rows, next_cursor, previous_cursor)
+
+def paginate_by_id(queryset, before, per_page):
+    """
+    Returns a ``CursorPage`` of the ``per_page`` rows of ``queryset`` with
+    the highest ids below ``before``, newest first. The ``next_cursor`` of
+    the page is the ``before`` of the following one. An invalid ``before``
+    gives the first page.
+    """
+    try:
+        before = int(before)
+    except (TypeError, ValueError):
+        before = None
+    if before is not None:
+        queryset = queryset.filter(pk__lt=before)
+    rows = list(queryset.order_by('-id')[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = str(rows[-1].pk)
+    return CursorPage(rows, next_cursor)
@@ -28,33 +28,58 @@ class CommaSeparatedUserInput(widgets.Input):
         
 
 
+def batch_recipient_filter(recipient_filter):
+    """
+    Adapts a ``recipient_filter``, called with each user and returning False
+    to reject it, to the batch protocol of ``recipients_filter``: called
+    once with the list of users, it returns the set of the allowed ones.
+    """
+    def recipients_filter(users):
+        return set([user for user in users if recipient_filter(user) is not False])
+    return recipients_filter
+
+
 class CommaSeparatedUserField(forms.Field):
     widget = CommaSeparatedUserInput
     
     def __init__(self, *args, **kwargs):
         recipient_filter = kwargs.pop('recipient_filter', None)
+        recipients_filter = kwargs.pop('recipients_filter', None)
         self._recipient_filter = recipient_filter
+        self._recipients_filter = recipients_filter
         super(CommaSeparatedUserField, self).__init__(*args, **kwargs)
         
+    def get_recipients_filter(self):
+        """
+        Returns the batch filter of the recipients, adapting the per user
+        ``recipient_filter`` if that's the one given.
+        """
+        if self._recipients_filter is not None:
+            return self._recipients_filter
+        if self._recipient_filter is not None:
+            return batch_recipient_filter(self._recipient_filter)
+        return None
+
     def clean(self, value):
         super(CommaSeparatedUserField, self).clean(value)
         if not value:
             return ''
         if isinstance(value, (list, tuple)):
             return value
+        if isinstance(value, User):
+            value = value.username
         
         names = set(value.split(','))
         names_set = set([name.strip() for name in names])
         users = list(User.objects.filter(username__in=names_set))
         unknown_names = names_set ^ set([user.username for user in users])
         
-        recipient_filter = self._recipient_filter
+        recipients_filter = self.get_recipients_filter()
         invalid_users = []
-        if recipient_filter is not None:
-            for r in users:
-                if recipient_filter(r) is False:
-                    users.remove(r)
-                    invalid_users.append(r.username)
+        if recipients_filter is not None and users:
+            allowed = set(recipients_filter(users))
+            invalid_users = [user.username for user in users if user not in allowed]
+            users = [user for user in users if user in allowed]
         
         if unknown_names or invalid_users:
             raise forms.ValidationError(_(u"The following usernames are incorrect: %(users)s") % {'users': ', '.join(list(unknown_names)+invalid_users)})
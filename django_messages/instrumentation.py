@@ -0,0 +1,200 @@
+"""
+Opt-in instrumentation of the views, manager methods and notification
+senders of django-messages.
+
+When ``DJANGO_MESSAGES_INSTRUMENTATION`` is True, every call of an
+instrumented function records its number of queries, the time spent in the
+database and in total (in milliseconds) and, when its result is a list or
+a page, the number of rows it returned. The metric is handed to each sink
+of ``DJANGO_MESSAGES_METRICS_SINKS``, dotted paths to classes with a
+``send(metric)`` method:
+
+* ``django_messages.instrumentation.LoggingSink`` logs to the
+  ``django_messages.metrics`` logger (the default);
+* ``django_messages.instrumentation.AggregatorSink`` sums the metrics in
+  the memory of the process, shown by the ``messages_stats`` view;
+* ``django_messages.instrumentation.StatsdSink`` sends them in the statsd
+  format over UDP to ``DJANGO_MESSAGES_STATSD_HOST`` and
+  ``DJANGO_MESSAGES_STATSD_PORT``.
+
+Queries are counted on every database of ``DATABASES``, replicas
+included, by turning their debug cursors on during the outermost
+instrumented call.
+"""
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('django_messages.metrics')
+
+_local = threading.local()
+_sinks = {}
+
+
+def is_enabled():
+    return getattr(settings, 'DJANGO_MESSAGES_INSTRUMENTATION', False)
+
+def get_sinks():
+    """returns the sinks of the ``DJANGO_MESSAGES_METRICS_SINKS`` setting"""
+    paths = tuple(getattr(settings, 'DJANGO_MESSAGES_METRICS_SINKS',
+        ('django_messages.instrumentation.LoggingSink',)))
+    if paths not in _sinks:
+        sinks = []
+        for path in paths:
+            module, name = path.rsplit('.', 1)
+            sinks.append(getattr(import_module(module), name)())
+        _sinks.clear()
+        _sinks[paths] = sinks
+    return _sinks[paths]
+
+def count_rows(result):
+    """returns the length of a list or page, None for anything else"""
+    if isinstance(result, (list, tuple)) or hasattr(result, 'object_list'):
+        return len(result)
+    # a queryset is only counted if it was evaluated by the call
+    if getattr(result, '_result_cache', None) is not None:
+        return len(result._result_cache)
+    return None
+
+def enable_debug_cursors():
+    """
+    Makes every database record its queries, and returns the previous state
+    for ``restore_debug_cursors``.
+    """
+    previous = {}
+    for alias in connections:
+        previous[alias] = connections[alias].use_debug_cursor
+        connections[alias].use_debug_cursor = True
+    return previous
+
+def restore_debug_cursors(previous):
+    for alias, use_debug_cursor in previous.items():
+        connections[alias].use_debug_cursor = use_debug_cursor
+        if not settings.DEBUG:
+            del connections[alias].queries[:]
+
+def query_counts():
+    """returns the number of queries recorded so far by each database"""
+    return dict((alias, len(connections[alias].queries)) for alias in connections)
+
+def queries_since(counts):
+    """returns the queries recorded by every database since ``query_counts()``"""
+    queries = []
+    for alias in connections:
+        queries.extend(connections[alias].queries[counts.get(alias, 0):])
+    return queries
+
+def publish(metric):
+    for sink in get_sinks():
+        try:
+            sink.send(metric)
+        except Exception, e:
+            logger.warning('Could not publish %s to %r: %s', metric['name'], sink, e)
+
+def instrument(name):
+    """
+    Returns a decorator recording the metrics of the calls of a function
+    under the given name.
+    """
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return function(*args, **kwargs)
+            depth = getattr(_local, 'depth', 0)
+            if depth == 0:
+                _local.use_debug_cursors = enable_debug_cursors()
+            _local.depth = depth + 1
+            counts = query_counts()
+            started = time.time()
+            result = None
+            try:
+                result = function(*args, **kwargs)
+                return result
+            finally:
+                total_time = (time.time() - started) * 1000
+                queries = queries_since(counts)
+                _local.depth = depth
+                if depth == 0:
+                    restore_debug_cursors(_local.use_debug_cursors)
+                publish({
+                    'name': name,
+                    'queries': len(queries),
+                    'db_time': sum(float(query['time']) for query in queries) * 1000,
+                    'total_time': total_time,
+                    'rows': count_rows(result),
+                })
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__module__ = function.__module__
+        return wrapper
+    return decorator
+
+
+class LoggingSink(object):
+
+    def send(self, metric):
+        logger.info('%(name)s: %(queries)d queries, %(db_time).1f ms in the database, '
+            '%(total_time).1f ms in total, %(rows)s rows' % metric)
+
+
+class AggregatorSink(object):
+    """
+    Sums the metrics of each name in the memory of the process.
+    """
+    lock = threading.Lock()
+    stats = {}
+
+    def send(self, metric):
+        with self.lock:
+            stats = self.stats.setdefault(metric['name'], {
+                'calls': 0, 'queries': 0, 'db_time': 0.0, 'total_time': 0.0,
+                'max_total_time': 0.0, 'rows': 0,
+            })
+            stats['calls'] += 1
+            stats['queries'] += metric['queries']
+            stats['db_time'] += metric['db_time']
+            stats['total_time'] += metric['total_time']
+            stats['max_total_time'] = max(stats['max_total_time'], metric['total_time'])
+            stats['rows'] += metric['rows'] or 0
+
+    def get_stats(cls):
+        """returns a copy of the metrics summed so far"""
+        with cls.lock:
+            return dict((name, dict(stats)) for name, stats in cls.stats.items())
+    get_stats = classmethod(get_stats)
+
+    def reset(cls):
+        with cls.lock:
+            cls.stats.clear()
+    reset = classmethod(reset)
+
+
+class StatsdSink(object):
+    """
+    Sends the metrics as statsd packets: timers for the durations and
+    counters for the calls, queries and rows.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or getattr(settings, 'DJANGO_MESSAGES_STATSD_HOST', 'localhost'),
+            port or getattr(settings, 'DJANGO_MESSAGES_STATSD_PORT', 8125),
+        )
+        self.prefix = prefix or getattr(settings, 'DJANGO_MESSAGES_STATSD_PREFIX', 'django_messages')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, metric):
+        name = '%s.%s' % (self.prefix, metric['name'])
+        lines = [
+            '%s.calls:1|c' % name,
+            '%s.queries:%d|c' % (name, metric['queries']),
+            '%s.db_time:%.3f|ms' % (name, metric['db_time']),
+            '%s.total_time:%.3f|ms' % (name, metric['total_time']),
+        ]
+        if metric['rows'] is not None:
+            lines.append('%s.rows:%d|c' % (name, metric['rows']))
+        self.socket.sendto('\n'.join(lines), self.address)
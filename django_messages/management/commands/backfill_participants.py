@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_messages.models import Message, ConversationParticipant
+
+
+class Command(BaseCommand):
+    """Rebuild the conversation summaries of every participant from messages"""
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=500,
+            help='Number of conversations refreshed at once'),
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.total = 0
+        # messages saved without a conversation are their own conversation
+        self.refresh_in_batches('pk', Message.objects.filter(
+            conversation__isnull=True,
+        ))
+        self.refresh_in_batches('conversation__id', Message.objects.all())
+        self.stdout.write('Total count of conversations refreshed: %d\n' % self.total)
+
+    def refresh_in_batches(self, field, queryset):
+        queryset = queryset.values_list(field, flat=True).distinct().order_by(field)
+        last = 0
+        while True:
+            lookup = {'%s__gt' % field: last}
+            conversations = list(queryset.filter(**lookup)[:self.batch_size])
+            if not conversations:
+                break
+            ConversationParticipant.objects.refresh(conversations)
+            self.total += len(conversations)
+            last = conversations[-1]
+            self.stdout.write('Refreshed %d conversations\n' % self.total)
@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from django_messages.benchmark import Population, Benchmark
+
+
+class Command(BaseCommand):
+    """Time the listings and views over a synthetic population and print JSON results"""
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users',
+            action='store',
+            type='int',
+            dest='users',
+            default=100,
+            help='Number of users generated'),
+        make_option('--bots',
+            action='store',
+            type='int',
+            dest='bots',
+            default=2,
+            help='Number of heavy senders generated'),
+        make_option('--bot-share',
+            action='store',
+            type='float',
+            dest='bot_share',
+            default=0.3,
+            help='Share of the conversations started by the heavy senders'),
+        make_option('--conversations',
+            action='store',
+            type='int',
+            dest='conversations',
+            default=1000,
+            help='Number of conversations generated'),
+        make_option('--max-thread-length',
+            action='store',
+            type='int',
+            dest='max_thread_length',
+            default=50,
+            help='Maximum number of messages in a conversation'),
+        make_option('--repeat',
+            action='store',
+            type='int',
+            dest='repeat',
+            default=20,
+            help='Number of times each case is timed'),
+        make_option('--case',
+            action='append',
+            dest='cases',
+            default=None,
+            help='Case to run, all of them by default; may be repeated'),
+        make_option('--seed',
+            action='store',
+            type='int',
+            dest='seed',
+            default=0,
+            help='Seed of the random generator'),
+        make_option('--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='Write the JSON results to that file instead of the standard output'),
+        make_option('--keep',
+            action='store_true',
+            dest='keep',
+            default=False,
+            help='Keep the generated users and messages'),
+        )
+
+    def handle(self, *args, **options):
+        cases = options['cases']
+        unknown = set(cases or ()) - set(Benchmark.cases)
+        if unknown:
+            raise CommandError('Unknown cases: %s' % ', '.join(sorted(unknown)))
+        population = Population(
+            users=options['users'],
+            bots=options['bots'],
+            bot_share=options['bot_share'],
+            conversations=options['conversations'],
+            max_thread_length=options['max_thread_length'],
+            seed=options['seed'],
+        )
+        if population.get_users().exists():
+            raise CommandError('A benchmark population already exists, delete the users '
+                'whose username starts with "%s" first' % population.prefix)
+        population.generate()
+        try:
+            results = Benchmark(population, repeat=options['repeat'], seed=options['seed']).run(cases)
+        finally:
+            if not options['keep']:
+                population.delete()
+
+        output = simplejson.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output + '\n')
@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+
+from django_messages import counters
+from django_messages.models import Message
+
+
+class Command(BaseCommand):
+    """Repair the cached unread counts that drifted from the database"""
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of users checked at once'),
+        make_option('--dry-run',
+            action='store_true',
+            dest='dryrun',
+            default=False,
+            help='Count the number of drifted counts without repairing them'),
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dryrun = options['dryrun']
+
+        users = User.objects.values_list('pk', flat=True).order_by('pk')
+        checked = drifted = 0
+        last = 0
+        while True:
+            user_ids = list(users.filter(pk__gt=last)[:batch_size])
+            if not user_ids:
+                break
+            last = user_ids[-1]
+            checked += len(user_ids)
+
+            cached = counters.get_inbox_counts(user_ids)
+            if not cached:
+                continue
+            # a replica lagging behind would cache wrong counts
+            counts = Message.objects.db_manager(Message.objects.write_db).unread_counts(cached.keys())
+            wrong = dict(
+                (user_id, count) for user_id, count in counts.items()
+                if cached[user_id] != count
+            )
+            drifted += len(wrong)
+            if wrong and not dryrun:
+                counters.set_inbox_counts(wrong)
+
+        self.stdout.write('Checked %d users, %d unread counts drifted\n' % (checked, drifted))
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from django_messages import search
+from django_messages.models import Message
+
+
+class Command(BaseCommand):
+    """Rebuild the full-text search index of the messages"""
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of messages indexed at once'),
+        make_option('--clear',
+            action='store_true',
+            dest='clear',
+            default=False,
+            help='Empty the index first, dropping the rows of deleted messages'),
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options['verbosity'])
+        backend = search.get_backend(Message.objects.write_db)
+
+        if options['clear']:
+            with transaction.commit_on_success(using=Message.objects.write_db):
+                backend.clear()
+        # only one batch of messages is in memory at a time
+        messages = Message.objects.only('id', 'subject', 'body').order_by('id')
+        total = 0
+        last = 0
+        while True:
+            batch = list(messages.filter(pk__gt=last)[:batch_size])
+            if not batch:
+                break
+            with transaction.commit_on_success(using=Message.objects.write_db):
+                backend.index(batch)
+            total += len(batch)
+            last = batch[-1].pk
+            if verbosity > 1:
+                self.stdout.write('Indexed %d messages\n' % total)
+        self.stdout.write('Total count of messages indexed: %d\n' % total)
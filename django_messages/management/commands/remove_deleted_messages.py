@@ -1,12 +1,120 @@
 # -*- coding:utf-8 -*-
+import gzip
+import os
+import zlib
+from cStringIO import StringIO
 from datetime import datetime
 from optparse import make_option
-from time import time
+from time import time, sleep
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.deletion import Collector
+from django.utils import simplejson
 
-from django_messages.models import Message
+from django_messages import counters, search
+from django_messages.models import Message, ConversationParticipant
+
+
+class MessageArchive(object):
+    """
+    Appends messages as JSON lines to a gzip file, each batch as a gzip
+    member of its own. A member is complete, trailer included, and synced
+    to disk before ``write`` returns, so it is safe to delete the archived
+    rows afterwards.
+
+    A run killed while appending a batch leaves an incomplete member at the
+    end of the file, whose messages were not deleted. It is cut off when the
+    archive is opened again, so that the members appended next can still be
+    read.
+    """
+    fields = [field.attname for field in Message._meta.fields]
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.truncated = 0
+        self.file = open(path, 'ab+')
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        complete = complete_length(path)
+        if complete < size:
+            self.file.truncate(complete)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.truncated = size - complete
+
+    def write(self, messages):
+        """
+        Appends ``messages`` as one gzip member, synced to disk, and returns
+        the ids read back from it.
+        """
+        buffer = StringIO()
+        member = gzip.GzipFile(fileobj=buffer, mode='wb')
+        for message in messages:
+            row = dict((field, getattr(message, field)) for field in self.fields)
+            for field, value in row.items():
+                if isinstance(value, datetime):
+                    row[field] = value.isoformat()
+            member.write(simplejson.dumps(row) + '\n')
+        # writes the trailer of the member
+        member.close()
+        data = buffer.getvalue()
+
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.file.seek(offset)
+        member = gzip.GzipFile(fileobj=StringIO(self.file.read(len(data))), mode='rb')
+        ids = [simplejson.loads(line)['id'] for line in member]
+        self.count += len(ids)
+        return ids
+
+    def close(self):
+        self.file.close()
+
+
+def complete_length(path, chunk_size=64 * 1024):
+    """
+    Returns the length of the complete gzip members at the start of a file,
+    whose checksums are verified by zlib.
+    """
+    archive = open(path, 'rb')
+    try:
+        complete = 0
+        position = 0
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = ''
+        while True:
+            data = data or archive.read(chunk_size)
+            at_end = not data
+            if at_end:
+                # a complete member leaves this byte unused
+                data = '\0'
+            try:
+                decompressor.decompress(data)
+            except zlib.error:
+                break
+            if not decompressor.unused_data:
+                if at_end:
+                    break
+                position += len(data)
+                data = ''
+                continue
+            position += len(data) - len(decompressor.unused_data)
+            complete = position
+            if at_end:
+                break
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return complete
+    finally:
+        archive.close()
 
 
 class Command(BaseCommand):
@@ -19,6 +127,29 @@ class Command(BaseCommand):
             dest='dryrun',
             default=False,
             help='Count the number of messages that would be deleted without actually doing it'),
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of messages deleted in each transaction'),
+        make_option('--sleep',
+            action='store',
+            type='float',
+            dest='sleep',
+            default=0,
+            help='Seconds to wait between two batches'),
+        make_option('--archive',
+            action='store',
+            dest='archive',
+            default=None,
+            help='Append the deleted messages to that gzipped JSON lines file before deleting them'),
+        make_option('--max-time',
+            action='store',
+            type='float',
+            dest='max_time',
+            default=None,
+            help='Stop after the batch running when that many seconds elapsed'),
         )
 
     def handle(self, *args, **options):
@@ -34,4 +165,116 @@ class Command(BaseCommand):
             count = query.count()
             print 'Total count of messages to be deleted: %d' % count
         else:
-            query.delete()
+            self.archive = None
+            if options['archive']:
+                self.archive = MessageArchive(options['archive'])
+                if self.archive.truncated:
+                    self.stdout.write('Removed %d bytes of an interrupted batch from %s\n' % (
+                        self.archive.truncated, self.archive.path))
+            try:
+                self.purge(query, options)
+            finally:
+                if self.archive is not None:
+                    self.archive.close()
+            if self.archive is not None and int(options['verbosity']) > 0:
+                self.stdout.write('Total count of messages archived to %s: %d\n' % (
+                    self.archive.path, self.archive.count))
+
+    def purge(self, query, options):
+        """
+        Deletes the messages of ``query`` by batches of decreasing ids, each
+        one in its own transaction, so that replies are deleted before the
+        messages they reply to. An interrupted purge keeps the batches
+        already deleted and the next run carries on with the rest.
+        """
+        batch_size = options['batch_size']
+        max_time = options['max_time']
+        verbosity = int(options['verbosity'])
+        started = time()
+        deleted = kept = batches = 0
+        last = None
+        query = query.order_by('-pk').values_list('pk', 'conversation')
+        while True:
+            batch = query
+            if last is not None:
+                batch = query.filter(pk__lt=last)
+            rows = list(batch[:batch_size])
+            if not rows:
+                break
+            last = rows[-1][0]
+            with transaction.commit_on_success(using=Message.objects.write_db):
+                ids, users = self.delete_batch(rows)
+            counters.bump_mailbox_versions(users)
+            deleted += len(ids)
+            kept += len(rows) - len(ids)
+            batches += 1
+            if verbosity > 1:
+                self.stdout.write('Deleted %d messages, down to id %d\n' % (deleted, last))
+            if max_time is not None and time() - started >= max_time:
+                self.stdout.write('Time budget spent, stopping after id %d\n' % last)
+                break
+            if options['sleep']:
+                sleep(options['sleep'])
+        if verbosity > 0:
+            self.stdout.write('Total count of messages deleted: %d in %d batches\n' % (
+                deleted, batches))
+            if kept:
+                self.stdout.write('Kept %d messages having replies not deleted yet\n' % kept)
+
+    def blocked(self, ids, db):
+        """
+        Returns the ids, among ``ids``, of the messages that have a reply or,
+        for the first message of a conversation, another message that isn't
+        in ``ids`` or is blocked itself. Deleting them would delete those
+        messages in cascade.
+        """
+        blocked = set()
+        ancestors = {}
+        dependants = Message.objects.using(db).filter(
+            Q(parent_msg__in=ids) | Q(conversation__in=ids)
+        ).values_list('pk', 'parent_msg', 'conversation')
+        for pk, parent_id, conversation_id in dependants:
+            for ancestor in (set([parent_id, conversation_id]) & ids) - set([pk]):
+                if pk in ids:
+                    ancestors.setdefault(pk, set()).add(ancestor)
+                else:
+                    blocked.add(ancestor)
+        # replies come after the messages they reply to, their own
+        # dependants are known by the time they are reached
+        for pk in sorted(ancestors, reverse=True):
+            if pk in blocked:
+                blocked.update(ancestors[pk])
+        return blocked
+
+    def delete_batch(self, rows):
+        """
+        Deletes the messages of ``rows`` but those that would delete other
+        messages in cascade, and returns the ids of the deleted messages and
+        of the users whose summary rows changed.
+        """
+        db = Message.objects.write_db
+        ids = set(pk for pk, conversation_id in rows)
+        ids -= self.blocked(ids, db)
+        if not ids:
+            return [], set()
+        conversations = set(
+            conversation_id or pk for pk, conversation_id in rows if pk in ids
+        )
+        queryset = Message.objects.filter(pk__in=ids).using(db)
+        # same as queryset.delete(), but what is deleted in cascade is known
+        # beforehand, and the messages are deleted by decreasing ids
+        collector = Collector(using=queryset.db)
+        collector.collect(queryset)
+        doomed = sorted(collector.data.get(Message, ()), key=lambda message: message.pk)
+        if len(doomed) > len(ids):
+            # a reply was sent since the batch was checked
+            raise CommandError('Messages outside the batch would be deleted in cascade, batch rolled back')
+        ids = [message.pk for message in doomed]
+        if self.archive is not None:
+            if sorted(self.archive.write(doomed)) != ids:
+                raise CommandError('Could not archive every message, nothing deleted')
+        collector.delete()
+        if Message.objects.filter(pk__in=ids).using(db).exists():
+            raise CommandError('Some messages were not deleted, batch rolled back')
+        search.get_backend(db).unindex(ids)
+        return ids, ConversationParticipant.objects.db_manager(db).refresh(conversations)
@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.template import loader
+from django.utils.encoding import force_unicode
+
+from django_messages.models import QueuedEmail
+from django_messages.utils import message_email
+
+
+class Command(BaseCommand):
+    """Send the queued emails notifying users of new messages"""
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=100,
+            help='Number of emails read from the queue at once'),
+        make_option('--max-attempts',
+            action='store',
+            type='int',
+            dest='max_attempts',
+            default=5,
+            help='Number of attempts before an email is dropped'),
+        make_option('--retry-delay',
+            action='store',
+            type='int',
+            dest='retry_delay',
+            default=60,
+            help='Seconds before the first retry, doubled after each attempt'),
+        make_option('--claim-time',
+            action='store',
+            type='int',
+            dest='claim_time',
+            default=600,
+            help='Seconds an email is reserved by this run, after which another run may send it'),
+        make_option('--template',
+            action='store',
+            dest='template_name',
+            default='django_messages/new_message.html',
+            help='Template of the emails'),
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        max_attempts = options['max_attempts']
+        retry_delay = options['retry_delay']
+        claim_time = options['claim_time']
+
+        protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
+        site_url = '%s://%s' % (protocol, Site.objects.get_current().domain)
+        template = loader.get_template(options['template_name'])
+
+        now = datetime.now()
+        sent = failed = dropped = 0
+        connection = get_connection()
+        connection.open()
+        try:
+            last = 0
+            while True:
+                # every email is tried once per run, even if it is due again
+                batch = list(QueuedEmail.objects.due(now).filter(
+                    pk__gt=last,
+                ).order_by('pk')[:batch_size])
+                if not batch:
+                    break
+                last = batch[-1].pk
+                done = []
+                for queued in batch:
+                    # another run may have claimed it since it was read
+                    claimed_until = datetime.now() + timedelta(seconds=claim_time)
+                    if not QueuedEmail.objects.filter(
+                        pk=queued.pk,
+                        next_attempt_at=queued.next_attempt_at,
+                    ).update(next_attempt_at=claimed_until):
+                        continue
+                    queued.next_attempt_at = claimed_until
+                    message = queued.message
+                    if not message.recipient or not message.recipient.email:
+                        done.append(queued.pk)
+                        continue
+                    try:
+                        connection.send_messages([
+                            message_email(message, template, site_url),
+                        ])
+                    except Exception, e:
+                        queued.attempts += 1
+                        if queued.attempts >= max_attempts:
+                            queued.delete()
+                            dropped += 1
+                            continue
+                        delay = retry_delay * 2 ** (queued.attempts - 1)
+                        queued.next_attempt_at = now + timedelta(seconds=delay)
+                        queued.last_error = force_unicode(e, errors='replace')
+                        queued.save()
+                        failed += 1
+                    else:
+                        done.append(queued.pk)
+                        sent += 1
+                QueuedEmail.objects.filter(pk__in=done).delete()
+        finally:
+            connection.close()
+
+        self.stdout.write('Sent %d emails, %d failed and will be retried, %d dropped\n' % (
+            sent, failed, dropped))
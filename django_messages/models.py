@@ -1,18 +1,53 @@
 import datetime
 
-from django.db import models
+from django.db import connections, models, router, transaction, IntegrityError
 from django.conf import settings
-from django.db.models import signals, Max, Q
+from django.db.backends.util import typecast_timestamp
+from django.db.models import signals, Count, F, Max, Q
+from django.db.models.sql import InsertQuery
 from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
+from django.utils.text import Truncator
 from django.utils.translation import ugettext_lazy as _
 
+from django_messages import counters, cursors, search
+from django_messages.instrumentation import instrument
+from django_messages.signals import messages_sent
+
+# number of users or conversations handled by each query of the
+# ``*_counts_for`` functions and of ``mark_deleted``, below the limit of
+# query parameters of SQLite
+COUNT_CHUNK_SIZE = getattr(settings, 'DJANGO_MESSAGES_COUNT_CHUNK_SIZE', 500)
+
+# the columns of a message and of its users shown in the listings, where
+# the body and everything but the usernames is left out
+LIST_FIELDS = (
+    'subject', 'snippet', 'sender__username', 'recipient__username',
+    'parent_msg', 'conversation', 'sent_at', 'read_at', 'replied_at',
+    'sender_deleted_at', 'recipient_deleted_at',
+)
+SNIPPET_LENGTH = 100
+
+def make_snippet(body):
+    """returns the beginning of a body on a single line, for the listings"""
+    return Truncator(u' '.join(body.split())).chars(SNIPPET_LENGTH)
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), COUNT_CHUNK_SIZE):
+        yield values[i:i + COUNT_CHUNK_SIZE]
+
 class MessageManager(models.Manager):
 
     @property
     def related(self):
         return self.select_related('recipient', 'sender')
 
+    @property
+    def write_db(self):
+        """the database written to, ``db`` being the one read from"""
+        return self._db or router.db_for_write(self.model)
+
     @property
     def _conversations(self):
         """
@@ -29,40 +64,172 @@ class MessageManager(models.Manager):
             'conversation'
         )
 
-    def inbox_for(self, user):
+    def inbox_for(self, user, cursor=None, per_page=None, annotate=False):
         """
-        Return Inbox by filtering conversations containing messages
-        received by given user that were not deleted
+        Return Inbox, the latest message received by given user that was
+        not deleted in each conversation. Read from the
+        ``ConversationParticipant`` summary of the user.
+        If ``per_page`` is given, returns the ``CursorPage`` designated by
+        ``cursor`` instead of every message.
+        If ``annotate`` is True, the messages are annotated by
+        ``annotate_conversations``, and a list is returned instead of a
+        queryset.
         """
-        return self.related.filter(
-            id__in=self._conversations.filter(
-                recipient=user, 
-                recipient_deleted_at__isnull=True
+        if per_page is not None:
+            page = ConversationParticipant.objects.page_for(
+                user, 'inbox_message', cursor, per_page
             )
-        )
+            if annotate:
+                self.annotate_conversations(user, page.object_list)
+            return page
+        messages = self.related.filter(inbox_participants__user=user)
+        if annotate:
+            return self.annotate_conversations(user, messages)
+        return messages
+    inbox_for = instrument('manager.inbox_for')(inbox_for)
 
-    def outbox_for(self, user):
+    def outbox_for(self, user, cursor=None, per_page=None, annotate=False):
         """
-        Return Outbox by filtering conversations containing messages 
-        sent by given user that were not deleted
+        Return Outbox, the latest message sent by given user that was not
+        deleted in each conversation. Read from the
+        ``ConversationParticipant`` summary of the user.
+        If ``per_page`` is given, returns the ``CursorPage`` designated by
+        ``cursor`` instead of every message.
+        If ``annotate`` is True, the messages are annotated by
+        ``annotate_conversations``, and a list is returned instead of a
+        queryset.
         """
-        return self.related.filter(
-            id__in=self._conversations.filter(
-                sender=user,
-                sender_deleted_at__isnull=True,
+        if per_page is not None:
+            page = ConversationParticipant.objects.page_for(
+                user, 'outbox_message', cursor, per_page
+            )
+            if annotate:
+                self.annotate_conversations(user, page.object_list)
+            return page
+        messages = self.related.filter(outbox_participants__user=user)
+        if annotate:
+            return self.annotate_conversations(user, messages)
+        return messages
+    outbox_for = instrument('manager.outbox_for')(outbox_for)
+
+    def trash_for(self, user, cursor=None, per_page=None, annotate=False):
+        """
+        Return Trash, the latest message sent or received by given user
+        that was deleted in each conversation. Read from the
+        ``ConversationParticipant`` summary of the user.
+        If ``per_page`` is given, returns the ``CursorPage`` designated by
+        ``cursor`` instead of every message.
+        If ``annotate`` is True, the messages are annotated by
+        ``annotate_conversations``, and a list is returned instead of a
+        queryset.
+        """
+        if per_page is not None:
+            page = ConversationParticipant.objects.page_for(
+                user, 'trash_message', cursor, per_page
             )
+            if annotate:
+                self.annotate_conversations(user, page.object_list)
+            return page
+        messages = self.related.filter(trash_participants__user=user)
+        if annotate:
+            return self.annotate_conversations(user, messages)
+        return messages
+    trash_for = instrument('manager.trash_for')(trash_for)
+
+    def send(self, sender, recipients, subject, body, parent_msg=None):
+        """
+        Sends a message to each of the recipients and returns the list of the
+        created messages, in the order of the recipients, each recipient
+        counted once. The messages are inserted at once where the database
+        gives their ids back, see ``_insert_with_ids``, each one starting a
+        new conversation unless it replies to ``parent_msg``.
+        ``post_save`` is not sent for those messages but ``messages_sent``
+        is, once for all of them.
+        """
+        now = datetime.datetime.now()
+        conversation_id = None
+        if parent_msg is not None:
+            conversation_id = parent_msg.conversation_id or parent_msg.pk
+        seen = set()
+        recipients = [recipient for recipient in recipients
+            if recipient.pk not in seen and not seen.add(recipient.pk)]
+        messages = [
+            Message(
+                sender=sender,
+                recipient=recipient,
+                subject=subject,
+                body=body,
+                snippet=make_snippet(body),
+                parent_msg=parent_msg,
+                conversation_id=conversation_id,
+                sent_at=now,
+            ) for recipient in recipients
+        ]
+        db = self.write_db
+        with transaction.commit_on_success(using=db):
+            if parent_msg is not None:
+                # only replied_at is written, a concurrent change of the
+                # parent is not overwritten
+                self.filter(pk=parent_msg.pk).update(replied_at=now)
+                parent_msg.replied_at = now
+            self._insert_with_ids(messages, db)
+            if conversation_id is None:
+                self.filter(
+                    pk__in=[message.pk for message in messages]
+                ).update(conversation=F('id'))
+                for message in messages:
+                    message.conversation_id = message.pk
+            ConversationParticipant.objects.record_many(messages)
+            search.get_backend(db).index(messages)
+        for message in messages:
+            counters.incr_inbox_count(message.recipient_id)
+        # bumped once committed, so that a version is never seen before
+        # the changes it stands for
+        counters.bump_mailbox_versions(
+            [sender.pk] + [message.recipient_id for message in messages]
         )
+        messages_sent.send(sender=Message, messages=messages)
+        return messages
+    send = instrument('manager.send')(send)
 
-    def trash_for(self, user):
+    def _insert_with_ids(self, messages, db):
         """
-        Return Trash by filtering conversations containing messages 
-        sent by given user that were deleted
+        Inserts the messages and sets their ids. PostgreSQL and SQLite insert
+        them by multi-row INSERTs: PostgreSQL returns the ids, and SQLite gives
+        the consecutive rowids of each statement, up to the last one. Other
+        databases insert each message on its own to learn its id, the
+        auto-increment ids of a MySQL statement not being consecutive with
+        ``innodb_autoinc_lock_mode = 2``.
         """
-        q1 = Q(sender=user, sender_deleted_at__isnull=False)
-        q2 = Q(recipient=user, recipient_deleted_at__isnull=False)
-        ids = self._conversations.filter(q1 | q2)
-        return self.related.filter(id__in=ids)
-        
+        connection = connections[db]
+        opts = self.model._meta
+        fields = [f for f in opts.local_fields if not isinstance(f, models.AutoField)]
+        if len(messages) == 1 or connection.vendor not in ('postgresql', 'sqlite'):
+            for message in messages:
+                message.pk = self._insert([message], fields=fields, return_id=True, using=db)
+            return
+        batch_size = max(connection.ops.bulk_batch_size(fields, messages), 1)
+        cursor = connection.cursor()
+        for start in range(0, len(messages), batch_size):
+            batch = messages[start:start + batch_size]
+            query = InsertQuery(self.model)
+            query.insert_values(fields, batch)
+            compiler = query.get_compiler(using=db)
+            compiler.return_id = False
+            [(statement, params)] = compiler.as_sql()
+            if connection.vendor == 'postgresql':
+                # the ids come back in the order of the rows
+                cursor.execute('%s RETURNING %s' % (
+                    statement, connection.ops.quote_name(opts.pk.column)), params)
+                ids = [row[0] for row in cursor.fetchall()]
+            else:
+                cursor.execute(statement, params)
+                last = connection.ops.last_insert_id(cursor, opts.db_table, opts.pk.column)
+                ids = range(last - len(batch) + 1, last + 1)
+            for message, pk in zip(batch, ids):
+                message.pk = pk
+        transaction.set_dirty(using=db)
+
     def get_conversation(self, conversation):
         """
         Returns a specific conversation. We don't filter by user here,
@@ -72,7 +239,118 @@ class MessageManager(models.Manager):
         return self.related.filter(
             conversation=conversation
         ).order_by('sent_at')
-        
+    get_conversation = instrument('manager.get_conversation')(get_conversation)
+
+    def search_for(self, user, query, cursor=None, per_page=None):
+        """
+        Returns the messages sent or received by the given user, and not
+        deleted by them, whose subject or body contain every word of the
+        query, newest first.
+        If ``per_page`` is given, returns the ``CursorPage`` designated by
+        ``cursor`` instead of every message.
+        """
+        queryset = self.related.filter(
+            Q(sender=user, sender_deleted_at__isnull=True) |
+            Q(recipient=user, recipient_deleted_at__isnull=True)
+        )
+        queryset = search.get_backend(self.db).filter(queryset, query)
+        if per_page is not None:
+            return cursors.paginate_by_id(queryset.only(*LIST_FIELDS), cursor, per_page)
+        return queryset.order_by('-id')
+    search_for = instrument('manager.search_for')(search_for)
+
+    def unread(self):
+        """
+        Returns the messages their recipient has not read yet, that is sent
+        after the read cursor of the recipient in their conversation.
+        """
+        return self.get_query_set().extra(where=[
+            '%(message)s.id > COALESCE((SELECT p.last_read_id'
+            ' FROM %(participant)s p'
+            ' WHERE p.user_id = %(message)s.recipient_id'
+            ' AND p.conversation_id = COALESCE(%(message)s.conversation_id, %(message)s.id)'
+            '), 0)' % {
+                'message': self.model._meta.db_table,
+                'participant': ConversationParticipant._meta.db_table,
+            }
+        ])
+
+    def unread_counts(self, user_ids):
+        """
+        Returns a dict of the number of unread messages of each of the given
+        users, counted by one grouped query per ``COUNT_CHUNK_SIZE`` users.
+        """
+        counts = dict.fromkeys(user_ids, 0)
+        for chunk in _chunks(counts):
+            counts.update(self.unread().filter(
+                recipient__in=chunk,
+                recipient_deleted_at__isnull=True,
+            ).values_list('recipient').annotate(Count('id')).order_by())
+        return counts
+
+    def annotate_conversations(self, user, messages):
+        """
+        Sets on each of the given messages the ``message_count`` and the
+        ``last_activity`` of its conversation and the ``unread_count`` of the
+        messages of the conversation the user has not read yet, all computed
+        by one grouped query per ``COUNT_CHUNK_SIZE`` conversations. Returns
+        the list of the messages.
+        """
+        messages = list(messages)
+        user_id = getattr(user, 'pk', user)
+        connection = connections[self.db]
+        counts = {}
+        for chunk in _chunks(set(m.conversation_id or m.pk for m in messages)):
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT m.conversation_id, COUNT(m.id), MAX(m.sent_at),'
+                ' SUM(CASE WHEN m.recipient_id = %%s'
+                ' AND m.recipient_deleted_at IS NULL'
+                ' AND m.id > COALESCE(p.last_read_id, 0) THEN 1 ELSE 0 END)'
+                ' FROM %(message)s m LEFT OUTER JOIN %(participant)s p'
+                ' ON p.conversation_id = m.conversation_id AND p.user_id = %%s'
+                ' WHERE m.conversation_id IN (%(conversations)s)'
+                ' GROUP BY m.conversation_id' % {
+                    'message': self.model._meta.db_table,
+                    'participant': ConversationParticipant._meta.db_table,
+                    'conversations': ', '.join(['%s'] * len(chunk)),
+                },
+                [user_id, user_id] + chunk
+            )
+            for conversation_id, total, last_activity, unread in cursor.fetchall():
+                # SQLite returns the aggregated dates as strings
+                if isinstance(last_activity, basestring):
+                    last_activity = typecast_timestamp(last_activity)
+                counts[conversation_id] = (total, last_activity, unread)
+        for message in messages:
+            message.message_count, message.last_activity, message.unread_count = \
+                counts.get(message.conversation_id or message.pk, (0, None, 0))
+        return messages
+
+    def get_conversation_page(self, conversation, before=None, per_page=50):
+        """
+        Returns a ``CursorPage`` of the ``per_page`` latest messages of a
+        conversation, sent before the message of id ``before`` if given,
+        in sending order. Its ``next_cursor`` is the ``before`` of the page
+        of older messages.
+        """
+        page = cursors.paginate_by_id(
+            self.related.filter(conversation=conversation), before, per_page
+        )
+        page.object_list.reverse()
+        return page
+    get_conversation_page = instrument('manager.get_conversation_page')(get_conversation_page)
+
+    def get_last_message(self, conversation):
+        """
+        Returns the latest message of a conversation, or None.
+        """
+        messages = self.related.filter(conversation=conversation).order_by('-id')[:1]
+        for message in messages:
+            return message
+        return None
+    get_last_message = instrument('manager.get_last_message')(get_last_message)
+
     def get_conversations(self, conversations):
         """
         Returns specific conversations. We don't filter by user here,
@@ -82,6 +360,68 @@ class MessageManager(models.Manager):
         return self.related.filter(
             conversation__in=conversations
         ).order_by('sent_at')
+    get_conversations = instrument('manager.get_conversations')(get_conversations)
+
+    def _set_deleted(self, user, conversations, deleted_at):
+        """
+        Sets the deletion date of the messages of the given conversations
+        on the side of the user, sender or recipient, if they aren't
+        already in that state. The conditional expressions set both sides
+        in a single UPDATE per ``COUNT_CHUNK_SIZE`` conversations.
+        """
+        user_id = getattr(user, 'pk', user)
+        conversations = set(int(getattr(c, 'pk', c)) for c in conversations)
+        db = self.write_db
+        connection = connections[db]
+        state = deleted_at is None and 'IS NOT NULL' or 'IS NULL'
+        deleted_at = connection.ops.value_to_db_datetime(deleted_at)
+        changed = 0
+        for chunk in _chunks(conversations):
+            sql = (
+                'UPDATE %(message)s SET'
+                ' recipient_deleted_at = CASE WHEN recipient_id = %%s'
+                ' AND recipient_deleted_at %(state)s'
+                ' THEN %%s ELSE recipient_deleted_at END,'
+                ' sender_deleted_at = CASE WHEN sender_id = %%s'
+                ' AND sender_deleted_at %(state)s'
+                ' THEN %%s ELSE sender_deleted_at END'
+                ' WHERE conversation_id IN (%(conversations)s)'
+                ' AND ((recipient_id = %%s AND recipient_deleted_at %(state)s)'
+                ' OR (sender_id = %%s AND sender_deleted_at %(state)s))' % {
+                    'message': self.model._meta.db_table,
+                    'state': state,
+                    'conversations': ', '.join(['%s'] * len(chunk)),
+                }
+            )
+            params = [user_id, deleted_at, user_id, deleted_at] + chunk + [user_id, user_id]
+            with transaction.commit_on_success(using=db):
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+                transaction.set_dirty(using=db)
+                if cursor.rowcount:
+                    # the summary rows are committed along with the messages
+                    ConversationParticipant.objects.db_manager(db).refresh(chunk)
+            changed += cursor.rowcount
+        if changed:
+            counters.invalidate_inbox_counts([user_id])
+        return changed
+
+    def mark_deleted(self, user, conversations):
+        """
+        Moves the given conversations, or conversation ids, to the trash of
+        the user and returns the number of messages deleted. Messages the
+        user already deleted keep their deletion date.
+        """
+        return self._set_deleted(user, conversations, datetime.datetime.now())
+    mark_deleted = instrument('manager.mark_deleted')(mark_deleted)
+
+    def mark_undeleted(self, user, conversations):
+        """
+        Recovers the given conversations, or conversation ids, from the
+        trash of the user and returns the number of messages recovered.
+        """
+        return self._set_deleted(user, conversations, None)
+    mark_undeleted = instrument('manager.mark_undeleted')(mark_undeleted)
 
 
 class Message(models.Model):
@@ -90,6 +430,7 @@ class Message(models.Model):
     """
     subject = models.CharField(_("Subject"), max_length=120)
     body = models.TextField(_("Body"))
+    snippet = models.CharField(_("Snippet"), max_length=SNIPPET_LENGTH, blank=True, editable=False)
     sender = models.ForeignKey(User, related_name='sent_messages', null=True, verbose_name=_("Sender"))
     recipient = models.ForeignKey(User, related_name='received_messages', null=True, verbose_name=_("Recipient"))
     parent_msg = models.ForeignKey('self', related_name='next_messages', null=True, blank=True, verbose_name=_("Parent message"))
@@ -101,9 +442,11 @@ class Message(models.Model):
     recipient_deleted_at = models.DateTimeField(_("Recipient deleted at"), null=True, blank=True)
     
     objects = MessageManager()
-    
+
     def new(self):
         """returns whether the recipient has read the message or not"""
+        if getattr(self, 'read_cursor', None) is not None:
+            return self.pk > self.read_cursor
         if self.read_at is not None:
             return False
         return True
@@ -116,6 +459,11 @@ class Message(models.Model):
     
     def __unicode__(self):
         return self.subject
+
+    def __eq__(self, other):
+        # the listings load messages of a deferred subclass of Message,
+        # equal to the complete ones in Django 1.7 and later
+        return isinstance(other, Message) and self._get_pk_val() == other._get_pk_val()
     
     def get_absolute_url(self):
         conversation_id = self.conversation_id or self.pk
@@ -125,6 +473,7 @@ class Message(models.Model):
     def save(self, **kwargs):
         if not self.id:
             self.sent_at = datetime.datetime.now()
+        self.snippet = make_snippet(self.body)
         super(Message, self).save(**kwargs)
     
     class Meta:
@@ -132,14 +481,480 @@ class Message(models.Model):
         verbose_name = _("Message")
         verbose_name_plural = _("Messages")
         
+
+class ConversationParticipantManager(models.Manager):
+
+    @property
+    def write_db(self):
+        """the database written to, ``db`` being the one read from"""
+        return self._db or router.db_for_write(self.model)
+
+    def _upsert(self, user_id, conversation_id, **values):
+        db = self.write_db
+        rows = self.using(db).filter(user=user_id, conversation=conversation_id)
+        for field in ('inbox_message', 'outbox_message'):
+            if field in values:
+                # leaves alone a row already pointing to a later message,
+                # committed before this one
+                rows = rows.exclude(**{'%s__gte' % field: values[field].pk})
+        if rows.update(**values):
+            return
+        try:
+            sid = transaction.savepoint(using=db)
+            self.using(db).create(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                **values
+            )
+            transaction.savepoint_commit(sid, using=db)
+        except IntegrityError:
+            # the row was inserted meanwhile, by refresh for instance
+            transaction.savepoint_rollback(sid, using=db)
+            rows.update(**values)
+
+    def box_counts(self, user_ids, box):
+        """
+        Returns a dict of the number of conversations of each of the given
+        users having a message in ``box``, counted by one grouped query per
+        ``COUNT_CHUNK_SIZE`` users.
+        """
+        counts = dict.fromkeys(user_ids, 0)
+        for chunk in _chunks(counts):
+            # exclude() tests the column, __isnull=False would join
+            counts.update(self.filter(user__in=chunk).exclude(**{
+                box: None,
+            }).values_list('user').annotate(Count('id')).order_by())
+        return counts
+
+    def page_for(self, user, box, cursor, per_page):
+        """
+        Returns a ``CursorPage`` of the latest message of the conversations
+        of the user having one in ``box``, the name of one of the
+        ``inbox_message``, ``outbox_message`` and ``trash_message`` fields.
+        Only the ``LIST_FIELDS`` of the messages are loaded.
+        """
+        queryset = self.filter(
+            user=user,
+            **{'%s__isnull' % box: False}
+        ).select_related('%s__sender' % box, '%s__recipient' % box).only(
+            'conversation', 'last_activity', 'last_read_id', box,
+            *['%s__%s' % (box, field) for field in LIST_FIELDS]
+        )
+        return cursors.paginate(
+            queryset, cursor, per_page, 
+            lambda participant: participant.get_message(box)
+        )
+
+    def mark_read(self, user, conversation, message):
+        """
+        Moves the read cursor of the user in the conversation up to the
+        given message, in a single row update that does nothing when the
+        user already read it. Returns the number of messages received by the
+        user, and not deleted by them, this marked read: the number to take
+        off their unread count. The ``read_at`` of the messages is set for
+        compatibility, deleted ones included.
+        """
+        conversation = getattr(conversation, 'pk', conversation)
+        moved = self.filter(
+            user=user,
+            conversation=conversation,
+            last_read_id__lt=message.pk,
+        ).update(last_read_id=message.pk, unread=False)
+        if not moved:
+            return 0
+        counters.bump_mailbox_versions([getattr(user, 'pk', user)])
+        messages = Message.objects.filter(
+            conversation=conversation,
+            recipient=user,
+            pk__lte=message.pk,
+            read_at__isnull=True,
+        )
+        now = datetime.datetime.now()
+        # deleted messages are not in the unread count
+        read = messages.filter(recipient_deleted_at__isnull=True).update(read_at=now)
+        messages.update(read_at=now)
+        return read
+
+    def mark_all_read(self, user, up_to=None, batch_size=1000):
+        """
+        Marks read every conversation of the user, or only the messages up
+        to the message of id ``up_to``, by batches of ``batch_size`` summary
+        rows each updated in its own transaction. Returns the number of
+        messages received by the user this marked read, whose ``read_at``
+        is set for compatibility.
+        """
+        user_id = getattr(user, 'pk', user)
+        rows = self.filter(user=user_id, unread=True).order_by('pk')
+        if up_to is not None:
+            rows = rows.filter(last_read_id__lt=up_to)
+        now = datetime.datetime.now()
+        read = 0
+        changed = False
+        last = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last).values_list('pk', 'conversation')[:batch_size])
+            if not batch:
+                break
+            last = batch[-1][0]
+            ids = [pk for pk, conversation_id in batch]
+            messages = Message.objects.filter(
+                conversation__in=[conversation_id for pk, conversation_id in batch],
+                recipient=user_id,
+                read_at__isnull=True,
+            )
+            with transaction.commit_on_success(using=self.write_db):
+                if up_to is None:
+                    self.filter(pk__in=ids).update(
+                        last_read_id=F('inbox_message'), unread=False)
+                else:
+                    self.filter(pk__in=ids, inbox_message__lte=up_to).update(
+                        last_read_id=F('inbox_message'), unread=False)
+                    # newer messages of those conversations stay unread
+                    self.filter(pk__in=ids, inbox_message__gt=up_to).update(
+                        last_read_id=up_to)
+                    messages = messages.filter(pk__lte=up_to)
+                read += messages.update(read_at=now)
+            changed = True
+        if changed:
+            counters.invalidate_inbox_counts([user_id])
+            counters.bump_mailbox_versions([user_id])
+        return read
+    mark_all_read = instrument('manager.mark_all_read')(mark_all_read)
+
+    def empty_trash(self, user, batch_size=1000):
+        """
+        Empties the trash of the user by batches of ``batch_size`` summary
+        rows, each updated in its own transaction, and returns the number of
+        conversations removed from it. The messages stay in the database
+        until they are purged; only their ids up to the latest deleted one
+        are remembered so that they don't come back to the trash.
+        """
+        user_id = getattr(user, 'pk', user)
+        # exclude() tests the column, __isnull=False would join
+        rows = self.filter(user=user_id).exclude(trash_message=None).order_by('pk')
+        emptied = 0
+        last = 0
+        while True:
+            ids = list(rows.filter(pk__gt=last).values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            last = ids[-1]
+            with transaction.commit_on_success(using=self.write_db):
+                emptied += self.filter(pk__in=ids).update(
+                    trash_cleared_id=F('trash_message'), trash_message=None)
+        if emptied:
+            counters.bump_mailbox_versions([user_id])
+        return emptied
+    empty_trash = instrument('manager.empty_trash')(empty_trash)
+
+    def record(self, message):
+        """
+        Updates the summary rows of the sender and the recipient of a newly
+        created message without reading the conversation back.
+        """
+        if message.sender_deleted_at or message.recipient_deleted_at:
+            return self.refresh([message.conversation_id or message.pk])
+        conversation_id = message.conversation_id or message.pk
+        sender_values = {
+            'outbox_message': message,
+            'last_activity': message.sent_at,
+            'deleted_at': None,
+        }
+        recipient_values = {
+            'inbox_message': message,
+            'last_activity': message.sent_at,
+            'deleted_at': None,
+        }
+        if message.read_at is None:
+            recipient_values['unread'] = True
+        if message.sender_id == message.recipient_id:
+            sender_values.update(recipient_values)
+        elif message.recipient_id is not None:
+            self._upsert(message.recipient_id, conversation_id, **recipient_values)
+        if message.sender_id is not None:
+            self._upsert(message.sender_id, conversation_id, **sender_values)
+        counters.bump_mailbox_versions(
+            [user_id for user_id in (message.sender_id, message.recipient_id) if user_id]
+        )
+
+    def record_many(self, messages):
+        """
+        Same as ``record`` for several messages. The summary rows of
+        messages starting new conversations are inserted at once.
+        """
+        participants = []
+        for message in messages:
+            if message.conversation_id != message.pk:
+                self.record(message)
+                continue
+            participants.append(ConversationParticipant(
+                user_id=message.sender_id,
+                conversation_id=message.pk,
+                outbox_message_id=message.pk,
+                last_activity=message.sent_at,
+            ))
+            if message.recipient_id == message.sender_id:
+                participants[-1].inbox_message_id = message.pk
+                participants[-1].unread = True
+            else:
+                participants.append(ConversationParticipant(
+                    user_id=message.recipient_id,
+                    conversation_id=message.pk,
+                    inbox_message_id=message.pk,
+                    last_activity=message.sent_at,
+                    unread=True,
+                ))
+        self.bulk_create(participants)
+
+    def refresh(self, conversations):
+        """
+        Recomputes from the ``Message`` table the summary rows of the
+        participants of the given conversations, in one transaction holding
+        a lock on their rows. Returns the ids of the participants.
+        """
+        conversations = set(int(getattr(c, 'pk', c)) for c in conversations)
+        if not conversations:
+            return set()
+        db = self.write_db
+        with transaction.commit_on_success(using=db):
+            users = self._refresh(conversations, db)
+        counters.bump_mailbox_versions(users)
+        return users
+
+    def _refresh(self, conversations, db):
+        read_cursors = {}
+        trash_cursors = {}
+        # the locks make mark_read and _upsert wait for the new rows
+        for user_id, conversation_id, last_read_id, trash_cleared_id in self.using(db).select_for_update().filter(
+            conversation__in=conversations,
+        ).values_list('user', 'conversation', 'last_read_id', 'trash_cleared_id'):
+            read_cursors[user_id, conversation_id] = last_read_id
+            trash_cursors[user_id, conversation_id] = trash_cleared_id
+        messages = Message.objects.using(db).select_for_update().filter(
+            Q(conversation__in=conversations) | Q(pk__in=conversations)
+        ).order_by('id').values_list(
+            'id', 'conversation', 'sender', 'recipient', 'sent_at',
+            'read_at', 'sender_deleted_at', 'recipient_deleted_at',
+        )
+        summaries = {}
+        deletions = {}
+        for (pk, conversation_id, sender_id, recipient_id, sent_at, read_at,
+                sender_deleted_at, recipient_deleted_at) in messages:
+            conversation_id = conversation_id or pk
+            if conversation_id not in conversations:
+                continue
+            sides = (
+                (sender_id, 'outbox_message_id', sender_deleted_at),
+                (recipient_id, 'inbox_message_id', recipient_deleted_at),
+            )
+            for user_id, field, deleted_at in sides:
+                if user_id is None:
+                    continue
+                key = (user_id, conversation_id)
+                if key not in summaries:
+                    summaries[key] = ConversationParticipant(
+                        user_id=user_id,
+                        conversation_id=conversation_id,
+                        last_read_id=read_cursors.get(key, 0),
+                        trash_cleared_id=trash_cursors.get(key, 0),
+                    )
+                summary = summaries[key]
+                # messages are iterated by id, the latest one wins
+                summary.last_activity = sent_at
+                if deleted_at is not None:
+                    # messages deleted before the trash was emptied stay
+                    # out of it
+                    if pk > summary.trash_cleared_id:
+                        summary.trash_message_id = pk
+                    deletions.setdefault(key, []).append(deleted_at)
+                    continue
+                setattr(summary, field, pk)
+                # messages read before the cursor existed move it forward
+                if field == 'inbox_message_id' and read_at is not None:
+                    summary.last_read_id = max(summary.last_read_id, pk)
+        for key, summary in summaries.items():
+            summary.unread = (summary.inbox_message_id or 0) > summary.last_read_id
+            # the conversation is deleted once every message of the
+            # participant is
+            if summary.inbox_message_id is None and summary.outbox_message_id is None:
+                summary.deleted_at = max(deletions[key])
+        self.using(db).filter(conversation__in=conversations).delete()
+        self.using(db).bulk_create(summaries.values())
+        return set([user_id for user_id, conversation_id in summaries.keys() + read_cursors.keys()])
+
+
+class ConversationParticipant(models.Model):
+    """
+    Summary of a conversation for one of its participants, maintained
+    alongside ``Message`` so that the inbox, outbox and trash of a user
+    can be listed without grouping the whole ``Message`` table.
+    """
+    user = models.ForeignKey(User, related_name='message_conversations', verbose_name=_("User"))
+    conversation = models.ForeignKey(Message, related_name='participants', verbose_name=_("Conversation"))
+    inbox_message = models.ForeignKey(Message, related_name='inbox_participants', null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("Latest received message"))
+    outbox_message = models.ForeignKey(Message, related_name='outbox_participants', null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("Latest sent message"))
+    trash_message = models.ForeignKey(Message, related_name='trash_participants', null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_("Latest deleted message"))
+    last_activity = models.DateTimeField(_("last activity"), null=True, blank=True)
+    unread = models.BooleanField(_("unread"), default=False)
+    last_read_id = models.PositiveIntegerField(_("last read message id"), default=0)
+    trash_cleared_id = models.PositiveIntegerField(_("last cleared deleted message id"), default=0)
+    deleted_at = models.DateTimeField(_("deleted at"), null=True, blank=True)
+
+    objects = ConversationParticipantManager()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.user, self.conversation_id)
+
+    def get_message(self, box):
+        """
+        Returns the latest message of the conversation in ``box``, telling
+        it the read cursor of the user.
+        """
+        message = getattr(self, box)
+        if message is not None:
+            message.read_cursor = self.last_read_id
+        return message
+
+    class Meta:
+        unique_together = ('user', 'conversation')
+        ordering = ['-last_activity']
+        verbose_name = _("Conversation participant")
+        verbose_name_plural = _("Conversation participants")
+
+def update_participants(sender, instance, created, **kwargs):
+    """
+    Keeps ``ConversationParticipant`` in sync with saved messages.
+    """
+    if created:
+        ConversationParticipant.objects.record(instance)
+    else:
+        ConversationParticipant.objects.refresh([instance.conversation_id or instance.pk])
+signals.post_save.connect(update_participants, sender=Message)
+
+def update_search_index(sender, instance, using, **kwargs):
+    """
+    Indexes the subject and body of saved messages.
+    """
+    search.get_backend(using).index([instance])
+signals.post_save.connect(update_search_index, sender=Message)
+
 def inbox_count_for(user):
     """
     returns the number of unread messages for the given user but does not
-    mark them seen
+    mark them seen. The count is kept in the cache between calls, and read
+    from the primary database so that a lagging replica is never cached.
+    """
+    count = counters.get_inbox_count(user.pk)
+    if count is None:
+        manager = Message.objects.db_manager(Message.objects.write_db)
+        count = manager.unread().filter(recipient=user, recipient_deleted_at__isnull=True).count()
+        counters.set_inbox_count(user.pk, count)
+    return count
+
+def inbox_counts_for(users):
+    """
+    returns a dict of the number of unread messages of each of the given
+    users or user ids, by user id. Only the counts missing from the cache
+    are computed, by one query per ``COUNT_CHUNK_SIZE`` users on the primary
+    database.
+    """
+    user_ids = [getattr(user, 'pk', user) for user in users]
+    counts = counters.get_inbox_counts(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in counts]
+    if missing:
+        computed = Message.objects.db_manager(Message.objects.write_db).unread_counts(missing)
+        counters.set_inbox_counts(computed)
+        counts.update(computed)
+    return counts
+
+def outbox_counts_for(users):
+    """
+    returns a dict of the number of conversations in the outbox of each of
+    the given users or user ids, by user id.
+    """
+    return ConversationParticipant.objects.box_counts(
+        [getattr(user, 'pk', user) for user in users], 'outbox_message')
+
+def trash_counts_for(users):
+    """
+    returns a dict of the number of conversations in the trash of each of
+    the given users or user ids, by user id.
     """
-    return Message.objects.filter(recipient=user, read_at__isnull=True, recipient_deleted_at__isnull=True).count()
+    return ConversationParticipant.objects.box_counts(
+        [getattr(user, 'pk', user) for user in users], 'trash_message')
+
+def update_inbox_count(sender, instance, created, **kwargs):
+    """
+    Counts a new unread message in the cached unread count of its
+    recipient. Any other change to a message may change the count, which is
+    then dropped from the cache.
+    """
+    if instance.recipient_id is None:
+        return
+    if not created:
+        counters.invalidate_inbox_counts([instance.recipient_id])
+    elif instance.read_at is None and instance.recipient_deleted_at is None:
+        counters.incr_inbox_count(instance.recipient_id)
+signals.post_save.connect(update_inbox_count, sender=Message)
+
+class QueuedEmailManager(models.Manager):
+
+    def enqueue(self, messages):
+        """
+        Queues the emails notifying the recipients of the given messages.
+        """
+        now = datetime.datetime.now()
+        self.bulk_create([
+            QueuedEmail(message=message, created_at=now, next_attempt_at=now)
+            for message in messages
+        ])
+
+    def due(self, now=None):
+        """
+        Returns the queued emails that should be sent by now, with their
+        message and its recipient.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        return self.filter(
+            next_attempt_at__lte=now,
+        ).select_related('message__sender', 'message__recipient')
+
+
+class QueuedEmail(models.Model):
+    """
+    An email notifying the recipient of a message, waiting to be sent by
+    the ``send_message_emails`` command.
+    """
+    message = models.ForeignKey(Message, related_name='queued_emails', verbose_name=_("Message"))
+    created_at = models.DateTimeField(_("created at"))
+    next_attempt_at = models.DateTimeField(_("next attempt at"), db_index=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+
+    objects = QueuedEmailManager()
+
+    def __unicode__(self):
+        return unicode(self.message)
+
+    class Meta:
+        ordering = ['next_attempt_at']
+        verbose_name = _("Queued email")
+        verbose_name_plural = _("Queued emails")
+
+def queue_message_email(sender, instance, created, **kwargs):
+    if created:
+        QueuedEmail.objects.enqueue([instance])
+
+def queue_messages_email(sender, messages, **kwargs):
+    QueuedEmail.objects.enqueue(messages)
 
 # fallback for email notification if django-notification could not be found
 if "notification" not in settings.INSTALLED_APPS:
-    from django_messages.utils import new_message_email
-    signals.post_save.connect(new_message_email, sender=Message)
+    if getattr(settings, 'DJANGO_MESSAGES_QUEUE_EMAILS', True):
+        signals.post_save.connect(queue_message_email, sender=Message)
+        messages_sent.connect(queue_messages_email, sender=Message)
+    else:
+        from django_messages.utils import new_message_email, new_messages_email
+        signals.post_save.connect(new_message_email, sender=Message)
+        messages_sent.connect(new_messages_email, sender=Message)
@@ -0,0 +1,115 @@
+"""
+Waiting for changes to a mailbox, for the ``messages_api_wait`` long-poll and
+server-sent events view.
+
+A mailbox changes whenever its version is bumped by
+``counters.bump_mailbox_versions``, which sends the ``mailbox_changed``
+signal. The broker of ``DJANGO_MESSAGES_PUSH_BROKER`` blocks a request
+until the version of a mailbox differs from the one the client knows:
+
+* ``django_messages.push.CacheBroker`` (the default) reads the version from
+  the cache every ``DJANGO_MESSAGES_PUSH_INTERVAL`` seconds, so it sees the
+  changes made by every process sharing the cache;
+* ``django_messages.push.LocalBroker`` also wakes up as soon as the change
+  is published by the same process, which suits a single threaded server
+  and the tests.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from django_messages import counters
+from django_messages.signals import mailbox_changed
+
+PUSH_INTERVAL = getattr(settings, 'DJANGO_MESSAGES_PUSH_INTERVAL', 1)
+
+_brokers = {}
+
+
+def get_broker():
+    """returns the broker of the ``DJANGO_MESSAGES_PUSH_BROKER`` setting"""
+    path = getattr(settings, 'DJANGO_MESSAGES_PUSH_BROKER',
+        'django_messages.push.CacheBroker')
+    if path not in _brokers:
+        module, name = path.rsplit('.', 1)
+        _brokers.clear()
+        _brokers[path] = getattr(import_module(module), name)()
+    return _brokers[path]
+
+def publish(sender, user_ids, version, **kwargs):
+    get_broker().publish(user_ids, version)
+mailbox_changed.connect(publish, dispatch_uid='django_messages.push.publish')
+
+def event_stream(user_id, version, timeout, broker=None):
+    """
+    Yields a server-sent event each time the mailbox of the user changes,
+    during ``timeout`` seconds. The version is the id of the event, so that
+    a reconnecting client sends it back as ``Last-Event-ID``.
+    """
+    broker = broker or get_broker()
+    deadline = time.time() + timeout
+    # tells the client to reconnect right away once the stream ends
+    yield 'retry: 0\n\n'
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        current = broker.wait(user_id, version, remaining)
+        if current != version:
+            version = current
+            yield 'id: %r\nevent: mailbox\ndata: %s\n\n' % (version,
+                simplejson.dumps({'version': '%r' % version}))
+
+
+class CacheBroker(object):
+    """
+    Polls the version of the mailbox in the cache.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval or PUSH_INTERVAL
+
+    def publish(self, user_ids, version):
+        # the new version is already in the cache
+        pass
+
+    def pause(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, user_id, version, timeout):
+        """
+        Returns the version of the mailbox of the user as soon as it is not
+        ``version`` anymore, or after ``timeout`` seconds.
+        """
+        deadline = time.time() + timeout
+        current = counters.get_mailbox_version(user_id)
+        while current == version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.pause(min(self.interval, remaining))
+            current = counters.get_mailbox_version(user_id)
+        return current
+
+
+class LocalBroker(CacheBroker):
+    """
+    Wakes up the waiting threads of this process whenever a mailbox
+    changes, and still polls the cache for the changes made elsewhere.
+    """
+    condition = threading.Condition()
+
+    def publish(self, user_ids, version):
+        with self.condition:
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        self.condition.wait(seconds)
+
+    def wait(self, user_id, version, timeout):
+        # the lock is held from reading the version to waiting, so that no
+        # change is published in between
+        with self.condition:
+            return super(LocalBroker, self).wait(user_id, version, timeout)
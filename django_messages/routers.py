@@ -0,0 +1,130 @@
+"""
+Routing of the reads of django-messages to read replicas.
+
+``ReplicaRouter`` sends the reads of the models of django-messages to one
+of the databases of ``DJANGO_MESSAGES_REPLICA_DATABASES``, picked at
+random once per request, and their writes to
+``DJANGO_MESSAGES_PRIMARY_DATABASE`` (``'default'`` by default). Once a
+thread wrote to the primary, its reads stay on the primary so that it reads
+its own writes. This state is cleared when a request starts; code running
+outside of requests, such as a task worker, should call ``reset()`` between
+its units of work.
+
+``ReplicaMiddleware`` carries this over to the next requests of the user:
+for ``DJANGO_MESSAGES_REPLICA_STICKY_TIMEOUT`` seconds after a request of a
+user wrote messages, for instance to send, reply to or delete them, the
+reads of their requests go to the primary, so that they never miss their
+own changes while the replicas catch up.
+"""
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS
+
+_local = threading.local()
+
+
+def get_primary():
+    return getattr(settings, 'DJANGO_MESSAGES_PRIMARY_DATABASE', DEFAULT_DB_ALIAS)
+
+def get_replicas():
+    return tuple(getattr(settings, 'DJANGO_MESSAGES_REPLICA_DATABASES', ()))
+
+def pin_primary():
+    """sends the next reads of the current thread to the primary"""
+    _local.pinned = True
+
+def is_pinned():
+    return getattr(_local, 'pinned', False)
+
+def has_written():
+    """returns whether the current thread wrote to the primary"""
+    return getattr(_local, 'written', False)
+
+def get_replica():
+    """returns the replica read by the current thread, picked at random"""
+    replica = getattr(_local, 'replica', None)
+    replicas = get_replicas()
+    if replica not in replicas:
+        replica = _local.replica = random.choice(replicas)
+    return replica
+
+def reset():
+    """lets the current thread read from the replicas again"""
+    _local.pinned = _local.written = False
+    _local.replica = None
+
+def reset_on_request(sender, **kwargs):
+    reset()
+request_started.connect(reset_on_request, dispatch_uid='django_messages.routers.reset')
+
+def sticky_key(user_id):
+    return 'django_messages:sticky:%s' % user_id
+
+def stick_user(user_id):
+    """sends the reads of the requests of the user to the primary for a while"""
+    cache.set(sticky_key(user_id), True,
+        getattr(settings, 'DJANGO_MESSAGES_REPLICA_STICKY_TIMEOUT', 10))
+
+def is_sticky(user_id):
+    return cache.get(sticky_key(user_id), False)
+
+
+class ReplicaRouter(object):
+
+    def routes(self, model):
+        return model._meta.app_label == 'django_messages'
+
+    def db_for_read(self, model, **hints):
+        if not self.routes(model):
+            return None
+        if not get_replicas() or is_pinned():
+            return get_primary()
+        return get_replica()
+
+    def db_for_write(self, model, **hints):
+        if not self.routes(model):
+            return None
+        _local.pinned = _local.written = True
+        return get_primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        if self.routes(obj1.__class__) or self.routes(obj2.__class__):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        # the replicas get their tables from the primary
+        if self.routes(model) and db in get_replicas():
+            return False
+        return None
+
+
+class ReplicaMiddleware(object):
+    """
+    Sends the reads of the requests of the users who recently wrote to the
+    primary. Must come after ``AuthenticationMiddleware``.
+    """
+    def get_user_id(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            return user.pk
+        return None
+
+    def process_request(self, request):
+        reset()
+        user_id = self.get_user_id(request)
+        if user_id is not None and is_sticky(user_id):
+            pin_primary()
+
+    def process_response(self, request, response):
+        if has_written():
+            user_id = self.get_user_id(request)
+            if user_id is not None:
+                stick_user(user_id)
+        reset()
+        return response
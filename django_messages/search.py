@@ -0,0 +1,173 @@
+"""
+Full-text search over the subject and body of messages.
+
+The words of each message are indexed in the ``django_messages_search``
+table, created by ``syncdb`` from the custom SQL of the app: a FTS5 virtual
+table on SQLite, a ``tsvector`` column with a GIN index on PostgreSQL.
+Other databases have no index and are searched with ``icontains``, and so
+are those where the table could not be created.
+
+Messages are indexed when saved or sent, and unindexed when purged by the
+``remove_deleted_messages`` command. Rows left by messages deleted
+otherwise never match, since searches only return existing messages. The
+``reindex_messages`` command rebuilds the whole index.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.db.models import Q
+
+SEARCH_TABLE = 'django_messages_search'
+
+# the text search configuration used by PostgreSQL
+SEARCH_CONFIG = getattr(settings, 'DJANGO_MESSAGES_SEARCH_CONFIG', 'english')
+
+
+def split_query(query):
+    """
+    Returns the words of a query, leaving out the punctuation that the
+    search syntax of the databases would interpret.
+    """
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+class SimpleSearchBackend(object):
+    """
+    Searches without an index, for the databases not supported below.
+    """
+    def __init__(self, using):
+        self.using = using
+
+    def is_available(self):
+        return True
+
+    def index(self, messages):
+        pass
+
+    def unindex(self, ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def filter(self, queryset, query):
+        for word in split_query(query):
+            queryset = queryset.filter(
+                Q(subject__icontains=word) | Q(body__icontains=word)
+            )
+        return queryset
+
+    def execute(self, sql, params_list):
+        cursor = connections[self.using].cursor()
+        if params_list:
+            cursor.executemany(sql, params_list)
+
+
+class SQLiteSearchBackend(SimpleSearchBackend):
+    """
+    Searches the FTS5 table, whose rowid is the id of the message.
+    """
+    def is_available(self):
+        # fails when the table is missing or SQLite was built without FTS5
+        try:
+            connections[self.using].cursor().execute(
+                'SELECT rowid FROM %s LIMIT 0' % SEARCH_TABLE)
+        except DatabaseError:
+            return False
+        return True
+
+    def index(self, messages):
+        self.unindex([message.pk for message in messages])
+        self.execute(
+            'INSERT INTO %s (rowid, subject, body) VALUES (%%s, %%s, %%s)' % SEARCH_TABLE,
+            [(message.pk, message.subject, message.body) for message in messages]
+        )
+
+    def unindex(self, ids):
+        self.execute(
+            'DELETE FROM %s WHERE rowid = %%s' % SEARCH_TABLE,
+            [(pk,) for pk in ids]
+        )
+
+    def clear(self):
+        connections[self.using].cursor().execute('DELETE FROM %s' % SEARCH_TABLE)
+
+    def filter(self, queryset, query):
+        words = split_query(query)
+        if not words:
+            return queryset.none()
+        # every word is quoted, they must all appear in the message
+        match = ' '.join('"%s"' % word for word in words)
+        return queryset.extra(
+            where=['%s.id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                queryset.model._meta.db_table, SEARCH_TABLE, SEARCH_TABLE,
+            )],
+            params=[match],
+        )
+
+
+class PostgreSQLSearchBackend(SimpleSearchBackend):
+    """
+    Searches the ``tsvector`` of each message, words of the subject
+    weighting more than the ones of the body.
+    """
+    def is_available(self):
+        # a failed query would abort the transaction, the table is looked up
+        return SEARCH_TABLE in connections[self.using].introspection.table_names()
+
+    def index(self, messages):
+        self.unindex([message.pk for message in messages])
+        self.execute(
+            'INSERT INTO %s (message_id, document) VALUES (%%s, '
+            'setweight(to_tsvector(%%s, %%s), \'A\') || to_tsvector(%%s, %%s))' % SEARCH_TABLE,
+            [
+                (message.pk, SEARCH_CONFIG, message.subject, SEARCH_CONFIG, message.body)
+                for message in messages
+            ]
+        )
+
+    def unindex(self, ids):
+        self.execute(
+            'DELETE FROM %s WHERE message_id = %%s' % SEARCH_TABLE,
+            [(pk,) for pk in ids]
+        )
+
+    def clear(self):
+        connections[self.using].cursor().execute('TRUNCATE %s' % SEARCH_TABLE)
+
+    def filter(self, queryset, query):
+        words = split_query(query)
+        if not words:
+            return queryset.none()
+        return queryset.extra(
+            where=['%s.id IN (SELECT message_id FROM %s '
+                   'WHERE document @@ plainto_tsquery(%%s, %%s))' % (
+                queryset.model._meta.db_table, SEARCH_TABLE,
+            )],
+            params=[SEARCH_CONFIG, ' '.join(words)],
+        )
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+_backends = {}
+
+def get_backend(using='default'):
+    """
+    Returns the search backend of the given database. A database without
+    the ``django_messages_search`` table, for instance because its SQLite
+    lacks FTS5, is searched without an index. This is checked once per
+    process and database.
+    """
+    connection = connections[using]
+    key = (using, connection.settings_dict['NAME'])
+    if key not in _backends:
+        backend = BACKENDS.get(connection.vendor, SimpleSearchBackend)(using)
+        if not backend.is_available():
+            backend = SimpleSearchBackend(using)
+        _backends[key] = backend
+    return _backends[key]
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+# Sent by ``MessageManager.send`` with the list of ``messages`` it created
+# at once. Those messages are inserted without ``save()``, so ``post_save``
+# is not sent for them.
+messages_sent = Signal(providing_args=['messages'])
+
+# Sent by ``counters.bump_mailbox_versions`` with the ids of the users whose
+# mailbox changed and their new ``version``, once it is in the cache.
+mailbox_changed = Signal(providing_args=['user_ids', 'version'])
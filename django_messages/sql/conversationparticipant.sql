@@ -0,0 +1,2 @@
+-- Listings page through the conversations of a user by last activity
+CREATE INDEX django_messages_conversationparticipant_activity ON django_messages_conversationparticipant (user_id, last_activity, conversation_id);
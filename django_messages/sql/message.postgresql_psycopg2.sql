@@ -0,0 +1,3 @@
+-- Full-text index of the messages, see django_messages.search
+CREATE TABLE django_messages_search (message_id integer PRIMARY KEY, document tsvector NOT NULL);
+CREATE INDEX django_messages_search_document ON django_messages_search USING gin (document);
@@ -0,0 +1,2 @@
+-- Full-text index of the messages, see django_messages.search
+CREATE VIRTUAL TABLE django_messages_search USING fts5(subject, body);
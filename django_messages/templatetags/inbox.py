@@ -1,14 +1,21 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.template import Library, Node, TemplateSyntaxError
+from django.utils import timezone, translation
+
+from django_messages.models import inbox_count_for, inbox_counts_for
+
+ROW_CACHE_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_ROW_CACHE_TIMEOUT', 60 * 60 * 24)
 
 class InboxOutput(Node):
     def __init__(self, varname=None):
         self.varname = varname
         
     def render(self, context):
-        try:
-            user = context['user']
-            count = user.received_messages.filter(read_at__isnull=True, recipient_deleted_at__isnull=True).count()
-        except (KeyError, AttributeError):
+        user = context.get('user')
+        if user is not None and user.is_authenticated():
+            count = inbox_count_for(user)
+        else:
             count = ''
         if self.varname is not None:
             context[self.varname] = count
@@ -41,5 +48,97 @@ def do_print_inbox_count(parser, token):
     else:
         return InboxOutput()
 
+class InboxCountsNode(Node):
+    def __init__(self, users, varname):
+        self.users = users
+        self.varname = varname
+
+    def render(self, context):
+        users = list(self.users.resolve(context) or [])
+        counts = inbox_counts_for(users)
+        context[self.varname] = [(user, counts[user.pk]) for user in users]
+        return ""
+
+def do_inbox_counts(parser, token):
+    """
+    A templatetag to show the unread-counts of a list of users, counted at
+    once. Assigns the list of ``(user, count)`` pairs to a variable.
+    Usage::
+
+        {% load inbox %}
+        {% inbox_counts users as user_counts %}
+        {% for user, count in user_counts %}
+            {{ user }}: {{ count }}
+        {% endfor %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) != 4 or bits[2] != 'as':
+        raise TemplateSyntaxError, "inbox_counts tag should be used as {% inbox_counts users as var %}"
+    return InboxCountsNode(parser.compile_filter(bits[1]), bits[3])
+
+def message_row_key(name, message):
+    """
+    Returns the cache key of the row of a message in a listing. The row
+    changes with the latest message of the conversation, its state, the
+    counts of the conversation if it was annotated and the language and
+    time zone it is rendered in.
+    """
+    key = 'django_messages:row:%s:%s:%s:%d%d:%s:%s:%s' % (
+        name,
+        message.conversation_id or message.pk,
+        message.pk,
+        message.new(),
+        message.replied(),
+        getattr(message, 'message_count', ''),
+        getattr(message, 'unread_count', ''),
+        translation.get_language(),
+    )
+    if settings.USE_TZ:
+        key += ':%s' % timezone.get_current_timezone_name()
+    return key
+
+class MessageRowNode(Node):
+    def __init__(self, nodelist, name, message):
+        self.nodelist = nodelist
+        self.name = name
+        self.message = message
+
+    def render(self, context):
+        key = message_row_key(
+            self.name.resolve(context), 
+            self.message.resolve(context),
+        )
+        output = cache.get(key)
+        if output is None:
+            output = self.nodelist.render(context)
+            cache.set(key, output, ROW_CACHE_TIMEOUT)
+        return output
+
+def do_message_row(parser, token):
+    """
+    A templatetag caching the row of a message in a listing, as long as it
+    is the latest message of its conversation and its state doesn't change.
+    ``name`` tells the listings apart.
+    Usage::
+
+        {% load inbox %}
+        {% for message in conversations %}
+            {% message_row "inbox" message %}
+                <tr>...</tr>
+            {% endmessage_row %}
+        {% endfor %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise TemplateSyntaxError, "message_row tag takes exactly two arguments"
+    nodelist = parser.parse(('endmessage_row',))
+    parser.delete_first_token()
+    return MessageRowNode(nodelist, parser.compile_filter(bits[1]), 
+        parser.compile_filter(bits[2]))
+
 register = Library()     
 register.tag('inbox_count', do_print_inbox_count)
+register.tag('inbox_counts', do_inbox_counts)
+register.tag('message_row', do_message_row)
@@ -4,4 +4,12 @@ from test_manager import *
 from test_fields import *
 from test_forms import *
 from test_command_remove_deleted_messages import *
+from test_command_backfill_participants import *
+from test_command_reconcile_inbox_counts import *
+from test_command_send_message_emails import *
+from test_command_reindex_messages import *
+from test_command_benchmark_messages import *
+from test_instrumentation import *
+from test_push import *
+from test_routers import *
 from test_views import *
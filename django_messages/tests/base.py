@@ -1,7 +1,9 @@
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
+from django_messages import autocomplete, blocking, routers
 from django_messages.models import Message
 
 
@@ -34,6 +36,14 @@ class BaseTestCase(TestCase):
        the user making debugging easier
     """
 
+    def _pre_setup(self):
+        super(BaseTestCase, self)._pre_setup()
+        # counters kept in the cache outlive the rollback of the database
+        cache.clear()
+        autocomplete.reset_username_index()
+        blocking.reset_blocking_status(None)
+        routers.reset()
+
     def skip_if_auth_not_installed(self):
         if not auth_installed:
             self.skipTest('Auth contrib application should be installed')
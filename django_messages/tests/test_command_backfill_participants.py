@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from django_messages.models import Message, ConversationParticipant
+
+from base import DjangoMessagesTestCase
+
+
+class TestBackfillParticipants(DjangoMessagesTestCase):
+
+    def call_backfill_participants_command(self, batch_size=500):
+        call_command('backfill_participants', batch_size=batch_size)
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', '123456')
+
+    def test_rebuild_missing_summaries(self):
+        """Conversations created before the summary table existed are
+        listed once the command ran"""
+        for i in range(3):
+            conversation = self.send_message(self.user1, self.user2)
+            conversation.conversation = conversation
+            conversation.save()
+            self.send_message(self.user2, self.user1, parent=conversation, conversation=conversation)
+        self.send_message(self.user1, self.user2)
+        ConversationParticipant.objects.all().delete()
+        self.assertEquals(Message.objects.inbox_for(self.user2).count(), 0)
+
+        self.call_backfill_participants_command(batch_size=2)
+
+        self.assertEquals(ConversationParticipant.objects.count(), 8)
+        self.assertEquals(Message.objects.inbox_for(self.user1).count(), 3)
+        self.assertEquals(Message.objects.inbox_for(self.user2).count(), 4)
+        self.assertEquals(Message.objects.outbox_for(self.user1).count(), 4)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db.models import F
+from django.utils import simplejson
+
+from django_messages.benchmark import Population, percentile
+from django_messages.models import Message, ConversationParticipant
+
+from base import DjangoMessagesTestCase
+
+
+class TestBenchmarkMessages(DjangoMessagesTestCase):
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.skip_if_auth_urls_not_installed()
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 95), 95)
+        self.assertEquals(percentile([3], 95), 3)
+        self.assertIsNone(percentile([], 50))
+
+    def test_population(self):
+        population = Population(users=5, bots=1, conversations=12, max_thread_length=4).generate()
+        self.assertEquals(User.objects.count(), 6)
+        self.assertEquals(Message.objects.filter(conversation=F('id')).count(), 12)
+        self.assertEquals(Message.objects.count(), population.messages)
+        self.assertTrue(ConversationParticipant.objects.exists())
+
+        population.delete()
+        self.assertEquals(User.objects.count(), 0)
+        self.assertEquals(Message.objects.count(), 0)
+
+    def test_command(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('benchmark_messages', users=5, conversations=10, repeat=2, output=path)
+            with open(path) as f:
+                results = simplejson.load(f)
+        finally:
+            os.remove(path)
+        self.assertEquals(results['population']['conversations'], 10)
+        for case in ('inbox_for', 'inbox_count_for', 'view', 'delete'):
+            self.assertTrue(results['results'][case]['queries'] > 0)
+            self.assertTrue(results['results'][case]['p95_ms'] >= results['results'][case]['p50_ms'])
+        self.assertEquals(User.objects.count(), 0)
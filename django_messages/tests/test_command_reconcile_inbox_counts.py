@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.core.management import call_command
+
+from django_messages import counters
+from django_messages.models import inbox_count_for
+
+from base import DjangoMessagesTestCase
+
+
+class TestReconcileInboxCounts(DjangoMessagesTestCase):
+
+    def call_reconcile_inbox_counts_command(self, dryrun=False):
+        call_command('reconcile_inbox_counts', dryrun=dryrun, batch_size=1)
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', '123456')
+        self.send_message(self.user1, self.user2)
+        self.send_message(self.user1, self.user2)
+
+    def test_repair_drifted_count(self):
+        counters.set_inbox_count(self.user1.pk, 3)
+        counters.set_inbox_count(self.user2.pk, 1)
+        self.call_reconcile_inbox_counts_command()
+        self.assertEquals(inbox_count_for(self.user1), 0)
+        self.assertEquals(inbox_count_for(self.user2), 2)
+
+    def test_dont_cache_missing_count(self):
+        self.call_reconcile_inbox_counts_command()
+        self.assertIsNone(counters.get_inbox_count(self.user1.pk))
+
+    def test_dryrun(self):
+        counters.set_inbox_count(self.user2.pk, 1)
+        self.call_reconcile_inbox_counts_command(dryrun=True)
+        self.assertEquals(inbox_count_for(self.user2), 1)
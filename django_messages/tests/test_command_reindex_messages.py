@@ -0,0 +1,44 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+
+from django_messages import search
+from django_messages.models import Message
+
+from base import DjangoMessagesTestCase
+
+
+class TestReindexMessages(DjangoMessagesTestCase):
+
+    def call_reindex_messages_command(self, batch_size=1000, clear=False):
+        call_command('reindex_messages', batch_size=batch_size, clear=clear, verbosity=0)
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', '123456')
+
+    def test_reindex(self):
+        for i in range(5):
+            Message.objects.send(self.user1, [self.user2], 'Holidays', 'Body')
+        search.get_backend().clear()
+        self.assertEquals(Message.objects.search_for(self.user2, 'holidays').count(), 0)
+
+        self.call_reindex_messages_command(batch_size=2)
+
+        self.assertEquals(Message.objects.search_for(self.user2, 'holidays').count(), 5)
+
+    def test_purged_messages_are_unindexed(self):
+        message = Message.objects.send(self.user1, [self.user2], 'Holidays', 'Body')[0]
+        Message.objects.filter(pk=message.pk).update(
+            sender_deleted_at=datetime(2000, 1, 1),
+            recipient_deleted_at=datetime(2000, 1, 1),
+        )
+        call_command('remove_deleted_messages', verbosity=0)
+
+        if connection.vendor == 'sqlite':
+            cursor = connection.cursor()
+            cursor.execute('SELECT COUNT(*) FROM %s' % search.SEARCH_TABLE)
+            self.assertEquals(cursor.fetchone()[0], 0)
@@ -1,19 +1,37 @@
 import datetime
+import gzip
+import os
+import tempfile
 from time import time
 
 from django.contrib.auth.models import User
 from django.core.management import call_command
 from django.conf import settings
+from django.utils import simplejson
 
-from django_messages.models import Message
+from django_messages.models import Message, ConversationParticipant
+from django_messages.management.commands.remove_deleted_messages import Command, MessageArchive
 
 from base import BaseTestCase
 
 
 class TestCleanDeletedMessages(BaseTestCase):
 
-    def call_clean_deleted_messages_command(self, dryrun=False):
-        call_command('remove_deleted_messages', dryrun=dryrun)
+    def call_clean_deleted_messages_command(self, dryrun=False, **options):
+        call_command('remove_deleted_messages', dryrun=dryrun, verbosity=0, **options)
+
+    def create_deleted_messages(self, count):
+        settings.DELETED_MESSAGE_MAX_AGE = 999
+        deleted_at = time() - settings.DELETED_MESSAGE_MAX_AGE
+        deleted_at = datetime.datetime.fromtimestamp(deleted_at)
+        for i in range(count):
+            Message(
+                sender=self.user1,
+                recipient=self.user2,
+                subject='Subject Text %d' % i,
+                body='Body Text %d' % i,
+                recipient_deleted_at=deleted_at,
+                sender_deleted_at=deleted_at).save()
 
     def setUp(self):
         self.skip_if_auth_not_installed()
@@ -131,3 +149,123 @@ class TestCleanDeletedMessages(BaseTestCase):
             sender_deleted_at=sender_deleted_at).save()
         self.call_clean_deleted_messages_command(dryrun=True)
         self.assertEquals(Message.objects.all().count(), 1)
+
+    def test_delete_messages_in_batches(self):
+        self.create_deleted_messages(5)
+        Message(sender=self.user1, recipient=self.user2, subject='Kept', body='Kept').save()
+        self.call_clean_deleted_messages_command(batch_size=2)
+        self.assertEquals(list(Message.objects.values_list('subject', flat=True)), ['Kept'])
+
+    def test_stop_when_time_budget_is_spent(self):
+        """The purge stops after the first batch and the next run carries on"""
+        self.create_deleted_messages(3)
+        self.call_clean_deleted_messages_command(batch_size=2, max_time=0)
+        self.assertEquals(Message.objects.all().count(), 1)
+        self.call_clean_deleted_messages_command(batch_size=2, max_time=0)
+        self.assertEquals(Message.objects.all().count(), 0)
+
+    def test_refresh_trash_of_deleted_conversations(self):
+        self.create_deleted_messages(1)
+        self.assertEquals(Message.objects.trash_for(self.user1).count(), 1)
+        self.call_clean_deleted_messages_command()
+        self.assertEquals(Message.objects.trash_for(self.user1).count(), 0)
+        self.assertFalse(ConversationParticipant.objects.exists())
+
+    def test_archive_before_delete(self):
+        """Deleted messages are appended to the archive"""
+        self.create_deleted_messages(3)
+        handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        try:
+            self.call_clean_deleted_messages_command(batch_size=2, archive=path)
+            archive = gzip.open(path)
+            rows = [simplejson.loads(line) for line in archive]
+            archive.close()
+        finally:
+            os.remove(path)
+        self.assertEquals(Message.objects.all().count(), 0)
+        self.assertEquals(sorted(row['subject'] for row in rows),
+            ['Subject Text %d' % i for i in range(3)])
+        self.assertEquals(set(row['sender_id'] for row in rows), set([self.user1.pk]))
+        self.assertEquals(set(row['recipient_id'] for row in rows), set([self.user2.pk]))
+
+    def test_keep_messages_with_replies_not_deleted(self):
+        """A message whose replies are not all deleted is kept, and so are
+        the messages it replies to"""
+        self.create_deleted_messages(2)
+        root = Message.objects.order_by('pk')[0]
+        deleted_at = root.sender_deleted_at
+        reply = Message(sender=self.user2, recipient=self.user1, subject='Reply',
+            body='Reply', parent_msg=root, conversation=root,
+            sender_deleted_at=deleted_at, recipient_deleted_at=deleted_at)
+        reply.save()
+        kept = Message(sender=self.user1, recipient=self.user2, subject='Kept',
+            body='Kept', parent_msg=reply, conversation=root)
+        kept.save()
+        self.call_clean_deleted_messages_command(batch_size=1)
+        self.assertEquals(sorted(Message.objects.values_list('pk', flat=True)),
+            [root.pk, reply.pk, kept.pk])
+
+    def test_rollback_batch_deleting_other_messages(self):
+        """A reply sent after the batch was checked is not deleted in
+        cascade"""
+        self.create_deleted_messages(1)
+        root = Message.objects.get()
+        Message(sender=self.user2, recipient=self.user1, subject='Reply',
+            body='Reply', parent_msg=root, conversation=root).save()
+        blocked = Command.blocked
+        # the reply is not seen by the check, as if it was sent meanwhile
+        Command.blocked = lambda self, ids, db: set()
+        try:
+            # call_command exits on a CommandError
+            self.assertRaises(SystemExit, self.call_clean_deleted_messages_command)
+        finally:
+            Command.blocked = blocked
+        self.assertEquals(Message.objects.count(), 2)
+
+    def test_delete_replies_before_their_conversation(self):
+        """A conversation spread over several batches is deleted from its
+        latest message on"""
+        self.create_deleted_messages(1)
+        root = Message.objects.get()
+        deleted_at = root.sender_deleted_at
+        parent = root
+        for i in range(3):
+            parent = Message(sender=self.user2, recipient=self.user1, subject='Reply',
+                body='Reply', parent_msg=parent, conversation=root,
+                sender_deleted_at=deleted_at, recipient_deleted_at=deleted_at)
+            parent.save()
+        self.call_clean_deleted_messages_command(batch_size=1, max_time=0)
+        self.assertEquals(Message.objects.count(), 3)
+        self.assertFalse(Message.objects.filter(pk=parent.pk).exists())
+        self.call_clean_deleted_messages_command(batch_size=1)
+        self.assertEquals(Message.objects.count(), 0)
+
+    def test_archive_resumes_after_interrupted_batch(self):
+        """A batch cut short while appended to the archive is removed from
+        it by the next run, and every batch is then readable"""
+        self.create_deleted_messages(3)
+        handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        try:
+            self.call_clean_deleted_messages_command(batch_size=1, archive=path, max_time=0)
+            self.assertEquals(Message.objects.all().count(), 2)
+            # the run is killed while appending its second batch
+            complete = os.path.getsize(path)
+            archive = MessageArchive(path)
+            archive.write(Message.objects.order_by('pk')[:1])
+            archive.close()
+            archive = open(path, 'rb+')
+            archive.truncate(complete + (os.path.getsize(path) - complete) / 2)
+            archive.close()
+            self.assertRaises(Exception, lambda: list(gzip.open(path)))
+
+            self.call_clean_deleted_messages_command(batch_size=1, archive=path)
+            archive = gzip.open(path)
+            rows = [simplejson.loads(line) for line in archive]
+            archive.close()
+        finally:
+            os.remove(path)
+        self.assertEquals(Message.objects.all().count(), 0)
+        self.assertEquals(len(rows), 3)
+        self.assertEquals(len(set(row['id'] for row in rows)), 3)
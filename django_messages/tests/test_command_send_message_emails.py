@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.conf import settings
+
+from django_messages.models import QueuedEmail
+
+from base import DjangoMessagesTestCase
+
+
+class FailingBackend(BaseEmailBackend):
+
+    def send_messages(self, messages):
+        raise IOError('SMTP server unavailable')
+
+
+class UndecodableErrorBackend(BaseEmailBackend):
+
+    def send_messages(self, messages):
+        raise IOError('\xe9chec de la connexion')
+
+
+class ConcurrentRunBackend(BaseEmailBackend):
+    """Sends the emails while another run claims those left"""
+
+    def send_messages(self, messages):
+        QueuedEmail.objects.filter(next_attempt_at__lte=datetime.now()).update(
+            next_attempt_at=datetime.now() + timedelta(seconds=600))
+        mail.outbox.extend(messages)
+        return len(messages)
+
+
+class TestSendMessageEmails(DjangoMessagesTestCase):
+
+    def call_send_message_emails_command(self, **options):
+        call_command('send_message_emails', **options)
+
+    def queue(self, messages):
+        """Only queues the emails of ``messages``, whatever sends
+        notifications in the project"""
+        QueuedEmail.objects.all().delete()
+        QueuedEmail.objects.enqueue(messages)
+        mail.outbox = []
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', '123456')
+        self.user3 = User.objects.create_user('user3', '', '123456')
+        self.email_backend = settings.EMAIL_BACKEND
+
+    def tearDown(self):
+        settings.EMAIL_BACKEND = self.email_backend
+
+    def test_send_queued_emails(self):
+        """Every queued email is sent and removed from the queue"""
+        messages = [self.send_message(self.user1, self.user2) for i in range(3)]
+        self.queue(messages)
+        self.call_send_message_emails_command(batch_size=2)
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertEquals(mail.outbox[0].to, ['user2@example.com'])
+        self.assertEquals(QueuedEmail.objects.count(), 0)
+
+    def test_skip_recipient_without_email(self):
+        message = self.send_message(self.user1, self.user3)
+        self.queue([message])
+        self.call_send_message_emails_command()
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(QueuedEmail.objects.count(), 0)
+
+    def test_retry_failed_email_later(self):
+        message = self.send_message(self.user1, self.user2)
+        self.queue([message])
+        settings.EMAIL_BACKEND = '%s.FailingBackend' % __name__
+        self.call_send_message_emails_command(retry_delay=60)
+        queued = QueuedEmail.objects.get()
+        self.assertEquals(queued.attempts, 1)
+        self.assertTrue(queued.next_attempt_at > datetime.now())
+        self.assertIn('SMTP server unavailable', queued.last_error)
+
+        # not due yet
+        settings.EMAIL_BACKEND = self.email_backend
+        self.call_send_message_emails_command()
+        self.assertEquals(len(mail.outbox), 0)
+
+    def test_drop_email_after_max_attempts(self):
+        message = self.send_message(self.user1, self.user2)
+        self.queue([message])
+        settings.EMAIL_BACKEND = '%s.FailingBackend' % __name__
+        self.call_send_message_emails_command(max_attempts=1)
+        self.assertEquals(QueuedEmail.objects.count(), 0)
+
+    def test_undecodable_error(self):
+        message = self.send_message(self.user1, self.user2)
+        self.queue([message])
+        settings.EMAIL_BACKEND = '%s.UndecodableErrorBackend' % __name__
+        self.call_send_message_emails_command()
+        self.assertIn(u'chec de la connexion', QueuedEmail.objects.get().last_error)
+
+    def test_skip_emails_claimed_by_another_run(self):
+        """An email claimed by another run since it was read is not sent"""
+        messages = [self.send_message(self.user1, self.user2) for i in range(3)]
+        self.queue(messages)
+        settings.EMAIL_BACKEND = '%s.ConcurrentRunBackend' % __name__
+        self.call_send_message_emails_command(batch_size=10)
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(QueuedEmail.objects.count(), 2)
+        self.assertEquals(QueuedEmail.objects.filter(attempts=0).count(), 2)
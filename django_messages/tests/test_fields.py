@@ -2,7 +2,8 @@ from collections import namedtuple
 
 from django import forms
 from django.contrib.auth.models import User
-from django_messages.fields import CommaSeparatedUserInput, BaseUserField
+from django_messages.fields import CommaSeparatedUserInput, CommaSeparatedUserField, \
+    BaseUserField, batch_recipient_filter
 
 from base import BaseTestCase
 
@@ -76,7 +77,44 @@ class CommaSeparatedUserInputTests(BaseTestCase):
 
 
 class CommaSeparatedUserFieldTests(BaseTestCase):
-    pass # Not used in current django_messages
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.users = [User.objects.create(username='user%d' % i) for i in range(4)]
+        self.value = ', '.join(user.username for user in self.users)
+
+    def test_users(self):
+        field = CommaSeparatedUserField()
+        self.assertEquals(set(self.users), set(field.clean(self.value)))
+
+    def test_recipient_filter_rejects_every_user(self):
+        """Rejected users are all reported, none is skipped"""
+        field = CommaSeparatedUserField(recipient_filter=lambda user: False)
+        with self.assertRaises(forms.ValidationError) as context_manager:
+            field.clean(self.value)
+        message = context_manager.exception.messages[0]
+        for user in self.users:
+            self.assertTrue(user.username in message)
+
+    def test_recipients_filter_called_once(self):
+        calls = []
+        def recipients_filter(users):
+            calls.append(users)
+            return set(user for user in users if user.username != 'user2')
+        field = CommaSeparatedUserField(recipients_filter=recipients_filter)
+        self.assertEquals(set(self.users) - set([self.users[2]]),
+            set(field.clean('user0, user1, user3')))
+        with self.assertRaises(forms.ValidationError) as context_manager:
+            field.clean(self.value)
+        self.assertEquals(
+            u'The following usernames are incorrect: user2',
+            context_manager.exception.messages[0])
+        self.assertEquals(len(calls), 2)
+
+    def test_batch_recipient_filter(self):
+        recipients_filter = batch_recipient_filter(lambda user: user.username != 'user1')
+        self.assertEquals(set(self.users) - set([self.users[1]]),
+            recipients_filter(self.users))
 
 
 class BaseUserFieldTests(BaseTestCase):
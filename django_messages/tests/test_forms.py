@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
 
 from django_messages.forms import ComposeForm
 # django-relationships should, be installed if you want to run the tests
@@ -55,6 +57,31 @@ class ComposeFormTests(BaseTestCase):
         expected_error_message = expected_error_message % {'recipient': self.user2}
         self.assertEquals(expected_error_message, errors[0])
 
+    def test_blocking_several_recipients_one_query(self):
+        """The blocklists of every recipient are read at once, then from the
+        cache until a relationship of theirs changes"""
+        blocking = RelationshipStatus.objects.get(from_slug='blocking')
+        user3 = User.objects.create(username="user 3")
+        data = {
+            'recipient': u'%s, %s' % (self.user2.username, user3.username),
+            'subject': 'this is not empty',
+            'body': 'this is not empty',
+        }
+        self.assertTrue(ComposeForm(data, sender=self.user1).is_valid())
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        self.assertTrue(ComposeForm(data, sender=self.user1).is_valid())
+        queries = [q for q in connection.queries if 'relationships_' in q['sql']]
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(queries, [])
+
+        Relationship.objects.create(from_user=user3, to_user=self.user1, status=blocking)
+        form = ComposeForm(data, sender=self.user1)
+        self.assertFalse(form.is_valid())
+        self.assertTrue(unicode(user3) in form.errors['recipient'][0])
+
     def test_save(self):
         form = ComposeForm(
             {
@@ -84,3 +111,20 @@ class ComposeFormTests(BaseTestCase):
         self.assertIsNotNone(message.pk)
         self.assertIsNotNone(message.parent_msg)
         self.assertIsNotNone(message.conversation)
+
+    def test_save_several_recipients(self):
+        user3 = User.objects.create(username="user 3")
+        form = ComposeForm(
+            {
+                'recipient': '%s, %s' % (self.user2.username, user3.username),
+                'subject': 'this is not empty',
+                'body': 'this is not empty',
+            }, 
+            sender=self.user1,
+        )
+        self.assertTrue(form.is_valid())
+        message = form.save()
+        self.assertEquals(2, len(form.sent_messages))
+        self.assertIn(message, form.sent_messages)
+        recipients = set(m.recipient for m in form.sent_messages)
+        self.assertEquals(set([self.user2, user3]), recipients)
@@ -0,0 +1,109 @@
+import socket
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.db import connection, connections, router
+from django.utils import simplejson
+
+from django_messages import routers
+from django_messages.instrumentation import AggregatorSink, StatsdSink
+from django_messages.routers import ReplicaRouter
+from django_messages.models import Message
+
+from base import DjangoMessagesTestCase
+
+
+class InstrumentationTests(DjangoMessagesTestCase):
+
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        self.skip_if_auth_urls_not_installed()
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', 'user1')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', 'user2')
+        Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')
+        self.old_settings = (
+            getattr(settings, 'DJANGO_MESSAGES_INSTRUMENTATION', False),
+            getattr(settings, 'DJANGO_MESSAGES_METRICS_SINKS', ()),
+        )
+        settings.DJANGO_MESSAGES_INSTRUMENTATION = True
+        settings.DJANGO_MESSAGES_METRICS_SINKS = (
+            'django_messages.instrumentation.AggregatorSink',
+        )
+        AggregatorSink.reset()
+
+    def tearDown(self):
+        (settings.DJANGO_MESSAGES_INSTRUMENTATION,
+            settings.DJANGO_MESSAGES_METRICS_SINKS) = self.old_settings
+        AggregatorSink.reset()
+
+    def test_view_and_manager_metrics(self):
+        self.client.login(username='user1', password='user1')
+        self.client.get(reverse('messages_inbox'))
+        stats = AggregatorSink.get_stats()
+
+        self.assertEquals(stats['views.inbox']['calls'], 1)
+        self.assertEquals(stats['manager.inbox_for']['calls'], 1)
+        self.assertEquals(stats['manager.inbox_for']['rows'], 1)
+        self.assertTrue(stats['manager.inbox_for']['queries'] > 0)
+        # queries of the manager are counted in the view too
+        self.assertTrue(stats['views.inbox']['queries'] >= stats['manager.inbox_for']['queries'])
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_queries_of_every_database(self):
+        """Queries sent to a replica are counted"""
+        replica = 'django_messages_metrics_replica'
+        connections.databases[replica] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+        call_command('syncdb', database=replica, interactive=False, verbosity=0)
+        replica_router = ReplicaRouter()
+        router.routers.insert(0, replica_router)
+        settings.DJANGO_MESSAGES_REPLICA_DATABASES = (replica,)
+        routers.reset()
+        try:
+            Message.objects.inbox_for(self.user1, per_page=20)
+            self.assertEquals(connections[replica].queries, [])
+        finally:
+            router.routers.remove(replica_router)
+            del settings.DJANGO_MESSAGES_REPLICA_DATABASES
+            connections[replica].close()
+            delattr(connections._connections, replica)
+            del connections.databases[replica]
+        self.assertTrue(AggregatorSink.get_stats()['manager.inbox_for']['queries'] > 0)
+
+    def test_disabled(self):
+        settings.DJANGO_MESSAGES_INSTRUMENTATION = False
+        Message.objects.inbox_for(self.user1, per_page=20)
+        self.assertEquals(AggregatorSink.get_stats(), {})
+
+    def test_statsd_sink(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(1)
+        try:
+            sink = StatsdSink(host='127.0.0.1', port=listener.getsockname()[1], prefix='test')
+            sink.send({'name': 'views.inbox', 'queries': 3, 'db_time': 1.5,
+                'total_time': 4.25, 'rows': None})
+            lines = listener.recv(4096).split('\n')
+        finally:
+            listener.close()
+        self.assertEquals(lines, [
+            'test.views.inbox.calls:1|c',
+            'test.views.inbox.queries:3|c',
+            'test.views.inbox.db_time:1.500|ms',
+            'test.views.inbox.total_time:4.250|ms',
+        ])
+
+    def test_stats_view(self):
+        Message.objects.inbox_for(self.user1, per_page=20)
+        self.client.login(username='user1', password='user1')
+        response = self.client.get(reverse('messages_stats'))
+        self.assertEquals(response.status_code, 302)
+
+        self.user1.is_staff = True
+        self.user1.save()
+        response = self.client.get(reverse('messages_stats'))
+        self.assertEquals(simplejson.loads(response.content)['manager.inbox_for']['calls'], 1)
@@ -2,7 +2,8 @@ from datetime import datetime, timedelta
 
 from django.test import TestCase
 from django.contrib.auth.models import User
-from django_messages.models import Message
+from django_messages import search
+from django_messages.models import Message, ConversationParticipant, inbox_count_for
 from django.db import connection
 from django.conf import settings
 
@@ -118,6 +119,36 @@ class ManagerTests(DjangoMessagesTestCase):
             self.assertTrue(message.sent_at >= sent_at)
             sent_at = message.sent_at
 
+    def test_get_conversation_page(self):
+        conversation = self.send_message(self.user1, self.user2)
+        conversation.conversation = conversation
+        conversation.save()
+        messages = [conversation]
+        for i in range(4):
+            messages.append(self.send_message(self.user2, self.user1, conversation=conversation))
+
+        page = Message.objects.get_conversation_page(conversation, per_page=2)
+        self.assertEquals(list(page), messages[3:])
+        self.assertTrue(page.has_next())
+
+        page = Message.objects.get_conversation_page(conversation, 
+            before=page.next_cursor, per_page=2)
+        self.assertEquals(list(page), messages[1:3])
+
+        page = Message.objects.get_conversation_page(conversation, 
+            before=page.next_cursor, per_page=2)
+        self.assertEquals(list(page), messages[:1])
+        self.assertFalse(page.has_next())
+
+    def test_get_last_message(self):
+        conversation = self.send_message(self.user1, self.user2)
+        conversation.conversation = conversation
+        conversation.save()
+        reply = self.send_message(self.user2, self.user1, conversation=conversation)
+
+        self.assertEquals(Message.objects.get_last_message(conversation), reply)
+        self.assertIsNone(Message.objects.get_last_message(reply.pk + 1))
+
     def test_get_conversations_with_one_message(self):
         conversation1 = self.send_message(self.user1, self.user2)
         conversation1.conversation = conversation1
@@ -146,3 +177,438 @@ class ManagerTests(DjangoMessagesTestCase):
         count = conversations.count()
         self.assertEquals(count, 12)
 
+
+    def test_inbox_for_shows_latest_message_of_conversation(self):
+        """A reply replaces the previous message of the conversation in the
+        inbox of the recipient"""
+        conversation = self.send_message(self.user1, self.user2)
+        conversation.conversation = conversation
+        conversation.save()
+        reply = self.send_message(self.user1, self.user2, parent=conversation, conversation=conversation)
+
+        inbox = Message.objects.inbox_for(self.user2)
+        self.assertEquals(inbox.count(), 1)
+        self.assertEquals(inbox[0], reply)
+
+    def test_participants_follow_deletion(self):
+        """Deleting every message of a conversation moves it from the inbox
+        to the trash of the recipient only"""
+        msg = self.send_message(self.user1, self.user2)
+        msg.conversation = msg
+        msg.save()
+        msg.recipient_deleted_at = datetime.now()
+        msg.save()
+
+        participant = ConversationParticipant.objects.get(user=self.user2, conversation=msg)
+        self.assertIsNone(participant.inbox_message_id)
+        self.assertEquals(participant.trash_message_id, msg.pk)
+        self.assertIsNotNone(participant.deleted_at)
+        participant = ConversationParticipant.objects.get(user=self.user1, conversation=msg)
+        self.assertEquals(participant.outbox_message_id, msg.pk)
+        self.assertIsNone(participant.deleted_at)
+
+    def test_participants_unread(self):
+        msg = self.send_message(self.user1, self.user2)
+        self.assertTrue(ConversationParticipant.objects.get(user=self.user2).unread)
+        self.assertFalse(ConversationParticipant.objects.get(user=self.user1).unread)
+        msg.read_at = datetime.now()
+        msg.save()
+        self.assertFalse(ConversationParticipant.objects.get(user=self.user2).unread)
+
+    def test_mark_read(self):
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user1, [self.user2], 'Re: Subject', 'Body',
+            parent_msg=conversation)[0]
+        self.assertEquals(Message.objects.unread().filter(recipient=self.user2).count(), 2)
+
+        read = ConversationParticipant.objects.mark_read(self.user2, conversation, reply)
+        self.assertEquals(read, 2)
+        participant = ConversationParticipant.objects.get(user=self.user2)
+        self.assertEquals(participant.last_read_id, reply.pk)
+        self.assertFalse(participant.unread)
+        self.assertEquals(Message.objects.unread().filter(recipient=self.user2).count(), 0)
+        # read_at is kept in sync
+        self.assertEquals(Message.objects.filter(read_at__isnull=True).count(), 0)
+        self.assertFalse(Message.objects.inbox_for(self.user2)[0].new())
+
+        # reading again is a no-op
+        settings.DEBUG = True
+        connection.queries = []
+        read = ConversationParticipant.objects.mark_read(self.user2, conversation, reply)
+        self.assertEquals(read, 0)
+        self.assertEquals(len(connection.queries), 1)
+        connection.queries = []
+        settings.DEBUG = False
+
+    def test_refresh_keeps_read_cursor(self):
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        ConversationParticipant.objects.mark_read(self.user2, conversation, conversation)
+        reply = Message.objects.send(self.user1, [self.user2], 'Re: Subject', 'Body',
+            parent_msg=conversation)[0]
+        ConversationParticipant.objects.refresh([conversation])
+
+        participant = ConversationParticipant.objects.get(user=self.user2)
+        self.assertEquals(participant.last_read_id, conversation.pk)
+        self.assertTrue(participant.unread)
+        self.assertEquals(list(Message.objects.unread().filter(recipient=self.user2)), [reply])
+
+    def test_record_keeps_later_message(self):
+        """A message recorded after a later one of its conversation, its
+        transaction having committed last, doesn't replace it"""
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user1, [self.user2], 'Re: Subject', 'Body',
+            parent_msg=conversation)[0]
+        ConversationParticipant.objects.record(conversation)
+
+        participant = ConversationParticipant.objects.get(user=self.user2)
+        self.assertEquals(participant.inbox_message_id, reply.pk)
+        self.assertEquals(participant.last_activity, reply.sent_at)
+        participant = ConversationParticipant.objects.get(user=self.user1)
+        self.assertEquals(participant.outbox_message_id, reply.pk)
+        self.assertEquals(participant.last_activity, reply.sent_at)
+
+    def test_inbox_for_pages(self):
+        """Pages follow each other from the most recent conversation, in both
+        directions"""
+        messages = []
+        for i in range(5):
+            msg = self.send_message(self.user1, self.user2)
+            msg.conversation = msg
+            msg.save()
+            messages.insert(0, msg)
+
+        page = Message.objects.inbox_for(self.user2, per_page=2)
+        self.assertEquals(list(page), messages[:2])
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+        page = Message.objects.inbox_for(self.user2, cursor=page.next_cursor, per_page=2)
+        self.assertEquals(list(page), messages[2:4])
+        self.assertTrue(page.has_previous())
+
+        last_page = Message.objects.inbox_for(self.user2, cursor=page.next_cursor, per_page=2)
+        self.assertEquals(list(last_page), messages[4:])
+        self.assertFalse(last_page.has_next())
+
+        page = Message.objects.inbox_for(self.user2, cursor=last_page.previous_cursor, per_page=2)
+        self.assertEquals(list(page), messages[2:4])
+        page = Message.objects.inbox_for(self.user2, cursor=page.previous_cursor, per_page=2)
+        self.assertEquals(list(page), messages[:2])
+        self.assertFalse(page.has_previous())
+
+    def test_inbox_for_invalid_cursor(self):
+        """An invalid cursor designates the first page"""
+        msg = self.send_message(self.user1, self.user2)
+        page = Message.objects.inbox_for(self.user2, cursor='invalid', per_page=2)
+        self.assertEquals(list(page), [msg])
+
+    def test_trash_for_pages_with_same_activity(self):
+        """Conversations with the same last activity are ordered by id"""
+        now = datetime.now()
+        for i in range(3):
+            msg = self.send_message(self.user1, self.user2)
+            msg.conversation = msg
+            msg.sent_at = now
+            msg.sender_deleted_at = now
+            msg.save()
+        first = Message.objects.trash_for(self.user1, per_page=2)
+        second = Message.objects.trash_for(self.user1, cursor=first.next_cursor, per_page=2)
+        ids = [msg.pk for msg in list(first) + list(second)]
+        self.assertEquals(ids, sorted(ids, reverse=True))
+        self.assertEquals(len(ids), 3)
+
+    def test_send_to_several_recipients(self):
+        """Each recipient gets a message starting its own conversation"""
+        recipients = [self.user2, self.user3]
+        messages = Message.objects.send(self.user1, recipients, 'Subject', 'Body')
+
+        self.assertEquals(len(messages), 2)
+        self.assertEquals(Message.objects.count(), 2)
+        for message, recipient in zip(messages, recipients):
+            self.assertEquals(message.recipient, recipient)
+            self.assertEquals(message.conversation_id, message.pk)
+            self.assertEquals(Message.objects.get(pk=message.pk).conversation_id, message.pk)
+            self.assertEquals(list(Message.objects.inbox_for(recipient)), [message])
+        self.assertEquals(Message.objects.outbox_for(self.user1).count(), 2)
+
+    def test_send_inserts_messages_at_once(self):
+        """The messages of all the recipients are inserted by a single
+        statement, and their ids are not read back"""
+        users = [User.objects.create_user('bulk%d' % i, 'bulk%d@example.com' % i, '123456')
+                 for i in range(20)]
+        # the search table is looked up once
+        search.get_backend()
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        Message.objects.send(self.user1, users[:2], 'Subject', 'Body')
+        # notifications may not be sent at once, only writes of messages
+        # are counted
+        few = [q['sql'] for q in connection.queries if 'django_messages_' in q['sql']]
+        connection.queries = []
+        Message.objects.send(self.user1, users, 'Subject', 'Body')
+        many = [q['sql'] for q in connection.queries if 'django_messages_' in q['sql']]
+        settings.DEBUG = False
+        self.assertEquals(len(few), len(many))
+        if connection.vendor in ('postgresql', 'sqlite'):
+            self.assertEquals(len([q for q in many
+                if q.startswith('INSERT INTO "django_messages_message"')]), 1)
+        self.assertFalse([q for q in many if q.startswith('SELECT')
+            and 'FROM "django_messages_message"' in q])
+
+    def test_send_to_more_recipients_than_a_statement_holds(self):
+        User.objects.bulk_create([User(username='bulk%d' % i) for i in range(150)])
+        users = list(User.objects.filter(username__startswith='bulk').order_by('-pk'))
+        messages = Message.objects.send(self.user1, users, 'Subject', 'Body')
+        self.assertEquals(len(set(message.pk for message in messages)), 150)
+        self.assertEquals(
+            [Message.objects.get(pk=message.pk).recipient_id for message in messages],
+            [user.pk for user in users])
+
+    def test_send_keeps_order_of_recipients(self):
+        """Recipients are counted once, in the order they were given"""
+        recipients = [self.user3, self.user2, self.user3, self.user1]
+        messages = Message.objects.send(self.user1, recipients, 'Subject', 'Body')
+        self.assertEquals([message.recipient_id for message in messages],
+            [self.user3.pk, self.user2.pk, self.user1.pk])
+        for message in messages:
+            self.assertEquals(Message.objects.get(pk=message.pk).recipient_id,
+                message.recipient_id)
+
+    def test_send_reply(self):
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body',
+            parent_msg=conversation)[0]
+
+        self.assertEquals(reply.conversation_id, conversation.pk)
+        self.assertEquals(reply.parent_msg, conversation)
+        self.assertIsNotNone(Message.objects.get(pk=conversation.pk).replied_at)
+        self.assertEquals(list(Message.objects.inbox_for(self.user1)), [reply])
+        self.assertEquals(list(Message.objects.outbox_for(self.user1)), [conversation])
+
+    def test_send_reply_keeps_concurrent_changes(self):
+        """Replying only writes ``replied_at`` on the parent message"""
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        now = datetime.now()
+        Message.objects.filter(pk=conversation.pk).update(read_at=now, sender_deleted_at=now)
+        Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body',
+            parent_msg=conversation)
+
+        parent = Message.objects.get(pk=conversation.pk)
+        self.assertIsNotNone(parent.replied_at)
+        self.assertIsNotNone(parent.read_at)
+        self.assertIsNotNone(parent.sender_deleted_at)
+
+    def test_send_one_message_writes(self):
+        """A single message is written by one INSERT and one narrow UPDATE"""
+        conversation = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body',
+            parent_msg=conversation)
+        queries = [q['sql'] for q in connection.queries if 'django_messages_message' in q['sql']]
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(len([q for q in queries if q.startswith('INSERT')]), 1)
+        self.assertEquals(len([q for q in queries if q.startswith('UPDATE')]), 1)
+        self.assertEquals(len([q for q in queries if q.startswith('SELECT')]), 0)
+
+    def test_search_for(self):
+        kept = Message.objects.send(self.user1, [self.user2], 'Holidays', 'See you in Paris')[0]
+        Message.objects.send(self.user1, [self.user3], 'Paris', 'Not for user2')
+        other = Message.objects.send(self.user2, [self.user1], 'Work', 'Nothing to see')[0]
+
+        self.assertEquals(list(Message.objects.search_for(self.user2, 'paris')), [kept])
+        self.assertEquals(list(Message.objects.search_for(self.user2, 'holidays, paris!')), [kept])
+        self.assertEquals(list(Message.objects.search_for(self.user2, 'see')), [other, kept])
+        self.assertEquals(list(Message.objects.search_for(self.user2, 'london paris')), [])
+        self.assertEquals(list(Message.objects.search_for(self.user2, '"*')), [])
+
+    def test_search_without_index(self):
+        """Messages are still saved and searched when the search table is
+        missing"""
+        table = search.SEARCH_TABLE
+        search.SEARCH_TABLE = 'django_messages_missing'
+        search._backends.clear()
+        try:
+            self.assertTrue(type(search.get_backend()) is search.SimpleSearchBackend)
+            kept = Message.objects.send(self.user1, [self.user2], 'Holidays', 'See you in Paris')[0]
+            self.assertEquals(list(Message.objects.search_for(self.user2, 'paris')), [kept])
+        finally:
+            search.SEARCH_TABLE = table
+            search._backends.clear()
+
+    def test_search_for_skips_deleted_messages(self):
+        message = Message.objects.send(self.user1, [self.user2], 'Holidays', 'Body')[0]
+        message.recipient_deleted_at = datetime.now()
+        message.save()
+        self.assertEquals(list(Message.objects.search_for(self.user2, 'holidays')), [])
+        self.assertEquals(list(Message.objects.search_for(self.user1, 'holidays')), [message])
+
+    def test_search_for_pages(self):
+        messages = [Message.objects.send(self.user1, [self.user2], 'Holidays', 'Body')[0]
+            for i in range(3)]
+        page = Message.objects.search_for(self.user2, 'holidays', per_page=2)
+        self.assertEquals(list(page), [messages[2], messages[1]])
+        page = Message.objects.search_for(self.user2, 'holidays', 
+            cursor=page.next_cursor, per_page=2)
+        self.assertEquals(list(page), [messages[0]])
+        self.assertFalse(page.has_next())
+
+    def test_mark_deleted(self):
+        first = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', first)[0]
+        other = Message.objects.send(self.user3, [self.user2], 'Subject', 'Body')[0]
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        deleted = Message.objects.mark_deleted(self.user1, [first.pk])
+        updates = [q for q in connection.queries
+            if q['sql'].startswith('UPDATE "django_messages_message"')
+            or q['sql'].startswith('UPDATE django_messages_message')]
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(deleted, 2)
+        self.assertEquals(len(updates), 1)
+
+        first = Message.objects.get(pk=first.pk)
+        reply = Message.objects.get(pk=reply.pk)
+        self.assertIsNotNone(first.sender_deleted_at)
+        self.assertIsNone(first.recipient_deleted_at)
+        self.assertIsNotNone(reply.recipient_deleted_at)
+        self.assertIsNone(reply.sender_deleted_at)
+        self.assertEquals(list(Message.objects.trash_for(self.user1)), [reply])
+        self.assertIsNone(Message.objects.get(pk=other.pk).recipient_deleted_at)
+
+        # deleting again changes nothing
+        self.assertEquals(Message.objects.mark_deleted(self.user1, [first.pk]), 0)
+        self.assertEquals(Message.objects.get(pk=first.pk).sender_deleted_at, first.sender_deleted_at)
+
+    def test_mark_undeleted(self):
+        first = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        Message.objects.mark_deleted(self.user1, [first.pk])
+        Message.objects.mark_deleted(self.user2, [first.pk])
+        self.assertEquals(Message.objects.mark_undeleted(self.user2, [first.pk]), 1)
+        first = Message.objects.get(pk=first.pk)
+        self.assertIsNotNone(first.sender_deleted_at)
+        self.assertIsNone(first.recipient_deleted_at)
+        self.assertEquals(list(Message.objects.inbox_for(self.user2)), [first])
+        self.assertEquals(list(Message.objects.trash_for(self.user2)), [])
+        self.assertEquals(Message.objects.mark_undeleted(self.user2, [first.pk]), 0)
+
+    def test_mark_deleted_chunks(self):
+        from django_messages import models
+        messages = Message.objects.send(self.user1, [self.user2, self.user3], 'Subject', 'Body')
+        self.assertEquals(inbox_count_for(self.user2), 1)
+        old_chunk_size = models.COUNT_CHUNK_SIZE
+        models.COUNT_CHUNK_SIZE = 1
+        try:
+            deleted = Message.objects.mark_deleted(self.user1,
+                [message.pk for message in messages])
+        finally:
+            models.COUNT_CHUNK_SIZE = old_chunk_size
+        self.assertEquals(deleted, 2)
+        self.assertEquals(list(Message.objects.outbox_for(self.user1)), [])
+        # the unread count of the recipient is kept
+        Message.objects.mark_deleted(self.user2, [messages[0].pk])
+        self.assertEquals(inbox_count_for(self.user2), 0)
+
+    def test_mark_all_read(self):
+        first = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', first)[0]
+        other = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        self.assertEquals(inbox_count_for(self.user1), 3)
+
+        read = ConversationParticipant.objects.mark_all_read(self.user1, batch_size=1)
+        self.assertEquals(read, 3)
+        self.assertEquals(inbox_count_for(self.user1), 0)
+        self.assertFalse(ConversationParticipant.objects.filter(user=self.user1, unread=True).exists())
+        self.assertIsNotNone(Message.objects.get(pk=other.pk).read_at)
+        self.assertEquals(ConversationParticipant.objects.mark_all_read(self.user1), 0)
+
+    def test_mark_all_read_up_to(self):
+        first = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        other = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        reply = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', first)[0]
+
+        read = ConversationParticipant.objects.mark_all_read(self.user1, up_to=other.pk)
+        self.assertEquals(read, 2)
+        self.assertEquals(list(Message.objects.unread().filter(recipient=self.user1)), [reply])
+        self.assertEquals(inbox_count_for(self.user1), 1)
+        participant = ConversationParticipant.objects.get(user=self.user1, conversation=first)
+        self.assertTrue(participant.unread)
+        self.assertEquals(participant.last_read_id, other.pk)
+
+    def test_empty_trash(self):
+        first = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        other = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        kept = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        Message.objects.mark_deleted(self.user1, [first.pk, other.pk])
+        self.assertEquals(len(Message.objects.trash_for(self.user1)), 2)
+
+        self.assertEquals(ConversationParticipant.objects.empty_trash(self.user1, batch_size=1), 2)
+        self.assertEquals(list(Message.objects.trash_for(self.user1)), [])
+        self.assertEquals(list(Message.objects.inbox_for(self.user1)), [kept])
+        # the other participants keep their messages
+        self.assertEquals(list(Message.objects.outbox_for(self.user3)), [kept, other])
+
+        # refreshed summaries remember the emptied trash, newly deleted
+        # messages go to the trash
+        reply = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', first)[0]
+        ConversationParticipant.objects.refresh([first.pk])
+        self.assertEquals(list(Message.objects.trash_for(self.user1)), [])
+        Message.objects.mark_deleted(self.user1, [first.pk])
+        self.assertEquals(list(Message.objects.trash_for(self.user1)), [reply])
+
+    def test_snippet(self):
+        message = Message.objects.send(self.user1, [self.user2], 'Subject',
+            'First line\n\nsecond  line')[0]
+        self.assertEquals(Message.objects.get(pk=message.pk).snippet, 'First line second line')
+        message = self.send_message(self.user1, self.user2)
+        message.body = 'word ' * 100
+        message.save()
+        snippet = Message.objects.get(pk=message.pk).snippet
+        self.assertEquals(len(snippet), 100)
+        self.assertTrue(snippet.endswith('...'))
+
+    def test_inbox_for_loads_list_fields(self):
+        """the pages of the listings leave the body and the passwords out"""
+        Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        page = Message.objects.inbox_for(self.user2, per_page=10)
+        sql = connection.queries[-1]['sql']
+        self.assertEquals(page[0].sender.username, 'user1')
+        self.assertEquals(page[0].snippet, 'Body')
+        self.assertTrue(page[0].new())
+        queries = len(connection.queries)
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(queries, 1)
+        self.assertFalse('"body"' in sql)
+        self.assertFalse('"password"' in sql)
+        # the body is still loaded on demand
+        self.assertEquals(page[0].body, 'Body')
+
+    def test_inbox_for_annotate(self):
+        first = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        Message.objects.send(self.user1, [self.user2], 'Re: Subject', 'Body', first)
+        last = Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', first)[0]
+        other = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        ConversationParticipant.objects.mark_read(self.user1, first.pk, first)
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        page = Message.objects.inbox_for(self.user1, per_page=10, annotate=True)
+        counts = [(m.pk, m.message_count, m.unread_count, m.last_activity) for m in page]
+        queries = len(connection.queries)
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(queries, 2)
+        self.assertEquals(counts, [
+            (other.pk, 1, 1, other.sent_at),
+            (last.pk, 3, 1, last.sent_at),
+        ])
+
+        messages = Message.objects.outbox_for(self.user2, annotate=True)
+        self.assertEquals([(m.pk, m.message_count, m.unread_count) for m in messages],
+            [(last.pk, 3, 1)])
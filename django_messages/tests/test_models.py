@@ -1,8 +1,13 @@
 from datetime import datetime
 
 from django.core import mail
+from django.conf import settings
+from django.db import connection
 from django.contrib.auth.models import User
-from django_messages.models import Message, inbox_count_for
+from django_messages import counters
+from django.template import Context, Template
+from django_messages.models import Message, inbox_count_for, inbox_counts_for, \
+    outbox_counts_for, trash_counts_for
 
 from base import DjangoMessagesTestCase
 
@@ -102,3 +107,75 @@ class MessageTests(DjangoMessagesTestCase):
         msg.save()
 
         self.assertEquals(inbox_count_for(self.user2), 0)
+
+    def test_user_inbox_count_is_cached(self):
+        """Once counted, the unread count is read from the cache and kept
+        up to date by new messages"""
+        self.send_message(self.user1, self.user2)
+        self.assertEquals(inbox_count_for(self.user2), 1)
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        self.assertEquals(inbox_count_for(self.user2), 1)
+        self.assertEquals(len(connection.queries), 0)
+        settings.DEBUG = False
+
+        self.send_message(self.user3, self.user2)
+        self.assertEquals(counters.get_inbox_count(self.user2.pk), 2)
+        self.assertEquals(inbox_count_for(self.user2), 2)
+
+    def test_inbox_counts_for(self):
+        """The unread counts of many users are counted in one query, the
+        cached ones left out"""
+        self.send_message(self.user1, self.user2)
+        self.send_message(self.user3, self.user2)
+        self.send_message(self.user2, self.user3)
+        counters.set_inbox_count(self.user1.pk, 5)
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        counts = inbox_counts_for([self.user1, self.user2, self.user3.pk])
+        queries = len(connection.queries)
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEquals(counts, {self.user1.pk: 5, self.user2.pk: 2, self.user3.pk: 1})
+        self.assertEquals(queries, 1)
+        self.assertEquals(counters.get_inbox_count(self.user2.pk), 2)
+
+    def test_inbox_counts_for_chunks(self):
+        from django_messages import models
+        self.send_message(self.user1, self.user2)
+        old_chunk_size = models.COUNT_CHUNK_SIZE
+        models.COUNT_CHUNK_SIZE = 2
+        try:
+            counts = inbox_counts_for([self.user1, self.user2, self.user3])
+        finally:
+            models.COUNT_CHUNK_SIZE = old_chunk_size
+        self.assertEquals(counts, {self.user1.pk: 0, self.user2.pk: 1, self.user3.pk: 0})
+
+    def test_outbox_and_trash_counts_for(self):
+        Message.objects.send(self.user1, [self.user2, self.user3], 'Subject', 'Body')
+        message = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        message.recipient_deleted_at = datetime.now()
+        message.save()
+        users = [self.user1, self.user2, self.user3]
+        self.assertEquals(outbox_counts_for(users),
+            {self.user1.pk: 2, self.user2.pk: 1, self.user3.pk: 0})
+        self.assertEquals(trash_counts_for(users),
+            {self.user1.pk: 1, self.user2.pk: 0, self.user3.pk: 0})
+
+    def test_inbox_counts_tag(self):
+        self.send_message(self.user1, self.user2)
+        template = Template('{% load inbox %}{% inbox_counts users as counts %}'
+            '{% for user, count in counts %}{{ user }}={{ count }} {% endfor %}')
+        output = template.render(Context({'users': [self.user1, self.user2]}))
+        self.assertEquals(output, 'user1=0 user2=1 ')
+
+    def test_user_inbox_count_after_change(self):
+        """Saving an existing message drops the cached count"""
+        msg = self.send_message(self.user1, self.user2)
+        self.assertEquals(inbox_count_for(self.user2), 1)
+        msg.read_at = datetime.now()
+        msg.save()
+        self.assertIsNone(counters.get_inbox_count(self.user2.pk))
+        self.assertEquals(inbox_count_for(self.user2), 0)
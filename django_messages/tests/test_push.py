@@ -0,0 +1,67 @@
+import threading
+import time
+
+from django.conf import settings
+
+from django_messages import counters, push
+
+from base import DjangoMessagesTestCase
+
+
+class BrokerTests(DjangoMessagesTestCase):
+
+    def bump_later(self, user_ids, delay=0.1):
+        thread = threading.Timer(delay, counters.bump_mailbox_versions, [user_ids])
+        thread.start()
+        return thread
+
+    def test_changed_version(self):
+        # an outdated version is answered right away
+        current = push.CacheBroker().wait(1, 1.0, 5)
+        self.assertEqual(current, counters.get_mailbox_version(1))
+
+    def test_timeout(self):
+        version = counters.get_mailbox_version(1)
+        started = time.time()
+        self.assertEqual(push.CacheBroker(interval=0.05).wait(1, version, 0.2), version)
+        self.assertTrue(time.time() - started >= 0.2)
+
+    def test_cache_broker(self):
+        version = counters.get_mailbox_version(1)
+        thread = self.bump_later([1])
+        current = push.CacheBroker(interval=0.05).wait(1, version, 5)
+        thread.join()
+        self.assertNotEqual(current, version)
+
+    def test_local_broker(self):
+        old_broker = getattr(settings, 'DJANGO_MESSAGES_PUSH_BROKER', None)
+        settings.DJANGO_MESSAGES_PUSH_BROKER = 'django_messages.push.LocalBroker'
+        try:
+            self.assertTrue(isinstance(push.get_broker(), push.LocalBroker))
+            # the interval is longer than the test: only the publication
+            # wakes the broker up
+            broker = push.LocalBroker(interval=10)
+            version = counters.get_mailbox_version(1)
+            # a change to another mailbox wakes the broker up but isn't returned
+            self.bump_later([2], delay=0.05).join()
+            thread = self.bump_later([1])
+            started = time.time()
+            current = broker.wait(1, version, 5)
+            thread.join()
+            self.assertNotEqual(current, version)
+            self.assertTrue(time.time() - started < 5)
+        finally:
+            if old_broker is None:
+                del settings.DJANGO_MESSAGES_PUSH_BROKER
+            else:
+                settings.DJANGO_MESSAGES_PUSH_BROKER = old_broker
+
+    def test_event_stream(self):
+        version = counters.get_mailbox_version(1)
+        thread = self.bump_later([1])
+        events = list(push.event_stream(1, version, 0.5, push.CacheBroker(interval=0.05)))
+        thread.join()
+        current = counters.get_mailbox_version(1)
+        self.assertEqual(events[0], 'retry: 0\n\n')
+        self.assertEqual(len(events), 2)
+        self.assertTrue(events[1].startswith('id: %r\nevent: mailbox\n' % current))
@@ -0,0 +1,135 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.db import connections, router
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from django_messages import counters, routers
+from django_messages.models import Message, inbox_count_for, inbox_counts_for
+from django_messages.routers import ReplicaRouter, ReplicaMiddleware
+
+from base import DjangoMessagesTestCase
+
+REPLICA = 'django_messages_replica'
+
+
+class ReplicaRouterTests(DjangoMessagesTestCase):
+    """
+    The replica is a second SQLite database with the tables but none of
+    the rows of the primary, as a replica lagging behind would.
+    """
+    def setUp(self):
+        self.skip_if_auth_not_installed()
+        connections.databases[REPLICA] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+        call_command('syncdb', database=REPLICA, interactive=False, verbosity=0)
+        self.router = ReplicaRouter()
+        router.routers.insert(0, self.router)
+        self.old_replicas = getattr(settings, 'DJANGO_MESSAGES_REPLICA_DATABASES', None)
+        settings.DJANGO_MESSAGES_REPLICA_DATABASES = (REPLICA,)
+
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', '123456')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', '123456')
+        self.message = Message.objects.send(self.user1, [self.user2], 'Subject', 'Body')[0]
+        routers.reset()
+
+    def tearDown(self):
+        router.routers.remove(self.router)
+        if self.old_replicas is None:
+            del settings.DJANGO_MESSAGES_REPLICA_DATABASES
+        else:
+            settings.DJANGO_MESSAGES_REPLICA_DATABASES = self.old_replicas
+        connections[REPLICA].close()
+        delattr(connections._connections, REPLICA)
+        del connections.databases[REPLICA]
+
+    def request(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def test_routing(self):
+        self.assertEqual(self.router.db_for_read(Message), REPLICA)
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_write(User), None)
+        self.assertEqual(self.router.db_for_write(Message), 'default')
+        # the thread now reads its writes
+        self.assertEqual(self.router.db_for_read(Message), 'default')
+        self.assertFalse(self.router.allow_syncdb(REPLICA, Message))
+        self.assertEqual(self.router.allow_syncdb('default', Message), None)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(list(Message.objects.inbox_for(self.user2)), [])
+        Message.objects.send(self.user2, [self.user1], 'Re: Subject', 'Body', self.message)
+        self.assertEqual(Message.objects.get_conversation(self.message.pk).count(), 2)
+
+    def test_api_reads_the_primary(self):
+        """A recipient polling the JSON api gets the new message at once,
+        and not an empty page tagged with the new version"""
+        self.client.login(username='user2', password='123456')
+        response = self.client.get(reverse('messages_api_inbox'))
+        data = simplejson.loads(response.content)
+        self.assertEqual([m['id'] for m in data['conversations']], [self.message.pk])
+
+    def test_cached_counts_read_the_primary(self):
+        counters.invalidate_inbox_counts([self.user2.pk])
+        self.assertEqual(inbox_count_for(self.user2), 1)
+        counters.invalidate_inbox_counts([self.user2.pk])
+        self.assertEqual(inbox_counts_for([self.user2]), {self.user2.pk: 1})
+
+    def test_sticky_user(self):
+        middleware = ReplicaMiddleware()
+        request = self.request(self.user1)
+        middleware.process_request(request)
+        Message.objects.mark_deleted(self.user1, [self.message.pk])
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(routers.is_pinned())
+
+        # the next requests of the user read from the primary
+        request = self.request(self.user1)
+        middleware.process_request(request)
+        self.assertEqual(list(Message.objects.trash_for(self.user1)), [self.message])
+        middleware.process_response(request, HttpResponse())
+
+        # but not those of the other users
+        request = self.request(self.user2)
+        middleware.process_request(request)
+        self.assertEqual(list(Message.objects.inbox_for(self.user2)), [])
+        middleware.process_response(request, HttpResponse())
+
+    def test_sticky_timeout(self):
+        settings.DJANGO_MESSAGES_REPLICA_STICKY_TIMEOUT = 0.1
+        try:
+            routers.stick_user(self.user1.pk)
+        finally:
+            del settings.DJANGO_MESSAGES_REPLICA_STICKY_TIMEOUT
+        self.assertTrue(routers.is_sticky(self.user1.pk))
+        time.sleep(0.2)
+        self.assertFalse(routers.is_sticky(self.user1.pk))
+
+    def test_reset_when_request_starts(self):
+        """A thread pinned outside of the middleware reads from the replicas
+        again once a request starts"""
+        routers.pin_primary()
+        request_started.send(sender=self.__class__)
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(self.router.db_for_read(Message), REPLICA)
+
+    def test_one_replica_per_request(self):
+        settings.DJANGO_MESSAGES_REPLICA_DATABASES = (REPLICA, 'other_replica')
+        replicas = set()
+        for i in range(20):
+            request_started.send(sender=self.__class__)
+            replica = self.router.db_for_read(Message)
+            self.assertEqual(set(self.router.db_for_read(Message) for j in range(10)),
+                set([replica]))
+            replicas.add(replica)
+        self.assertEqual(replicas, set([REPLICA, 'other_replica']))
@@ -1,11 +1,18 @@
 from datetime import datetime
+from time import time
 
 from django.core.urlresolvers import reverse
+from django.test.client import RequestFactory
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.unittest import skipIf
 from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import simplejson
+from django.utils.http import http_date
 
-from django_messages.models import Message
+from django_messages import counters, views
+from django_messages.models import Message, inbox_count_for
 from django_messages.forms import ComposeForm
 
 from base import DjangoMessagesTestCase
@@ -88,6 +95,35 @@ class InboxViewTests(ViewBaseTestCase):
             self.assertContains(response, message.subject)
 
 
+class InboxRowCacheTests(ViewBaseTestCase):
+    """Rows of the listings are cached until their message changes"""
+    def setUp(self):
+        super(InboxRowCacheTests, self).setUp()
+        self.message = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        self.client.login(username='user1', password='user1')
+
+    def test_cached_row(self):
+        response = self.client.get(reverse('messages_inbox'))
+        self.assertContains(response, 'Subject')
+        # a change that doesn't go through the key is not seen
+        Message.objects.filter(pk=self.message.pk).update(subject='Changed')
+        response = self.client.get(reverse('messages_inbox'))
+        self.assertContains(response, 'Subject')
+        self.assertNotContains(response, 'Changed')
+
+    def test_new_message_or_state_renders_again(self):
+        self.client.get(reverse('messages_inbox'))
+        Message.objects.filter(pk=self.message.pk).update(subject='Changed')
+        self.client.get(reverse('messages_detail', args=(self.message.pk,)))
+        response = self.client.get(reverse('messages_inbox'))
+        self.assertContains(response, 'Changed')
+
+        reply = Message.objects.send(self.user2, [self.user1], 'Reply', 'Body', 
+            parent_msg=self.message)[0]
+        response = self.client.get(reverse('messages_inbox'))
+        self.assertContains(response, 'Reply')
+
+
 class OutboxViewTests(ViewBaseTestCase):
 
     def setUp(self):
@@ -270,6 +306,39 @@ class ComposeViewTests(ViewBaseTestCase):
         )
         self.assertRedirects(response, redirect_url)
     
+    def test_submit_several_recipients(self):
+        """Sending to several recipients redirects to the outbox"""
+        self.client.login(username='user1', password='user1')
+        response = self.client.post(self.target_url, 
+            {
+                'recipient': 'user2, user3',
+                'subject': 'random subject for testing',
+                'body': 'body body body body body body',
+            }
+        )
+        self.assertRedirects(response, reverse('messages_outbox'))
+        self.assertEqual(1, Message.objects.inbox_for(self.user2).count())
+        self.assertEqual(1, Message.objects.inbox_for(self.user3).count())
+        self.assertEqual(2, Message.objects.outbox_for(self.user1).count())
+
+    def test_submit_recipients_filter(self):
+        """The ``recipients_filter`` of the view is given to the form"""
+        request = RequestFactory().post(self.target_url, {
+            'recipient': 'user2, user3',
+            'subject': 'random subject for testing',
+            'body': 'body body body body body body',
+        })
+        request.user = self.user1
+        request.session = {}
+        received = []
+        def recipients_filter(users):
+            received.append(sorted(user.username for user in users))
+            return set(user for user in users if user != self.user3)
+        response = views.compose(request, recipients_filter=recipients_filter)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(received, [['user2', 'user3']])
+        self.assertEqual(0, Message.objects.outbox_for(self.user1).count())
+
     def test_submit_redirect_next(self):
         """Tests that after submit the user is redirected to next parameter provided
         in query string"""
@@ -393,6 +462,18 @@ class DeleteViewTests(ViewBaseTestCase):
         response = self.client.get(self.target_url)
         self.assertEqual(response.status_code, 404)
 
+    def test_reading_a_reply_after_delete(self):
+        """The deleted messages read with the reply are not taken off the
+        unread count"""
+        Message.objects.mark_deleted(self.user2, [self.message.pk])
+        reply = Message.objects.send(self.user1, [self.user2], 'Re: Subject', 'Body',
+            parent_msg=self.message)[0]
+        self.assertEqual(inbox_count_for(self.user2), 1)
+        self.client.login(username='user2', password='user2')
+        self.client.get(reverse('messages_detail',
+            kwargs={'conversation_id': reply.conversation_id}))
+        self.assertEqual(inbox_count_for(self.user2), 0)
+
     def test_submit(self):
         self.client.login(username='user1', password='user1')
         ids = [self.message.pk] + [10, 11, 12]  # invalid ids are accepted
@@ -414,6 +495,58 @@ class DeleteViewTests(ViewBaseTestCase):
         self.assertRedirects(response, next)
 
 
+class MarkAllReadViewTests(ViewBaseTestCase):
+
+    def setUp(self):
+        super(MarkAllReadViewTests, self).setUp()
+        self.first = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        self.second = Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')[0]
+        self.target_url = reverse('messages_mark_all_read')
+
+    def test_login_required(self):
+        response = self.client.get(self.target_url)
+        login_url = reverse('django.contrib.auth.views.login')
+        redirect_url = 'http://testserver%s?next=%s' % (login_url, self.target_url)
+        self.assertRedirects(response, redirect_url)
+
+    def test_get_is_a_404(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.get(self.target_url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_submit(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.post(self.target_url)
+        self.assertRedirects(response, reverse('messages_inbox'))
+        self.assertEqual(Message.objects.unread().filter(recipient=self.user1).count(), 0)
+
+    def test_submit_up_to(self):
+        self.client.login(username='user1', password='user1')
+        self.client.post(self.target_url, {'up_to': self.first.pk})
+        self.assertEqual(list(Message.objects.unread().filter(recipient=self.user1)),
+            [self.second])
+
+
+class EmptyTrashViewTests(ViewBaseTestCase):
+
+    def setUp(self):
+        super(EmptyTrashViewTests, self).setUp()
+        self.message = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        Message.objects.mark_deleted(self.user1, [self.message.pk])
+        self.target_url = reverse('messages_empty_trash')
+
+    def test_get_is_a_404(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.get(self.target_url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_submit(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.post(self.target_url)
+        self.assertRedirects(response, reverse('messages_trash'))
+        self.assertEqual(list(Message.objects.trash_for(self.user1)), [])
+
+
 class UndeleteViewTests(ViewBaseTestCase):
 
     def setUp(self):
@@ -460,6 +593,210 @@ class UndeleteViewTests(ViewBaseTestCase):
         self.assertRedirects(response, next)
 
 
+class SearchViewTests(ViewBaseTestCase):
+    """Search view tests, url endpoint is ``messages_search``"""
+    def setUp(self):
+        super(SearchViewTests, self).setUp()
+        self.message = Message.objects.send(self.user1, [self.user2], 'Holidays', 'Body')[0]
+        self.target_url = reverse('messages_search')
+
+    def test_login_required(self):
+        response = self.client.get(self.target_url)
+        login_url = reverse('django.contrib.auth.views.login')
+        redirect_url = 'http://testserver%s?next=%s' % (login_url, self.target_url)
+        self.assertRedirects(response, redirect_url)
+
+    def test_search(self):
+        self.client.login(username='user2', password='user2')
+        response = self.client.get(self.target_url, {'q': 'holidays'})
+        self.assertEqual(list(response.context['results']), [self.message])
+        response = self.client.get(self.target_url)
+        self.assertEqual(list(response.context['results']), [])
+        self.client.login(username='user3', password='user3')
+        response = self.client.get(self.target_url, {'q': 'holidays'})
+        self.assertEqual(list(response.context['results']), [])
+
+
+class CompleteRecipientViewTests(ViewBaseTestCase):
+    """Recipient completion, url endpoint is ``messages_complete_recipient``"""
+    def setUp(self):
+        super(CompleteRecipientViewTests, self).setUp()
+        for username in ('User10', 'other', 'user4'):
+            User.objects.create(username=username)
+        self.target_url = reverse('messages_complete_recipient')
+
+    def complete(self, q):
+        response = self.client.get(self.target_url, {'q': q})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return simplejson.loads(response.content)
+
+    def test_login_required(self):
+        response = self.client.get(self.target_url)
+        login_url = reverse('django.contrib.auth.views.login')
+        redirect_url = 'http://testserver%s?next=%s' % (login_url, self.target_url)
+        self.assertRedirects(response, redirect_url)
+
+    def test_prefix(self):
+        self.client.login(username='user1', password='user1')
+        self.assertEqual(self.complete('USER'), ['User10', 'user2', 'user3', 'user4'])
+        self.assertEqual(self.complete('oth'), ['other'])
+        self.assertEqual(self.complete('nobody'), [])
+
+    def test_correspondents_first(self):
+        Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')
+        self.client.login(username='user1', password='user1')
+        self.assertEqual(self.complete('user'), ['user3', 'User10', 'user2', 'user4'])
+        self.assertEqual(self.complete(''), ['user3'])
+
+    def test_no_query_per_keystroke(self):
+        self.client.login(username='user1', password='user1')
+        self.complete('u')
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        self.complete('us')
+        queries = [q for q in connection.queries if 'auth_user' in q['sql'] and 'LIKE' in q['sql']]
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEqual(queries, [])
+
+
+class ApiViewTests(ViewBaseTestCase):
+    """JSON api, url endpoints are ``messages_api_*``"""
+    def setUp(self):
+        super(ApiViewTests, self).setUp()
+        self.message = Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')[0]
+        self.client.login(username='user1', password='user1')
+
+    def test_login_required(self):
+        self.client.logout()
+        target_url = reverse('messages_api_inbox')
+        response = self.client.get(target_url)
+        login_url = reverse('django.contrib.auth.views.login')
+        redirect_url = 'http://testserver%s?next=%s' % (login_url, target_url)
+        self.assertRedirects(response, redirect_url)
+
+    def test_inbox(self):
+        response = self.client.get(reverse('messages_api_inbox'))
+        self.assertEqual(response.status_code, 200)
+        data = simplejson.loads(response.content)
+        self.assertEqual([m['id'] for m in data['conversations']], [self.message.pk])
+        self.assertTrue(data['conversations'][0]['new'])
+        self.assertEqual(data['conversations'][0]['sender'], 'user2')
+        self.assertEqual(data['conversations'][0]['snippet'], 'Body')
+        self.assertEqual(data['conversations'][0]['message_count'], 1)
+        self.assertEqual(data['conversations'][0]['unread_count'], 1)
+        self.assertFalse('body' in data['conversations'][0])
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_not_modified(self):
+        target_url = reverse('messages_api_inbox')
+        etag = self.client.get(target_url)['ETag']
+
+        settings.DEBUG = True  # so that django populates connection.queries
+        connection.queries = []
+        response = self.client.get(target_url, HTTP_IF_NONE_MATCH=etag)
+        queries = [q for q in connection.queries if 'django_messages_' in q['sql']]
+        connection.queries = []
+        settings.DEBUG = False
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, [])
+
+        Message.objects.send(self.user3, [self.user1], 'Subject', 'Body')
+        response = self.client.get(target_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(simplejson.loads(response.content)['conversations']), 2)
+
+    def test_modified_since(self):
+        target_url = reverse('messages_api_inbox')
+        cache.set(counters.mailbox_version_key(self.user1.pk), time() - 10.5)
+        last_modified = self.client.get(target_url)['Last-Modified']
+        response = self.client.get(target_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        counters.bump_mailbox_versions([self.user1.pk])
+        response = self.client.get(target_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_modified_within_the_same_second(self):
+        """A change in the second of the Last-Modified header is not missed"""
+        target_url = reverse('messages_api_inbox')
+        # a second that is not over yet
+        second = int(time()) + 100
+        cache.set(counters.mailbox_version_key(self.user1.pk), second + 0.2)
+        last_modified = self.client.get(target_url)['Last-Modified']
+        self.assertEqual(last_modified, http_date(second))
+
+        cache.set(counters.mailbox_version_key(self.user1.pk), second + 0.7)
+        response = self.client.get(target_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_delete_changes_version(self):
+        target_url = reverse('messages_api_trash')
+        etag = self.client.get(target_url)['ETag']
+        self.client.post(reverse('messages_delete'), {'ids': self.message.pk})
+        response = self.client.get(target_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(simplejson.loads(response.content)['conversations']), 1)
+
+    def test_conversation(self):
+        target_url = reverse('messages_api_conversation', args=(self.message.pk,))
+        response = self.client.get(target_url)
+        data = simplejson.loads(response.content)
+        self.assertEqual([m['id'] for m in data['messages']], [self.message.pk])
+        # it is read now, and the version says so
+        self.assertFalse(data['messages'][0]['new'])
+        response = self.client.get(target_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        self.client.login(username='user3', password='user3')
+        response = self.client.get(target_url)
+        self.assertEqual(response.status_code, 404)
+
+
+class ViewPagingTests(ViewBaseTestCase):
+    """Conversation detail view paging, url endpoint is ``messages_detail``"""
+    def setUp(self):
+        super(ViewPagingTests, self).setUp()
+        self.message = self.send_message(self.user1, self.user2)
+        self.message.conversation = self.message
+        self.message.save()
+        self.messages = [self.message]
+        for i in range(5):
+            self.messages.append(self.send_message(self.user2, self.user1, 
+                conversation=self.message))
+        self.target_url = reverse('messages_detail', args=(self.message.pk,))
+
+    def test_latest_messages(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.get(self.target_url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(list(response.context['conversation']), self.messages)
+        self.assertEqual(response.context['last_message'], self.messages[-1])
+
+    def test_older_messages(self):
+        request = RequestFactory().get(self.target_url)
+        request.user = self.user1
+        response = views.view(request, str(self.message.pk), per_page=2)
+        self.assertContains(response, '?before=%s' % self.messages[4].pk)
+
+        self.client.login(username='user1', password='user1')
+
+        response = self.client.get(self.target_url, {'before': self.messages[2].pk})
+        self.assertEqual(list(response.context['conversation']), self.messages[:2])
+        # The reply form still answers the latest message
+        self.assertEqual(response.context['last_message'], self.messages[-1])
+        self.assertContains(response, 
+            reverse('messages_reply', args=(self.messages[-1].pk,)))
+
+    def test_invalid_before(self):
+        self.client.login(username='user1', password='user1')
+        response = self.client.get(self.target_url, {'before': 'foo'})
+        self.assertEqual(404, response.status_code)
+        response = self.client.get(self.target_url, {'before': self.message.pk})
+        self.assertEqual(404, response.status_code)
+
+
 def ViewTests(ViewBaseTestCase):
     """Conversation detail view tests, url endpoint is ``messages_detail``"""
     def setUp(self):
@@ -494,3 +831,53 @@ def ViewTests(ViewBaseTestCase):
         redirect_url = 'http://testserver%s?next=%s' % (login_url, self.target_url)
         self.assertRedirects(response, redirect_url)
 
+
+
+class WaitViewTests(ViewBaseTestCase):
+    """long-poll and server-sent events, url endpoint is ``messages_api_wait``"""
+    def setUp(self):
+        super(WaitViewTests, self).setUp()
+        self.factory = RequestFactory()
+
+    def get(self, **kwargs):
+        request = self.factory.get(reverse('messages_api_wait'), kwargs.pop('data', {}), **kwargs)
+        request.user = self.user1
+        return views.wait(request, timeout=0.2)
+
+    def test_login_required(self):
+        target_url = reverse('messages_api_wait')
+        response = self.client.get(target_url)
+        login_url = reverse('django.contrib.auth.views.login')
+        redirect_url = 'http://testserver%s?next=%s' % (login_url, target_url)
+        self.assertRedirects(response, redirect_url)
+
+    def test_unchanged(self):
+        version = '%r' % counters.get_mailbox_version(self.user1.pk)
+        response = self.get(data={'version': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content),
+            {'version': version, 'changed': False})
+
+    def test_changed(self):
+        self.client.login(username='user1', password='user1')
+        etag = self.client.get(reverse('messages_api_inbox'))['ETag']
+        Message.objects.send(self.user2, [self.user1], 'Subject', 'Body')
+        # the ETag of the JSON api is a version as well
+        data = simplejson.loads(self.get(data={'version': etag, 'timeout': 10}).content)
+        self.assertTrue(data['changed'])
+        self.assertEqual(data['version'], '%r' % counters.get_mailbox_version(self.user1.pk))
+
+    def test_invalid_timeout(self):
+        for timeout in ('nan', 'inf', '-1', '0', 'soon'):
+            response = self.get(data={'timeout': timeout})
+            self.assertEqual(response.status_code, 400)
+
+    def test_without_version(self):
+        data = simplejson.loads(self.get().content)
+        self.assertTrue(data['changed'])
+
+    def test_event_stream(self):
+        response = self.get(HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID='1.0')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        version = counters.get_mailbox_version(self.user1.pk)
+        self.assertTrue(('id: %r\n' % version) in response.content)
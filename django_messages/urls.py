@@ -15,4 +15,14 @@ urlpatterns = patterns('',
     url(r'^delete$', delete, name='messages_delete'),
     url(r'^undelete$', undelete, name='messages_undelete'),
     url(r'^trash/$', trash, name='messages_trash'),
+    url(r'^mark_all_read$', mark_all_read, name='messages_mark_all_read'),
+    url(r'^empty_trash$', empty_trash, name='messages_empty_trash'),
+    url(r'^search/$', search, name='messages_search'),
+    url(r'^complete/$', complete_recipient, name='messages_complete_recipient'),
+    url(r'^stats/$', stats, name='messages_stats'),
+    url(r'^api/inbox/$', api_inbox, name='messages_api_inbox'),
+    url(r'^api/outbox/$', api_outbox, name='messages_api_outbox'),
+    url(r'^api/trash/$', api_trash, name='messages_api_trash'),
+    url(r'^api/view/(?P<conversation_id>[\d]+)/$', api_conversation, name='messages_api_conversation'),
+    url(r'^api/wait/$', wait, name='messages_api_wait'),
 )
@@ -12,9 +12,13 @@ from django.template.loader import render_to_string
 # favour django-mailer but fall back to django.core.mail
 
 if "mailer" in settings.INSTALLED_APPS:
-    from mailer import send_mail
+    from mailer import send_mail, send_mass_mail
 else:
-    from django.core.mail import send_mail
+    from django.core.mail import send_mail, send_mass_mail
+
+from django.core.mail import EmailMessage
+
+from django_messages.instrumentation import instrument
 
 def format_quote(sender, body):
     """
@@ -31,6 +35,21 @@ def format_quote(sender, body):
         'body': quote,
     }
 
+def message_email(message, template, site_url,
+        subject_prefix=_(u'New Message: %(subject)s')):
+    """
+    Returns the ``EmailMessage`` notifying the recipient of ``message``,
+    rendered with an already loaded ``template``.
+    """
+    subject = subject_prefix % {'subject': message.subject}
+    body = template.render(Context({
+        'site_url': site_url,
+        'message': message,
+    }))
+    return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+        [message.recipient.email,])
+message_email = instrument('notification.message_email')(message_email)
+
 def new_message_email(sender, instance, signal, 
         subject_prefix=_(u'New Message: %(subject)s'),
         template_name="django_messages/new_message.html",
@@ -60,3 +79,38 @@ def new_message_email(sender, instance, signal,
         except Exception, e:
             #print e
             pass #fail silently
+new_message_email = instrument('notification.new_message_email')(new_message_email)
+
+def new_messages_email(sender, messages, signal, 
+        subject_prefix=_(u'New Message: %(subject)s'),
+        template_name="django_messages/new_message.html",
+        default_protocol=None,
+        *args, **kwargs):
+    """
+    Same as ``new_message_email`` for the list of messages sent at once with
+    the ``messages_sent`` signal. Every email is sent through one connection.
+    """
+    if default_protocol is None:
+        default_protocol = getattr(settings, 'DEFAULT_HTTP_PROTOCOL', 'http')
+
+    try:
+        current_domain = Site.objects.get_current().domain
+        site_url = '%s://%s' % (default_protocol, current_domain)
+        datatuple = []
+        for message in messages:
+            if message.recipient.email == "":
+                continue
+            datatuple.append((
+                subject_prefix % {'subject': message.subject},
+                render_to_string(template_name, {
+                    'site_url': site_url,
+                    'message': message,
+                }),
+                settings.DEFAULT_FROM_EMAIL,
+                [message.recipient.email,],
+            ))
+        send_mass_mail(datatuple)
+    except Exception, e:
+        #print e
+        pass #fail silently
+new_messages_email = instrument('notification.new_messages_email')(new_messages_email)
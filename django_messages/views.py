@@ -1,64 +1,122 @@
 # -*- coding:utf-8 -*-
-import datetime
+import math
+import time
 
-from django.http import Http404, HttpResponseRedirect
-from django.shortcuts import render_to_response, get_object_or_404, get_list_or_404
+from django.http import Http404, HttpResponse, HttpResponseRedirect, \
+    HttpResponseNotModified, HttpResponseBadRequest
+from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.contrib.auth.models import User
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
 from django.utils.translation import ugettext as _
 from django.utils.translation import ugettext_noop
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.utils import simplejson
+from django.utils.http import http_date, parse_http_date_safe
 
-from django_messages.models import Message
+from django_messages import autocomplete, counters, push, routers
+from django_messages.instrumentation import instrument, AggregatorSink
+from django_messages.models import Message, ConversationParticipant
 from django_messages.forms import ComposeForm
 from django_messages.utils import format_quote
 
+PER_PAGE = getattr(settings, 'DJANGO_MESSAGES_PER_PAGE', 20)
+THREAD_PER_PAGE = getattr(settings, 'DJANGO_MESSAGES_THREAD_PER_PAGE', 50)
+PUSH_TIMEOUT = getattr(settings, 'DJANGO_MESSAGES_PUSH_TIMEOUT', 25)
+
 def inbox(request, template_name='django_messages/inbox.html', 
-    *args, **kwargs):
+    per_page=PER_PAGE, *args, **kwargs):
     """
     Displays a list of received messages for the current user.
     Optional Arguments:
         ``template_name``: name of the template to use.
+        ``per_page``: number of conversations in a page.
     """
-    conversations = Message.objects.inbox_for(request.user)
+    page = Message.objects.inbox_for(request.user, 
+        cursor=request.GET.get('cursor'), per_page=per_page, annotate=True)
     return render_to_response(template_name, {
-        'conversations': conversations,
+        'conversations': page.object_list,
+        'page': page,
     }, context_instance=RequestContext(request))
-inbox = login_required(inbox)
+inbox = login_required(instrument('views.inbox')(inbox))
 
 def outbox(request, template_name='django_messages/outbox.html', 
-    *args, **kwargs):
+    per_page=PER_PAGE, *args, **kwargs):
     """
     Displays a list of sent messages by the current user.
     Optional arguments:
         ``template_name``: name of the template to use.
+        ``per_page``: number of conversations in a page.
     """
-    conversations = Message.objects.outbox_for(request.user)
+    page = Message.objects.outbox_for(request.user, 
+        cursor=request.GET.get('cursor'), per_page=per_page, annotate=True)
     return render_to_response(template_name, {
-        'conversations': conversations,
+        'conversations': page.object_list,
+        'page': page,
     }, context_instance=RequestContext(request))
-outbox = login_required(outbox)
+outbox = login_required(instrument('views.outbox')(outbox))
 
 def trash(request, template_name='django_messages/trash.html', 
-    *args, **kwargs):
+    per_page=PER_PAGE, *args, **kwargs):
     """
     Displays a list of deleted messages. 
     Optional arguments:
         ``template_name``: name of the template to use
+        ``per_page``: number of conversations in a page.
     Hint: A Cron-Job could periodicly clean up old messages, which are deleted
     by sender and recipient.
     """
-    conversations = Message.objects.trash_for(request.user)
+    page = Message.objects.trash_for(request.user, 
+        cursor=request.GET.get('cursor'), per_page=per_page, annotate=True)
+    return render_to_response(template_name, {
+        'conversations': page.object_list,
+        'page': page,
+    }, context_instance=RequestContext(request))
+trash = login_required(instrument('views.trash')(trash))
+
+def search(request, template_name='django_messages/search.html', 
+    per_page=PER_PAGE, *args, **kwargs):
+    """
+    Displays the messages of the current user matching the words of the
+    ``q`` query string parameter.
+    Optional arguments:
+        ``template_name``: name of the template to use.
+        ``per_page``: number of messages in a page.
+    """
+    query = request.GET.get('q', '').strip()
+    page = None
+    if query:
+        page = Message.objects.search_for(request.user, query, 
+            cursor=request.GET.get('before'), per_page=per_page)
     return render_to_response(template_name, {
-        'conversations': conversations,
+        'query': query,
+        'results': page and page.object_list or [],
+        'page': page,
     }, context_instance=RequestContext(request))
-trash = login_required(trash)
+search = login_required(instrument('views.search')(search))
+
+def complete_recipient(request, limit=10):
+    """
+    Returns the JSON list of the usernames starting with the ``q`` query
+    string parameter, the recent correspondents of the current user first.
+    Optional arguments:
+        ``limit``: maximum number of usernames returned.
+    """
+    usernames = autocomplete.complete(request.user, request.GET.get('q', '').strip(), limit)
+    return HttpResponse(simplejson.dumps(usernames), mimetype='application/json')
+complete_recipient = login_required(instrument('views.complete_recipient')(complete_recipient))
+
+def _recipients_filter_kwargs(recipients_filter):
+    # only given when set, for the form classes that don't take it
+    if recipients_filter is None:
+        return {}
+    return {'recipients_filter': recipients_filter}
 
 def compose(request, recipient=None, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None, recipient_filter=None,
+        recipients_filter=None,
         *args, **kwargs):
     """
     Displays and handles the ``form_class`` form to compose new messages.
@@ -69,13 +127,21 @@ def compose(request, recipient=None, form_class=ComposeForm,
         ``form_class``: the form-class to use
         ``template_name``: the template to use
         ``success_url``: where to redirect after successfull submission
+        ``recipient_filter``: callable called with each recipient, returning
+                              False to reject it
+        ``recipients_filter``: callable called once with the list of
+                               recipients, returning the set of the allowed
+                               ones
     """
     if request.method == "POST":
-        form = form_class(request.POST, recipient_filter=recipient_filter, sender=request.user)
+        form = form_class(request.POST, recipient_filter=recipient_filter, sender=request.user,
+            **_recipients_filter_kwargs(recipients_filter))
         if form.is_valid():
             msg = form.save()
             messages.add_message(request, messages.INFO, _(u"Message successfully sent."))
-            if success_url is None:
+            if success_url is None and len(getattr(form, 'sent_messages', [msg])) > 1:
+                success_url = reverse('messages_outbox')
+            elif success_url is None:
                 success_url = reverse('messages_detail', kwargs={'conversation_id' : msg.conversation_id})
             if request.GET.has_key('next'):
                 success_url = request.GET['next']
@@ -90,10 +156,11 @@ def compose(request, recipient=None, form_class=ComposeForm,
     return render_to_response(template_name, {
         'form': form,
     }, context_instance=RequestContext(request))
-compose = login_required(compose)
+compose = login_required(instrument('views.compose')(compose))
 
 def reply(request, message_id, form_class=ComposeForm,
         template_name='django_messages/compose.html', success_url=None, recipient_filter=None,
+        recipients_filter=None,
         quote=None, 
         *args, **kwargs):
     """
@@ -111,7 +178,8 @@ def reply(request, message_id, form_class=ComposeForm,
         postdata = request.POST.copy()
         postdata["recipient"] = data["recipient"]
         postdata["subject"] = data["subject"]
-        form = form_class(postdata, recipient_filter=recipient_filter, sender=request.user)
+        form = form_class(postdata, recipient_filter=recipient_filter, sender=request.user,
+            **_recipients_filter_kwargs(recipients_filter))
         if form.is_valid():
             msg = form.save(parent_msg=parent)
             messages.add_message(request, messages.INFO, _(u"Message successfully sent."))
@@ -123,7 +191,7 @@ def reply(request, message_id, form_class=ComposeForm,
     return render_to_response(template_name, {
         'form': form,
     }, context_instance=RequestContext(request))
-reply = login_required(reply)
+reply = login_required(instrument('views.reply')(reply))
 
 def delete(request, success_url=None, *args, **kwargs):
     """
@@ -139,26 +207,20 @@ def delete(request, success_url=None, *args, **kwargs):
     conversation.
     """
     if request.method == 'POST' and 'ids' in request.POST:
-        user = request.user
-        now = datetime.datetime.now()
-        ids = request.POST.getlist('ids')
-        queryset = Message.objects.get_conversations(conversations=ids)
-        conversation = get_list_or_404(queryset)
-        deleted = False
         if success_url is None:
             success_url = reverse('messages_inbox')
         if request.GET.has_key('next'):
             success_url = request.GET['next']
-        # FIXME: is there a clean way to combine those 2 requests in one ?
-        result1 = queryset.filter(recipient=user).update(recipient_deleted_at=now)
-        result2 = queryset.filter(sender=user).update(sender_deleted_at=now)
-        if result1 or result2:
-            deleted = True    
+        try:
+            deleted = Message.objects.mark_deleted(request.user,
+                request.POST.getlist('ids'))
+        except ValueError:
+            raise Http404
         if deleted:
             messages.add_message(request, messages.INFO, _(u"Conversation successfully deleted."))
             return HttpResponseRedirect(success_url)
     raise Http404
-delete = login_required(delete)
+delete = login_required(instrument('views.delete')(delete))
 
 def undelete(request, success_url=None, **kwargs):
     """
@@ -166,27 +228,58 @@ def undelete(request, success_url=None, **kwargs):
     ``(sender|recipient)_deleted_at`` from the model.
     """
     if request.method == 'POST' and 'ids' in request.POST:
-        user = request.user
-        ids = request.POST.getlist('ids')
-        queryset = Message.objects.get_conversations(conversations=ids)
-        undeleted = False
         if success_url is None:
             success_url = reverse('messages_inbox')
         if request.GET.has_key('next'):
             success_url = request.GET['next']
-        
-        # FIXME: is there a clean way to combine those 2 requests in one ?
-        # FIXME: refactor, it's very similar to delete()
-        result1 = queryset.filter(recipient=user).update(recipient_deleted_at=None)
-        result2 = queryset.filter(sender=user).update(sender_deleted_at=None)
-        if result1 or result2:
-           undeleted = True    
-            
+        try:
+            undeleted = Message.objects.mark_undeleted(request.user,
+                request.POST.getlist('ids'))
+        except ValueError:
+            raise Http404
         if undeleted:
             messages.add_message(request, messages.INFO, _(u"Conversation successfully recovered."))
             return HttpResponseRedirect(success_url)
     raise Http404
-undelete = login_required(undelete)
+undelete = login_required(instrument('views.undelete')(undelete))
+
+def mark_all_read(request, success_url=None, *args, **kwargs):
+    """
+    Marks read every conversation of the user, or only the messages up to
+    the one whose id is posted as ``up_to``.
+    """
+    if request.method == 'POST':
+        if success_url is None:
+            success_url = reverse('messages_inbox')
+        if request.GET.has_key('next'):
+            success_url = request.GET['next']
+        up_to = request.POST.get('up_to') or None
+        if up_to is not None:
+            try:
+                up_to = int(up_to)
+            except ValueError:
+                raise Http404
+        ConversationParticipant.objects.mark_all_read(request.user, up_to=up_to)
+        messages.add_message(request, messages.INFO, _(u"Conversations marked read."))
+        return HttpResponseRedirect(success_url)
+    raise Http404
+mark_all_read = login_required(instrument('views.mark_all_read')(mark_all_read))
+
+def empty_trash(request, success_url=None, *args, **kwargs):
+    """
+    Removes every conversation from the trash of the user. The messages
+    are purged later, once their other participant deleted them as well.
+    """
+    if request.method == 'POST':
+        if success_url is None:
+            success_url = reverse('messages_trash')
+        if request.GET.has_key('next'):
+            success_url = request.GET['next']
+        ConversationParticipant.objects.empty_trash(request.user)
+        messages.add_message(request, messages.INFO, _(u"Trash emptied."))
+        return HttpResponseRedirect(success_url)
+    raise Http404
+empty_trash = login_required(instrument('views.empty_trash')(empty_trash))
     
 def _get_form_data_and_check_parent(request, parent, quote):
     if parent.sender != request.user and parent.recipient != request.user:
@@ -214,31 +307,222 @@ def _get_form_data_and_check_parent(request, parent, quote):
 def view(request, conversation_id, 
     form_class=ComposeForm, quote=None,
     template_name='django_messages/view.html',
-    *args, **kwargs):
+    per_page=THREAD_PER_PAGE, *args, **kwargs):
     """
     Shows a single conversation.``conversation_id`` argument is required.
     The user is only allowed to see the conversation, if he is either 
     the sender or the recipient. If the user is not allowed a 404
     is raised. 
-    If the user is the recipient and the message is unread 
-    ``read_at`` is set to the current datetime.
+    Only the ``per_page`` latest messages are shown, the older ones are
+    shown by passing the id of the oldest message shown in the ``before``
+    query string parameter.
+    The read cursor of the user in the conversation is moved up to its
+    latest message.
     """
-    conversation = Message.objects.get_conversation(conversation_id)
-    if not conversation:
+    before = request.GET.get('before')
+    if before is not None:
+        try:
+            before = int(before)
+        except ValueError:
+            raise Http404
+    page = Message.objects.get_conversation_page(conversation_id, 
+        before=before, per_page=per_page)
+    if not page:
         raise Http404
         
     if not quote:
         quote = getattr(settings, 'DJANGO_MESSAGES_QUOTE', format_quote)
     
-    # FIXME: will force query evaluation. Is that a problem ?
-    data = _get_form_data_and_check_parent(request, conversation[len(conversation) - 1], quote)
+    if before is None:
+        last_message = page[len(page) - 1]
+    else:
+        last_message = Message.objects.get_last_message(conversation_id)
+    data = _get_form_data_and_check_parent(request, last_message, quote)
     
-    # FIXME This might be costly, since read_at is not indexed
-    now = datetime.datetime.now()
-    conversation.filter(recipient=request.user, read_at__isnull=True).update(read_at=now)
+    read = ConversationParticipant.objects.mark_read(request.user, 
+        conversation_id, last_message)
+    if read:
+        counters.incr_inbox_count(request.user.pk, -read)
 
     return render_to_response(template_name, {
-        'conversation': conversation,
+        'conversation': page.object_list,
+        'page': page,
+        'last_message': last_message,
         'form' : form_class(data, sender=request.user),
     }, context_instance=RequestContext(request))
-view = login_required(view)
+view = login_required(instrument('views.view')(view))
+
+def stats(request):
+    """
+    Returns the JSON metrics summed by the ``AggregatorSink`` of this
+    process. Only staff members are allowed.
+    """
+    return HttpResponse(simplejson.dumps(AggregatorSink.get_stats()),
+        mimetype='application/json')
+stats = user_passes_test(lambda user: user.is_staff)(stats)
+
+def _message_to_dict(message, body=True):
+    data = {
+        'id': message.pk,
+        'conversation_id': message.conversation_id or message.pk,
+        'subject': message.subject,
+        'snippet': message.snippet,
+        'sender': message.sender and message.sender.username,
+        'recipient': message.recipient and message.recipient.username,
+        'sent_at': message.sent_at and message.sent_at.isoformat(),
+        'new': message.new(),
+        'replied': message.replied(),
+        'url': message.get_absolute_url(),
+    }
+    # the body isn't loaded in the listings
+    if body:
+        data['body'] = message.body
+    # set by Message.objects.annotate_conversations
+    if hasattr(message, 'message_count'):
+        data['message_count'] = message.message_count
+        data['unread_count'] = message.unread_count
+        data['last_activity'] = message.last_activity and message.last_activity.isoformat()
+    return data
+
+def _mailbox_etag(version):
+    return '"%r"' % version
+
+def _last_modified(version):
+    """
+    Returns the whole second a client can send back as ``If-Modified-Since``
+    for ``version``. It is the next second once that one began, since no
+    later change can predate it, and the second of the version until then,
+    which never gets a 304.
+    """
+    last_modified = int(version) + 1
+    if last_modified > time.time():
+        last_modified -= 1
+    return last_modified
+
+def _mailbox_response(request, get_data, changes_version=False):
+    """
+    Returns the JSON of ``get_data()``, tagged with the version of the
+    mailbox of the current user, or a 304 if the client already has that
+    version. Only the version is read from the cache to answer a 304.
+    If ``get_data`` itself changes the mailbox, ``changes_version`` tags
+    the response with the version read afterwards.
+
+    The data is read from the primary database: read from a replica lagging
+    behind, it could predate the version and be answered by 304s until the
+    next change.
+    """
+    version = counters.get_mailbox_version(request.user.pk)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        not_modified = _mailbox_etag(version) in tags
+    else:
+        since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        not_modified = since is not None and version < since
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        routers.pin_primary()
+        response = HttpResponse(simplejson.dumps(get_data()),
+            mimetype='application/json')
+        if changes_version:
+            version = counters.get_mailbox_version(request.user.pk)
+    response['ETag'] = _mailbox_etag(version)
+    response['Last-Modified'] = http_date(_last_modified(version))
+    response['Cache-Control'] = 'private, must-revalidate'
+    return response
+
+def _box_api(box_for):
+    def api(request, per_page=PER_PAGE, *args, **kwargs):
+        def get_data():
+            page = box_for(request.user, 
+                cursor=request.GET.get('cursor'), per_page=per_page, annotate=True)
+            return {
+                'conversations': [_message_to_dict(message, body=False) for message in page],
+                'next_cursor': page.next_cursor,
+                'previous_cursor': page.previous_cursor,
+            }
+        return _mailbox_response(request, get_data)
+    return api
+
+# Return the JSON page of the inbox, outbox or trash of the current user
+# designated by the ``cursor`` query string parameter, with the version of
+# their mailbox as ``ETag`` and ``Last-Modified``.
+api_inbox = login_required(instrument('views.api_inbox')(_box_api(Message.objects.inbox_for)))
+api_outbox = login_required(instrument('views.api_outbox')(_box_api(Message.objects.outbox_for)))
+api_trash = login_required(instrument('views.api_trash')(_box_api(Message.objects.trash_for)))
+
+def api_conversation(request, conversation_id, 
+    per_page=THREAD_PER_PAGE, *args, **kwargs):
+    """
+    Returns the JSON of the latest messages of a conversation, older ones
+    given the ``before`` query string parameter, like the ``view`` view
+    does, with the version of the mailbox of the current user as ``ETag``
+    and ``Last-Modified``. The conversation is marked read.
+    """
+    def get_data():
+        before = request.GET.get('before')
+        if before is not None:
+            try:
+                before = int(before)
+            except ValueError:
+                raise Http404
+        last_message = Message.objects.get_last_message(conversation_id)
+        if last_message is None:
+            raise Http404
+        _get_form_data_and_check_parent(request, last_message, format_quote)
+        read = ConversationParticipant.objects.mark_read(request.user, 
+            conversation_id, last_message)
+        if read:
+            counters.incr_inbox_count(request.user.pk, -read)
+        page = Message.objects.get_conversation_page(conversation_id, 
+            before=before, per_page=per_page)
+        return {
+            'messages': [_message_to_dict(message) for message in page],
+            'next_cursor': page.next_cursor,
+        }
+    return _mailbox_response(request, get_data, changes_version=True)
+api_conversation = login_required(instrument('views.api_conversation')(api_conversation))
+
+def _parse_version(value):
+    """returns the version of a query string parameter or ETag, or None"""
+    try:
+        return float((value or '').strip('"'))
+    except ValueError:
+        return None
+
+def wait(request, timeout=PUSH_TIMEOUT, *args, **kwargs):
+    """
+    Waits until the mailbox version of the current user differs from the
+    ``version`` query string parameter, or until ``timeout`` seconds elapse,
+    then returns the JSON of the current version and whether it changed.
+    The client then fetches what changed with the JSON api and waits again.
+
+    A client accepting ``text/event-stream`` gets the server-sent events of
+    the changes instead, the last known version being taken from the
+    ``Last-Event-ID`` header when it reconnects. The ``timeout`` query string
+    parameter may shorten the wait.
+    """
+    if 'timeout' in request.GET:
+        try:
+            requested = float(request.GET['timeout'])
+        except ValueError:
+            return HttpResponseBadRequest('Invalid timeout')
+        # nan and inf would never let the wait end
+        if math.isnan(requested) or math.isinf(requested) or requested <= 0:
+            return HttpResponseBadRequest('Invalid timeout')
+        timeout = min(requested, timeout)
+    version = _parse_version(request.GET.get('version',
+        request.META.get('HTTP_LAST_EVENT_ID')))
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = HttpResponse(push.event_stream(request.user.pk, version, timeout),
+            mimetype='text/event-stream')
+    else:
+        current = push.get_broker().wait(request.user.pk, version, timeout)
+        response = HttpResponse(simplejson.dumps({
+            'version': '%r' % current,
+            'changed': current != version,
+        }), mimetype='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
+wait = login_required(wait)
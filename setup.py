@@ -16,6 +16,7 @@ setup(
         'django_messages': [
             'templates/django_messages/*',
             'templates/notification/*/*',
+            'sql/*',
             'locale/*/LC_MESSAGES/*',
         ]
     },